@@ -0,0 +1,150 @@
+#! /usr/bin/env python
+
+import sys
+import os
+import argparse
+import time
+import resource
+
+# non-default import
+import numpy as np
+
+# Project imports
+from data import *
+from item_extraction import *
+from image_utils import *
+from item_processing import *
+from synthetic_field import read_actual_code_names, read_actual_positions
+import stage2_grouping as stage2
+import stage3_plant_extraction as stage3
+import stage4_output as stage4
+
+def peak_memory_megabytes():
+    '''Return (this process, largest child process) peak resident memory in megabytes.'''
+    # Linux reports kilobytes.
+    self_usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    return self_usage, children_usage
+
+def nearest_distances(positions, other_positions):
+    '''Return distance from each (x, y) position to the closest of the other positions.  Infinite if there are no other positions.'''
+    if len(other_positions) == 0:
+        return np.full(len(positions), np.inf)
+    return np.array([np.min(np.hypot(*(other_positions - position).T)) for position in positions]).reshape(-1)
+
+def detection_recall(items, actual_positions, tolerance):
+    '''
+    Return (fraction of actual positions that have an item within tolerance, number of unique items not within tolerance
+    of any actual position).  Tolerance is in meters.
+    '''
+    item_positions = np.array([item.position[:2] for item in items], dtype=np.float64).reshape(-1, 2)
+    recall = np.mean(nearest_distances(actual_positions, item_positions) <= tolerance) if len(actual_positions) > 0 else 1.0
+    unique_items = merge_items(items, max_distance=tolerance * 100)
+    unique_positions = np.array([item.position[:2] for item in unique_items], dtype=np.float64).reshape(-1, 2)
+    num_false_items = np.count_nonzero(nearest_distances(unique_positions, actual_positions) > tolerance)
+    return recall, num_false_items
+
+def run_benchmark(data_directory, output_directory, qr_size, resolution, field_direction=90, workers=1,
+                  min_code_pixels=0, adaptive_order=False, max_scan_attempts=0, min_plant_size=4, max_plant_size=30,
+                  stick_length=30, stick_diameter=1.5, detection_tolerance=10):
+    '''
+    Run stages 1 through 4 on field written by synthetic_field.py and return dictionary of results.  Durations are in seconds
+    and recall is the fraction of actual codes, plants or sticks that were found.  Plants and sticks are found if one is
+    detected within the tolerance (in centimeters) of its actual position.  Sizes are in centimeters.
+    '''
+    image_directory = os.path.join(data_directory, 'images')
+    image_filenames = read_images(image_directory, ['tiff', 'tif', 'jpg', 'jpeg', 'png'])
+    geo_images = parse_geo_file(os.path.join(data_directory, 'geo.csv'), resolution, 0, 0, 0, 0)
+    geo_images = sorted(geo_images, key=lambda image: image.image_time)
+    geo_images, missing_image_count = verify_geo_images(geo_images, image_filenames)
+    if missing_image_count > 0:
+        print "Warning {0} geo images do not exist and will be skipped.".format(missing_image_count)
+
+    results = {}
+
+    # Stage 1
+    item_extractor = ItemExtractor([QRLocator(qr_size, min_code_pixels, adaptive_order, max_scan_attempts),
+                                    PlantLocator(min_plant_size, max_plant_size),
+                                    BlueStickLocator(stick_length, stick_diameter)])
+    ImageWriter.level = ImageWriter.NORMAL
+    start_time = time.time()
+    all_items = []
+    for geo_image, image_items in process_geo_images(geo_images, item_extractor, 0, image_directory, output_directory, False, workers):
+        if image_items is None:
+            image_items = []
+        geo_image.items = image_items
+        all_items += image_items
+    results['stage1_seconds'] = time.time() - start_time
+    results['num_images'] = len(geo_images)
+    all_codes = [item for item in all_items if 'code' in item.type.lower()]
+    results['num_codes'] = len(all_codes)
+
+    actual_code_names = read_actual_code_names(os.path.join(data_directory, 'codes.csv'))
+    found_code_names = set(code.name for code in all_codes)
+    results['recall'] = len(found_code_names & actual_code_names) / float(len(actual_code_names))
+    results['num_false_codes'] = len(found_code_names - actual_code_names)
+
+    tolerance = detection_tolerance / 100.0 # centimeters to meters
+    # Blue stick locator returns plain field items.
+    for name, item_type, positions_filename in [('plant', 'plant', 'plants.csv'), ('stick', 'fielditem', 'sticks.csv')]:
+        actual_positions = read_actual_positions(os.path.join(data_directory, positions_filename))
+        found_items = [item for item in all_items if item.type.lower() == item_type]
+        results['{}_recall'.format(name)], results['num_false_{}s'.format(name)] = detection_recall(found_items, actual_positions, tolerance)
+
+    # Stage 2
+    start_time = time.time()
+    grouping_info = stage2.load_grouping_info(os.path.join(data_directory, 'grouping.csv'))
+    rows = stage2.group_codes_into_rows(geo_images, grouping_info, field_direction)
+    results['stage2_seconds'] = time.time() - start_time
+
+    # Stage 3
+    start_time = time.time()
+    rows = stage3.place_plants_in_rows(rows)
+    results['stage3_seconds'] = time.time() - start_time
+
+    # Stage 4
+    start_time = time.time()
+    row_directions = dict((row.number, row.direction) for row in rows)
+    stage4.export_field_results(lambda: rows, row_directions, output_directory)
+    results['stage4_seconds'] = time.time() - start_time
+
+    results['peak_memory_mb'], results['peak_worker_memory_mb'] = peak_memory_megabytes()
+
+    return results
+
+if __name__ == '__main__':
+    '''Measure throughput and code recall of all stages on a synthetic field.'''
+
+    parser = argparse.ArgumentParser(description='''Measure throughput and code recall of all stages on a synthetic field.''')
+    parser.add_argument('data_directory', help='directory written by synthetic_field.py')
+    parser.add_argument('output_directory', help='where to write output files')
+    parser.add_argument('-qr', dest='qr_size', default=6.0, help='side length of QR item in centimeters. Must match generated field. Default 6.')
+    parser.add_argument('-rs', dest='resolution', default=0.1, help='Image resolution in centimeter/pixel. Must match generated field. Default 0.1.')
+    parser.add_argument('-mp', dest='min_code_pixels', default=0, help='If > 0 then codes are searched for in a reduced image where a code is at least this many pixels wide. Default 0 (full resolution).')
+    parser.add_argument('-ao', dest='adaptive_order', default='false', help='If true then the trim/threshold combinations that decode the most codes are tried first. Default false.')
+    parser.add_argument('-ma', dest='max_scan_attempts', default=0, help='If > 0 then the max number of trim/threshold combinations to try for each possible code. Default 0 (try all).')
+    parser.add_argument('-dt', dest='detection_tolerance', default=10, help='Max distance in centimeters a plant or stick can be detected from its actual position and still count as found. Default 10.')
+    parser.add_argument('-j', '--workers', dest='workers', default=1, help='Number of processes to analyze images with. Default 1.')
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_directory):
+        os.makedirs(args.output_directory)
+
+    results = run_benchmark(args.data_directory, args.output_directory, float(args.qr_size), float(args.resolution),
+                            workers=int(args.workers), min_code_pixels=float(args.min_code_pixels),
+                            adaptive_order=args.adaptive_order.lower() == 'true', max_scan_attempts=int(args.max_scan_attempts),
+                            detection_tolerance=float(args.detection_tolerance))
+
+    total_seconds = sum(results['stage{}_seconds'.format(stage)] for stage in range(1, 5))
+    print "\nBenchmark results"
+    print "Stage 1: {:.2f} s ({:.2f} images/sec, {:.2f} codes/sec)".format(results['stage1_seconds'],
+                                                                       results['num_images'] / results['stage1_seconds'],
+                                                                       results['num_codes'] / results['stage1_seconds'])
+    for stage in range(2, 5):
+        print "Stage {}: {:.2f} s".format(stage, results['stage{}_seconds'.format(stage)])
+    print "Total: {:.2f} s ({:.2f} images/sec)".format(total_seconds, results['num_images'] / total_seconds)
+    print "Code recall: {:.1f}% with {} unexpected codes".format(results['recall'] * 100, results['num_false_codes'])
+    print "Plant recall: {:.1f}% with {} unexpected plants".format(results['plant_recall'] * 100, results['num_false_plants'])
+    print "Stick recall: {:.1f}% with {} unexpected sticks".format(results['stick_recall'] * 100, results['num_false_sticks'])
+    print "Peak memory: {:.0f} MB (largest worker {:.0f} MB)".format(results['peak_memory_mb'], results['peak_worker_memory_mb'])
@@ -0,0 +1,190 @@
+#! /usr/bin/env python
+
+import os
+import pickle
+
+import numpy as np
+
+# Project imports
+from data import *
+
+# Item classes that can be recreated from the saved type column.
+item_classes = {'FieldItem': FieldItem, 'Plant': Plant, 'Gap': Gap, 'GroupCode': GroupCode, 'RowCode': RowCode}
+
+# Column names are prefixed by the table they belong to when saved.
+image_prefix = 'image_'
+item_prefix = 'item_'
+
+class ItemColumns(object):
+    '''Field items and the geo images they were found in, stored as one array per attribute.'''
+    def __init__(self, image_columns, item_columns):
+        '''Constructor. Each column is an array with one entry per image (or item).'''
+        self.image_columns = image_columns # column name -> array with an entry for each geo image
+        self.item_columns = item_columns # column name -> array with an entry for each item. 'image_index' refers to parent image.
+
+    @property
+    def num_images(self):
+        return len(self.image_columns['file_name'])
+
+    @property
+    def num_items(self):
+        return len(self.item_columns['name'])
+
+    def code_mask(self):
+        '''Return boolean array that's true for each item that's a code.'''
+        return np.char.find(np.char.lower(np.asarray(self.item_columns['type'])), 'code') >= 0
+
+    def select_items(self, mask):
+        '''Return new columns with only the items where mask is true.  Image columns are shared.'''
+        return ItemColumns(self.image_columns, dict((name, column[mask]) for name, column in self.item_columns.iteritems()))
+
+    def codes(self):
+        '''Return new columns with only code items.'''
+        return self.select_items(self.code_mask())
+
+    def geo_images(self):
+        '''Return list of geo images with items attached in the same order they were saved.'''
+        images = self.image_columns
+        geo_images = []
+        for i in range(self.num_images):
+            geo_image = GeoImage(str(images['file_name'][i]), image_time=float(images['image_time'][i]),
+                                 position=tuple(images['position'][i]), heading_degrees=float(images['heading_degrees'][i]),
+                                 provided_resolution=float(images['provided_resolution'][i]), focal_length=float(images['focal_length'][i]),
+                                 camera_rotation_degrees=float(images['camera_rotation_degrees'][i]), camera_height=float(images['camera_height'][i]),
+                                 sensor_width=float(images['sensor_width'][i]), size=tuple(int(v) for v in images['size'][i]))
+            geo_image.top_left_position = tuple(images['corner_positions'][i][0])
+            geo_image.top_right_position = tuple(images['corner_positions'][i][1])
+            geo_image.bottom_right_position = tuple(images['corner_positions'][i][2])
+            geo_image.bottom_left_position = tuple(images['corner_positions'][i][3])
+            geo_image.items = []
+            geo_images.append(geo_image)
+
+        items = self.item_columns
+        for i in range(self.num_items):
+            item_class = item_classes[str(items['type'][i])]
+            bounding_rect = None
+            rect = items['bounding_rect'][i]
+            if not np.isnan(rect[0]):
+                bounding_rect = ((float(rect[0]), float(rect[1])), (float(rect[2]), float(rect[3])), float(rect[4]))
+            parent_image = geo_images[int(items['image_index'][i])]
+            item = item_class(str(items['name'][i]), position=tuple(items['position'][i]), size=tuple(items['size'][i]),
+                              area=float(items['area'][i]), image_path=str(items['image_path'][i]),
+                              parent_image_filename=parent_image.file_name, bounding_rect=bounding_rect)
+            parent_image.items.append(item)
+
+        return geo_images
+
+def geo_images_to_columns(geo_images):
+    '''Return ItemColumns containing geo images and all items attached to them.'''
+    image_columns = {}
+    image_columns['file_name'] = np.array([image.file_name for image in geo_images], dtype='S')
+    image_columns['image_time'] = np.array([image.image_time for image in geo_images], dtype=np.float64)
+    image_columns['position'] = np.array([image.position for image in geo_images], dtype=np.float64).reshape(-1, 3)
+    image_columns['heading_degrees'] = np.array([image.heading_degrees for image in geo_images], dtype=np.float64)
+    image_columns['provided_resolution'] = np.array([image.provided_resolution for image in geo_images], dtype=np.float64)
+    image_columns['focal_length'] = np.array([image.focal_length for image in geo_images], dtype=np.float64)
+    image_columns['camera_rotation_degrees'] = np.array([image.camera_rotation_degrees for image in geo_images], dtype=np.float64)
+    image_columns['camera_height'] = np.array([image.camera_height for image in geo_images], dtype=np.float64)
+    image_columns['sensor_width'] = np.array([image.sensor_width for image in geo_images], dtype=np.float64)
+    image_columns['size'] = np.array([image.size for image in geo_images], dtype=np.int32).reshape(-1, 2)
+    image_columns['corner_positions'] = np.array([(image.top_left_position, image.top_right_position,
+                                                   image.bottom_right_position, image.bottom_left_position)
+                                                  for image in geo_images], dtype=np.float64).reshape(-1, 4, 3)
+
+    items = []
+    image_indexes = []
+    for image_index, geo_image in enumerate(geo_images):
+        image_items = getattr(geo_image, 'items', [])
+        items += image_items
+        image_indexes += [image_index] * len(image_items)
+
+    nan_rect = (np.nan,) * 5
+    item_columns = {}
+    item_columns['name'] = np.array([item.name for item in items], dtype='S')
+    item_columns['type'] = np.array([item.type for item in items], dtype='S')
+    item_columns['position'] = np.array([item.position for item in items], dtype=np.float64).reshape(-1, 3)
+    item_columns['size'] = np.array([item.size for item in items], dtype=np.float64).reshape(-1, 2)
+    item_columns['area'] = np.array([item.area for item in items], dtype=np.float64)
+    item_columns['bounding_rect'] = np.array([nan_rect if item.bounding_rect is None else flatten_rotated_rect(item.bounding_rect)
+                                              for item in items], dtype=np.float64).reshape(-1, 5)
+    item_columns['image_path'] = np.array([item.image_path for item in items], dtype='S')
+    item_columns['image_index'] = np.array(image_indexes, dtype=np.int32)
+
+    return ItemColumns(image_columns, item_columns)
+
+def flatten_rotated_rect(rect):
+    '''Return rotated rectangle ((center x, center y), (width, height), angle) as a flat 5 tuple.'''
+    (center_x, center_y), (width, height), angle = rect
+    return (center_x, center_y, width, height, angle)
+
+def save_item_columns(geo_images, output_path, compressed=False):
+    '''
+    Save geo images and their items to output path and return the path that was written.  If compressed then written to
+    a single .npz file, otherwise output path is a directory with a .npy file for each column that can be memory mapped.
+    '''
+    columns = geo_images_to_columns(geo_images)
+    named_columns = {}
+    for name, column in columns.image_columns.iteritems():
+        named_columns[image_prefix + name] = column
+    for name, column in columns.item_columns.iteritems():
+        named_columns[item_prefix + name] = column
+
+    if compressed:
+        if not output_path.endswith('.npz'):
+            output_path += '.npz'
+        np.savez_compressed(output_path, **named_columns)
+    else:
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+        for name, column in named_columns.iteritems():
+            np.save(os.path.join(output_path, name + '.npy'), column)
+
+    return output_path
+
+def is_item_columns_path(path):
+    '''Return true if path was written by save_item_columns().'''
+    if os.path.isdir(path):
+        return os.path.exists(os.path.join(path, item_prefix + 'name.npy'))
+    return path.endswith('.npz')
+
+def load_item_columns(input_path, codes_only=False):
+    '''Return ItemColumns read from input path.  Uncompressed columns are memory mapped so only the items that are used get read.'''
+    named_columns = {}
+    if os.path.isdir(input_path):
+        for filename in os.listdir(input_path):
+            name, extension = os.path.splitext(filename)
+            if extension == '.npy':
+                named_columns[name] = np.load(os.path.join(input_path, filename), mmap_mode='r')
+    else:
+        with np.load(input_path) as archive:
+            for name in archive.files:
+                named_columns[name] = archive[name]
+
+    image_columns = dict((name[len(image_prefix):], column) for name, column in named_columns.iteritems() if name.startswith(image_prefix))
+    item_columns = dict((name[len(item_prefix):], column) for name, column in named_columns.iteritems() if name.startswith(item_prefix))
+    columns = ItemColumns(image_columns, item_columns)
+
+    if codes_only:
+        columns = columns.codes()
+
+    return columns
+
+def load_stage1_geo_images(input_directory, codes_only=False):
+    '''
+    Return list of geo images from all stage 1 output found in input directory.  Output can either be pickled geo images
+    or item columns.  If codes only is true then only code items are loaded from item columns.
+    '''
+    stage1_filenames = os.listdir(input_directory)
+    geo_images = []
+    for stage1_filename in stage1_filenames:
+        stage1_filepath = os.path.join(input_directory, stage1_filename)
+        if is_item_columns_path(stage1_filepath):
+            file_geo_images = load_item_columns(stage1_filepath, codes_only).geo_images()
+        elif os.path.isfile(stage1_filepath):
+            with open(stage1_filepath) as stage1_file:
+                file_geo_images = pickle.load(stage1_file)
+        else:
+            continue # not stage 1 output
+        print 'Loaded {} geo images from {}'.format(len(file_geo_images), stage1_filename)
+        geo_images += file_geo_images
+    return geo_images
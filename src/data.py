@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from math import sqrt
+from collections import defaultdict
 
 class GeoImage(object):
     '''Image properties with X,Y,Z position and heading. All distances in centimeters.'''
@@ -190,3 +191,46 @@ class PlantGroup(object):
         for segment in self.segments:
             length += segment.length
         return length
+
+class GroupingInfo(object):
+    '''
+    Expected groups listed in grouping file.  Each info is a tuple (qr_id, entry, rep, estimated_num_plants, order_entered)
+    and can be looked up by QR id or by the order it was entered in the document.
+    '''
+    def __init__(self, infos=None):
+        '''Constructor.'''
+        self.infos = [] # all infos in the order they were added
+        self.by_id = defaultdict(list) # QR id -> infos with that id
+        self.by_order_entered = defaultdict(list) # order entered -> infos with that order
+        if infos is not None:
+            for info in infos:
+                self.add(info)
+            
+    def __len__(self):
+        return len(self.infos)
+    
+    def __iter__(self):
+        return iter(self.infos)
+        
+    def add(self, info):
+        '''Add info tuple and index it.'''
+        self.infos.append(info)
+        self.by_id[info[0]].append(info)
+        self.by_order_entered[info[4]].append(info)
+        
+    def matching_id(self, qr_id):
+        '''Return list of infos with the specified QR id.'''
+        return self.by_id.get(qr_id, [])
+    
+    def matching_order_entered(self, order_entered):
+        '''Return list of infos that were entered in the specified order.'''
+        return self.by_order_entered.get(order_entered, [])
+    
+    def missing_ids(self, found_ids):
+        '''Return ids in the order they were added that aren't in found ids.'''
+        found_ids = set(found_ids)
+        return [info[0] for info in self.infos if info[0] not in found_ids]
+    
+    def extra_ids(self, found_ids):
+        '''Return found ids (in same order) that don't have any info.'''
+        return [id for id in found_ids if id not in self.by_id]
@@ -0,0 +1,193 @@
+#! /usr/bin/env python
+
+import os
+import sqlite3
+
+# Project imports
+from data import *
+from columnar_items import item_classes
+
+# Field item attributes saved for both codes and plants. Position and size are split into separate columns.
+item_columns = ['type', 'name', 'entry', 'rep', 'x', 'y', 'z', 'width', 'height', 'area', 'row', 'range', 'image_path', 'parent_image_filename']
+
+schema = '''
+CREATE TABLE IF NOT EXISTS rows (number INTEGER PRIMARY KEY, direction TEXT, start_code_id INTEGER, end_code_id INTEGER);
+CREATE TABLE IF NOT EXISTS groups (id INTEGER PRIMARY KEY, expected_num_plants INTEGER);
+CREATE TABLE IF NOT EXISTS segments (id INTEGER PRIMARY KEY, row_number INTEGER, row_index INTEGER, group_id INTEGER,
+                                     start_code_id INTEGER, end_code_id INTEGER, expected_num_plants INTEGER);
+CREATE TABLE IF NOT EXISTS codes (id INTEGER PRIMARY KEY, parent_id INTEGER, {0});
+CREATE TABLE IF NOT EXISTS plants (id INTEGER PRIMARY KEY, segment_id INTEGER, segment_index INTEGER, parent_id INTEGER, {0});
+CREATE INDEX IF NOT EXISTS segments_by_row ON segments (row_number, row_index);
+CREATE INDEX IF NOT EXISTS segments_by_group ON segments (group_id);
+CREATE INDEX IF NOT EXISTS codes_by_parent ON codes (parent_id);
+CREATE INDEX IF NOT EXISTS codes_by_name ON codes (name);
+CREATE INDEX IF NOT EXISTS plants_by_segment ON plants (segment_id, segment_index);
+CREATE INDEX IF NOT EXISTS plants_by_parent ON plants (parent_id);
+'''.format(', '.join(item_columns))
+
+def is_field_database_path(filepath):
+    '''Return true if filepath refers to a field database (rather than pickled rows).'''
+    return os.path.splitext(filepath)[1].lower() == '.db'
+
+def item_to_values(item):
+    '''Return tuple of values for item columns.'''
+    row = item.row_number if hasattr(item, 'row_number') else item.row
+    return (item.type, item.name, getattr(item, 'entry', None), getattr(item, 'rep', None),
+            item.position[0], item.position[1], item.position[2], item.size[0], item.size[1], item.area,
+            row, item.range, item.image_path, item.parent_image_filename)
+
+def values_to_item(values):
+    '''Return new field item from item column values.'''
+    (item_type, name, entry, rep, x, y, z, width, height, area, row, range_grid, image_path, parent_image_filename) = values
+    item = item_classes[item_type](name, position=(x, y, z), size=(width, height), area=area, row=row, range_grid=range_grid,
+                                   image_path=image_path, parent_image_filename=parent_image_filename)
+    if entry is not None:
+        item.entry = entry
+    if rep is not None:
+        item.rep = rep
+    return item
+
+class FieldDatabase(object):
+    '''Rows, segments, groups, codes and plants of a field stored in an SQLite file so stages can read and update parts of it.'''
+    def __init__(self, filepath):
+        '''Constructor. Creates database file and tables if they don't exist.'''
+        self.filepath = filepath
+        self.connection = sqlite3.connect(filepath)
+        self.connection.executescript(schema)
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def commit(self):
+        self.connection.commit()
+
+    def save_rows(self, rows):
+        '''Replace everything in database with rows and the segments, groups, codes and plants they contain.'''
+        cursor = self.connection.cursor()
+        for table in ['rows', 'groups', 'segments', 'codes', 'plants']:
+            cursor.execute('DELETE FROM {}'.format(table))
+
+        code_ids = {} # python id of code -> database id. Same code is end of one segment and start of the next.
+        group_ids = {}
+
+        def save_code(code):
+            if id(code) in code_ids:
+                return code_ids[id(code)]
+            code_id = self._insert_item(cursor, 'codes', ('parent_id',), (None,), code)
+            code_ids[id(code)] = code_id
+            for other_code in code.other_items:
+                self._insert_item(cursor, 'codes', ('parent_id',), (code_id,), other_code)
+            return code_id
+
+        for row in rows:
+            cursor.execute('INSERT INTO rows (number, direction, start_code_id, end_code_id) VALUES (?, ?, ?, ?)',
+                           (row.number, row.direction, save_code(row.start_code), save_code(row.end_code)))
+            for row_index, segment in enumerate(row.group_segments):
+                group_id = None
+                if segment.group is not None:
+                    if id(segment.group) not in group_ids:
+                        cursor.execute('INSERT INTO groups (expected_num_plants) VALUES (?)', (segment.group.expected_num_plants,))
+                        group_ids[id(segment.group)] = cursor.lastrowid
+                    group_id = group_ids[id(segment.group)]
+                cursor.execute('INSERT INTO segments (row_number, row_index, group_id, start_code_id, end_code_id, expected_num_plants) '
+                               'VALUES (?, ?, ?, ?, ?, ?)', (row.number, row_index, group_id, save_code(segment.start_code),
+                                                             save_code(segment.end_code), segment.expected_num_plants))
+                self._insert_plants(cursor, cursor.lastrowid, segment.items)
+
+        self.connection.commit()
+
+    def _insert_item(self, cursor, table, extra_columns, extra_values, item):
+        '''Insert item into table and return its id.'''
+        columns = list(extra_columns) + item_columns
+        cursor.execute('INSERT INTO {} ({}) VALUES ({})'.format(table, ', '.join(columns), ', '.join('?' * len(columns))),
+                       tuple(extra_values) + item_to_values(item))
+        return cursor.lastrowid
+
+    def _insert_plants(self, cursor, segment_id, plants, first_segment_index=0):
+        '''Insert plants into segment along with their references.  References aren't in a segment so they only have a parent.'''
+        for segment_index, plant in enumerate(plants, first_segment_index):
+            plant_id = self._insert_item(cursor, 'plants', ('segment_id', 'segment_index', 'parent_id'), (segment_id, segment_index, None), plant)
+            for other_item in plant.other_items:
+                self._insert_item(cursor, 'plants', ('segment_id', 'segment_index', 'parent_id'), (None, None, plant_id), other_item)
+
+    def add_segment_plants(self, segment_id, plants):
+        '''Add plants after any items already stored in segment.  Changes aren't saved until commit().'''
+        cursor = self.connection.cursor()
+        num_existing_plants = cursor.execute('SELECT COUNT(*) FROM plants WHERE segment_id = ?', (segment_id,)).fetchone()[0]
+        self._insert_plants(cursor, segment_id, plants, num_existing_plants)
+
+    def row_directions(self):
+        '''Return dictionary of row number -> direction.'''
+        return dict(self.connection.execute('SELECT number, direction FROM rows'))
+
+    def _load_codes(self, code_ids):
+        '''Return dictionary of database id -> code (with other_items) for each code id.'''
+        code_ids = list(set(code_ids))
+        codes = {}
+        select = 'SELECT id, parent_id, {} FROM codes WHERE {} IN ({})'
+        max_ids_per_query = 500 # stay under SQLite's limit on number of query parameters
+        for i in range(0, len(code_ids), max_ids_per_query):
+            ids = code_ids[i:i+max_ids_per_query]
+            placeholders = ', '.join('?' * len(ids))
+            for values in self.connection.execute(select.format(', '.join(item_columns), 'id', placeholders), ids):
+                codes[values[0]] = values_to_item(values[2:])
+            for values in self.connection.execute(select.format(', '.join(item_columns), 'parent_id', placeholders) + ' ORDER BY id', ids):
+                codes[values[1]].other_items.append(values_to_item(values[2:]))
+        return codes
+
+    def _load_plants(self, segment_id):
+        '''Return list of plants (with other_items) in segment.'''
+        query = 'SELECT id, {} FROM plants WHERE segment_id = ? ORDER BY segment_index'.format(', '.join(item_columns))
+        plants = {}
+        plant_ids = []
+        for values in self.connection.execute(query, (segment_id,)):
+            plants[values[0]] = values_to_item(values[1:])
+            plant_ids.append(values[0])
+        if len(plants) > 0:
+            query = 'SELECT parent_id, {} FROM plants WHERE parent_id IN (SELECT id FROM plants WHERE segment_id = ?) ORDER BY id'
+            for values in self.connection.execute(query.format(', '.join(item_columns)), (segment_id,)):
+                plants[values[0]].other_items.append(values_to_item(values[1:]))
+        return [plants[plant_id] for plant_id in plant_ids]
+
+    def segments(self):
+        '''
+        Yield (segment id, row number, segment) for each segment in order of row.  Segments only have their start and end
+        codes loaded (without references) so they can be used to place plants.
+        '''
+        query = 'SELECT id, row_number, start_code_id, end_code_id, expected_num_plants FROM segments ORDER BY row_number, row_index'
+        for segment_id, row_number, start_code_id, end_code_id, expected_num_plants in self.connection.execute(query).fetchall():
+            codes = self._load_codes([start_code_id, end_code_id])
+            segment = PlantGroupSegment(codes[start_code_id], codes[end_code_id])
+            segment.expected_num_plants = expected_num_plants
+            yield segment_id, row_number, segment
+
+    def rows(self):
+        '''Yield each row in order of row number with its segments, codes (including references) and plants loaded.'''
+        groups = {} # database id -> PlantGroup so segments in different rows share group.
+        row_query = 'SELECT number, direction, start_code_id, end_code_id FROM rows ORDER BY number'
+        segment_query = 'SELECT id, group_id, start_code_id, end_code_id, expected_num_plants FROM segments WHERE row_number = ? ORDER BY row_index'
+        for number, direction, start_code_id, end_code_id in self.connection.execute(row_query).fetchall():
+            segment_values = self.connection.execute(segment_query, (number,)).fetchall()
+            code_ids = [start_code_id, end_code_id]
+            for values in segment_values:
+                code_ids += values[2:4]
+            codes = self._load_codes(code_ids)
+
+            row = Row(start_code=codes[start_code_id], end_code=codes[end_code_id], direction=direction)
+            for segment_id, group_id, segment_start_id, segment_end_id, expected_num_plants in segment_values:
+                segment = PlantGroupSegment(codes[segment_start_id], codes[segment_end_id], items=self._load_plants(segment_id))
+                segment.expected_num_plants = expected_num_plants
+                if group_id is not None:
+                    if group_id not in groups:
+                        groups[group_id] = PlantGroup()
+                        groups[group_id].expected_num_plants = self.connection.execute('SELECT expected_num_plants FROM groups WHERE id = ?',
+                                                                                       (group_id,)).fetchone()[0]
+                    groups[group_id].add_segment(segment)
+                row.group_segments.append(segment)
+
+            yield row
+
+    def load_rows(self):
+        '''Return list of all rows in field.'''
+        return list(self.rows())
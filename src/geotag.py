@@ -5,6 +5,10 @@ import os
 import argparse
 import math
 import bisect
+import itertools
+
+# non-default import
+import numpy as np
 
 class GeoReading:
     '''Sensor reading with position/orientation information.'''
@@ -58,16 +62,11 @@ def geotag(reading_time, reading_data, reading_position, reading_orientation, of
 
 def geotag_all_readings_closest(readings, offsets, position_times, positions, orientation_times, orientations):
     
-    geotagged_readings = []
-    for reading in readings:
-        reading_time = reading[0]
-        reading_data = reading[1:]
-        reading_position = closest_position_by_time(reading_time, reading_data, position_times, positions)
-        reading_orientation = closest_orientation_by_time(reading_time, reading_data, orientation_times, orientations)
-        geotagged_reading = geotag(reading_time, reading_data, reading_position, reading_orientation, offsets)
-        geotagged_readings.append(geotagged_reading)
+    reading_times = [reading[0] for reading in readings]
+    reading_positions, reading_orientations = geotag_readings(reading_times, offsets, 'closest', position_times, positions, orientation_times, orientations)
 
-    return geotagged_readings
+    return [GeoReading(reading[0], reading[1:], tuple(position), tuple(orientation))
+            for reading, position, orientation in zip(readings, reading_positions.tolist(), reading_orientations.tolist())]
 
 def closest_position_by_time(reading_time, reading_data, position_times, positions):
     ''''''
@@ -111,27 +110,13 @@ def closest_value(x_value, x_set, y_set, i1=None):
 
 def geotag_all_readings_interpolate(readings, offsets, position_times, positions, orientation_times, orientations):
 
-    x_list = [position[0] for position in positions]
-    y_list = [position[1] for position in positions]
-    z_list = [position[2] for position in positions]
-    positions_by_axes = [x_list, y_list, z_list]
-
     print "Only interpolating position.  Using closest time for orientation."
-    #angle1_list = [orientation[0] for orientation in orientations]
-    #angle2_list = [orientation[1] for orientation in orientations]
-    #angle3_list = [orientation[2] for orientation in orientations]
-    #orientations_by_axes = [angle1_list, angle2_list, angle3_list]
-    
-    geotagged_readings = []
-    for reading in readings:
-        reading_time = reading[0]
-        reading_data = reading[1:]
-        reading_position = interpolate_position(reading_time, reading_data, position_times, positions_by_axes)
-        reading_orientation = closest_orientation_by_time(reading_time, reading_data, orientation_times, orientations)
-        geotagged_reading = geotag(reading_time, reading_data, reading_position, reading_orientation, offsets)
-        geotagged_readings.append(geotagged_reading)
-        
-    return geotagged_readings
+    
+    reading_times = [reading[0] for reading in readings]
+    reading_positions, reading_orientations = geotag_readings(reading_times, offsets, 'interpolate', position_times, positions, orientation_times, orientations)
+
+    return [GeoReading(reading[0], reading[1:], tuple(position), tuple(orientation))
+            for reading, position, orientation in zip(readings, reading_positions.tolist(), reading_orientations.tolist())]
 
 def interpolate_position(reading_time, reading_data, position_times, positions_by_axes):
     ''''''
@@ -188,6 +173,114 @@ def interpolate(x_value, x_set, y_set, i1=None):
     
     return y_set[i1] + slope * (x_value - x_set[i1])
 
+def closest_indexes(x_values, x_set):
+    '''
+    Vectorized version of closest_value() that returns array of indexes into x_set (which must be sorted) of the value closest to
+    each of the x values.  Like closest_value() ties go to the later index and x values outside of x_set get the first/last index.
+    '''
+    x_values = np.asarray(x_values, dtype=np.float64)
+    x_set = np.asarray(x_set, dtype=np.float64)
+    last_index = len(x_set) - 1
+
+    # index of element in x_set right before or equal to each x value
+    i1 = np.searchsorted(x_set, x_values, side='right') - 1
+    i1_clipped = np.clip(i1, 0, last_index)
+    i2 = np.minimum(i1_clipped + 1, last_index)
+
+    i1_mag = np.abs(x_set[i1_clipped] - x_values)
+    i2_mag = np.abs(x_set[i2] - x_values)
+
+    closest = np.where(i1_mag < i2_mag, i1_clipped, i2)
+    closest[i1 < 0] = 0
+    closest[i1 >= last_index] = last_index
+    return closest
+
+def closest_values(x_values, x_set, y_set):
+    '''Vectorized version of closest_value(). Return array where each row is the y corresponding to the closest value in x_set.'''
+    return np.asarray(y_set, dtype=np.float64)[closest_indexes(x_values, x_set)]
+
+def interpolate_values(x_values, x_set, y_set):
+    '''
+    Vectorized version of interpolate() where each row in y_set is interpolated (e.g. x,y,z).  Return array with a row for each
+    x value.  Outside the bounds of x_set the first/last y is used.  x_set must be sorted.
+    '''
+    x_values = np.asarray(x_values, dtype=np.float64)
+    x_set = np.asarray(x_set, dtype=np.float64)
+    y_set = np.asarray(y_set, dtype=np.float64)
+    last_index = len(x_set) - 1
+
+    # index of element in x_set right before or equal to each x value
+    i1 = np.searchsorted(x_set, x_values, side='right') - 1
+    i1_clipped = np.clip(i1, 0, max(last_index - 1, 0))
+    i2 = np.minimum(i1_clipped + 1, last_index)
+
+    x1 = x_set[i1_clipped]
+    y1 = y_set[i1_clipped]
+    # Zero division only happens for values that get replaced below.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (y_set[i2] - y1) / (x_set[i2] - x1)[:, np.newaxis]
+        y_values = y1 + slope * (x_values - x1)[:, np.newaxis]
+
+    # don't need to interpolate if match exactly.
+    exact = x_values == x1
+    y_values[exact] = y1[exact]
+    y_values[i1 < 0] = y_set[0]
+    y_values[i1 >= last_index] = y_set[-1]
+    return y_values
+
+def geotag_positions(positions, orientations, offsets):
+    '''
+    Vectorized version of geotag(). Return array of positions with body offsets rotated by heading (3rd angle) added on.
+    Offsets are either a single (x,y,z) or have a row for each position.
+    '''
+    positions = np.array(positions, dtype=np.float64)
+    headings = np.asarray(orientations, dtype=np.float64)[:, 2]
+    x_body, y_body, z_body = np.asarray(offsets, dtype=np.float64).T
+
+    cos_headings = np.cos(headings)
+    sin_headings = np.sin(headings)
+    positions[:, 0] += x_body * cos_headings - y_body * sin_headings
+    positions[:, 1] += x_body * sin_headings + y_body * cos_headings
+    positions[:, 2] += z_body
+    return positions
+
+def closest_poses_by_time(reading_times, position_times, positions, orientation_times, orientations):
+    '''Return (positions, orientations) arrays with a row for each reading time using the closest position/orientation.'''
+    return closest_values(reading_times, position_times, positions), closest_values(reading_times, orientation_times, orientations)
+
+def closests_pose_by_time(reading_time, reading_data, position_times, positions, orientation_times, orientations):
+    '''Return (position, orientation) closest to single reading time.'''
+    reading_positions, reading_orientations = closest_poses_by_time([reading_time], position_times, positions, orientation_times, orientations)
+    return tuple(reading_positions[0]), tuple(reading_orientations[0])
+
+def interpolated_poses_by_time(reading_times, position_times, positions, orientation_times, orientations):
+    '''Return (positions, orientations) arrays with a row for each reading time. Only position is interpolated, orientation is closest.'''
+    return interpolate_values(reading_times, position_times, positions), closest_values(reading_times, orientation_times, orientations)
+
+def geotag_readings(reading_times, offsets, match_type, position_times, positions, orientation_times, orientations):
+    '''
+    Batch geotag all reading times using match type 'closest' or 'interpolate'.  Return (positions, orientations) arrays with a
+    row for each reading where the positions include the sensor offsets.
+    '''
+    if match_type == 'closest':
+        reading_positions, reading_orientations = closest_poses_by_time(reading_times, position_times, positions, orientation_times, orientations)
+    elif match_type == 'interpolate':
+        reading_positions, reading_orientations = interpolated_poses_by_time(reading_times, position_times, positions, orientation_times, orientations)
+    else:
+        raise ValueError("Invalid match type {}".format(match_type))
+
+    return geotag_positions(reading_positions, reading_orientations, offsets), reading_orientations
+
+def write_geotagged_readings(geo_filepath, reading_times, reading_data, positions, orientations):
+    '''Write line for each reading with time, original data, position and orientation.  Lines are built up and written all at once.'''
+    lines = []
+    for reading_time, data, position, orientation in zip(reading_times, reading_data, positions.tolist(), orientations.tolist()):
+        elements = map(str, itertools.chain(data, position, orientation))
+        lines.append('{:.4f},{},\n'.format(reading_time, ','.join(elements)))
+
+    with open(geo_filepath, 'w') as geo_file:
+        geo_file.write(''.join(lines))
+
 if __name__ == '__main__':
     '''Create geotag file for each sensor reading file.'''
     # Any reference to keyword ID is a short (unique) part of a filename.  
@@ -264,8 +357,9 @@ if __name__ == '__main__':
     positions = sorted(positions, key=lambda p: p[0])
     
     # Split off time from position now that it's sorted.
-    position_times = [p[0] for p in positions]
-    positions = [p[1:] for p in positions]
+    positions = np.array(positions, dtype=np.float64)
+    position_times = positions[:, 0]
+    positions = positions[:, 1:]
            
     # Read in orientation.
     orientations = []
@@ -281,8 +375,9 @@ if __name__ == '__main__':
     orientations = sorted(orientations, key=lambda o: o[0])
     
     # Split off time from orientation now that it's sorted.
-    orientation_times = [o[0] for o in orientations]
-    orientations = [o[1:] for o in orientations]
+    orientations = np.array(orientations, dtype=np.float64)
+    orientation_times = orientations[:, 0]
+    orientations = orientations[:, 1:]
     
     # Read in sensor data and create corresponding geo-referenced file.
     for sensor in sensors:
@@ -293,30 +388,16 @@ if __name__ == '__main__':
         sensor_filepath = os.path.join(input_directory, sensor_filename)
         with open(sensor_filepath) as sensor_file:
             sensor_data = [line.replace(',',' ').split() for line in sensor_file.readlines() if not line.strip().startswith('#')]
-            for data in sensor_data:
-                # Convert time to float.
-                data[0] = float(data[0])
-
-        if match_type == 'closest':
-            geo_readings = geotag_all_readings_closest(sensor_data, offsets, position_times, positions, orientation_times, orientations)
-        elif match_type == 'interpolate':
-            geo_readings = geotag_all_readings_interpolate(sensor_data, offsets, position_times, positions, orientation_times, orientations)
-        else:
-            print "Invalid type {}.".format(match_type)
-            continue
+        reading_times = [float(data[0]) for data in sensor_data]
+        reading_data = [data[1:] for data in sensor_data]
+
+        if match_type == 'interpolate':
+            print "Only interpolating position.  Using closest time for orientation."
+        geo_positions, geo_orientations = geotag_readings(reading_times, offsets, match_type, position_times, positions, orientation_times, orientations)
         
         just_sensor_filename, sensor_extension = os.path.splitext(sensor_filename)
         geo_filename = "{}_geo{}".format(just_sensor_filename, sensor_extension)
         geo_filepath = os.path.join(output_directory, geo_filename)
-        with open(geo_filepath, 'w') as geo_file:
-            for reading in geo_readings:
-                geo_file.write('{:.4f},'.format(reading.time))
-                for element in reading.data:
-                    geo_file.write('{},'.format(element))
-                for element in reading.position:
-                    geo_file.write('{},'.format(element))
-                for element in reading.orientation:
-                    geo_file.write('{},'.format(element))
-                geo_file.write('\n')
+        write_geotagged_readings(geo_filepath, reading_times, reading_data, geo_positions, geo_orientations)
 
         print 'Created output file {}'.format(geo_filepath)
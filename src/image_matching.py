@@ -4,7 +4,98 @@ import sys
 import os
 import argparse
 import time
-import itertools
+from collections import defaultdict
+
+def image_number_from_filename(filename):
+    '''Return image number at the end of file name (e.g. 123 for IMG_0123.CR2).'''
+    just_filename = os.path.splitext(filename)[0]
+    return int(just_filename.split('_')[-1])
+
+def shift_image_number(image_number, number_offset, max_image_number):
+    '''Return image number shifted by offset.  Wraps around like the camera counter which goes from 1 to max image number.'''
+    return (image_number - 1 + number_offset) % max_image_number + 1
+
+def out_of_range_image_numbers(image_numbers, max_image_number):
+    '''Return sorted list of the distinct image numbers that aren't between 1 and max image number.'''
+    return sorted(set(n for n in image_numbers if n < 1 or n > max_image_number))
+
+def rollover_epochs(image_numbers, max_image_number):
+    '''
+    Return list with how many times the camera counter has rolled over (max image number back to 1) for each image number.
+    Image numbers must be in the order the images were taken.  Each number is unwrapped to be as close as possible to the
+    one before it so a few images out of order (e.g. taken in the same second) don't look like a rollover.
+    '''
+    epochs = []
+    last_unwrapped_number = None
+    for image_number in image_numbers:
+        epoch = 0
+        if last_unwrapped_number is not None:
+            epoch = int(round((last_unwrapped_number - image_number) / float(max_image_number)))
+        last_unwrapped_number = image_number + epoch * max_image_number
+        epochs.append(epoch)
+    return epochs
+
+def read_filesystem_images(image_directory, extensions, recursive):
+    '''Return list of (epoch seconds, filename, serial number, image number) for each renamed image with one of the extensions.'''
+    filesystem_images = []
+    for (dirpath, dirnames, filenames) in os.walk(image_directory):
+        for filename in filenames:
+            # Make sure file has correct extension before adding it.
+            just_filename, extension = os.path.splitext(filename)
+            if extension[1:] in extensions:
+                filename_parts = just_filename.split('_')
+                serial_number = filename_parts[1]
+                datetime_original = '-'.join(filename_parts[2:4])
+                datetime_original = time.strptime(datetime_original, "%Y%m%d-%H%M%S")
+                epoch_seconds = time.mktime(datetime_original)
+                image_number = int(filename_parts[-1])
+                filesystem_images.append((epoch_seconds, filename, serial_number, image_number))
+        if not recursive:
+            break # only walk top level directory
+    return filesystem_images
+
+def index_filesystem_images(filesystem_images, max_image_number):
+    '''
+    Return (index, epochs) where index is a dictionary of (serial number, image number, rollover epoch) -> filename and epochs
+    is a dictionary of serial number -> set of rollover epochs.  Filesystem images must be sorted by time.  If there are
+    duplicate keys then the first image is used.
+    '''
+    images_by_serial = defaultdict(list)
+    for epoch_seconds, filename, serial_number, image_number in filesystem_images:
+        images_by_serial[serial_number].append((filename, image_number))
+
+    index = {}
+    epochs_by_serial = {}
+    for serial_number, serial_images in images_by_serial.iteritems():
+        epochs = rollover_epochs([image_number for _, image_number in serial_images], max_image_number)
+        for (filename, image_number), epoch in zip(serial_images, epochs):
+            key = (serial_number, image_number, epoch)
+            if key in index:
+                print "Duplicate image {} for serial {} number {}. Using {}".format(filename, serial_number, image_number, index[key])
+                continue
+            index[key] = filename
+        epochs_by_serial[serial_number] = set(epochs)
+
+    return index, epochs_by_serial
+
+def align_log_to_index(log_keys, index, epochs_by_serial, serial_numbers):
+    '''
+    Return list of (number of matches, serial number, epoch shift) with the epoch shift that matches the most (image number,
+    rollover epoch) log keys to indexed images for each serial number.  Sorted by most matches first.  Log epochs start at 0
+    for the first log line so need to be shifted to line up with the images.
+    '''
+    log_epochs = set(epoch for _, epoch in log_keys)
+    alignments = []
+    for serial_number in serial_numbers:
+        image_epochs = epochs_by_serial.get(serial_number, set())
+        epoch_shifts = sorted(set(image_epoch - log_epoch for image_epoch in image_epochs for log_epoch in log_epochs))
+        best_alignment = (0, serial_number, 0)
+        for epoch_shift in epoch_shifts:
+            num_matches = sum(1 for image_number, epoch in log_keys if (serial_number, image_number, epoch + epoch_shift) in index)
+            if num_matches > best_alignment[0]:
+                best_alignment = (num_matches, serial_number, epoch_shift)
+        alignments.append(best_alignment)
+    return sorted(alignments, key=lambda alignment: -alignment[0])
 
 if __name__ == '__main__':
     '''Match log file up with renamed image files.'''
@@ -15,6 +106,9 @@ if __name__ == '__main__':
     parser.add_argument('image_log', help='File containing time-stamped file names to match to actual images.')
     parser.add_argument('extensions', help='List of file extensions to rename separated by commas. Example "jpg, CR2". Case sensitive.')
     parser.add_argument('-r', dest='recursive', default=default_recursive, help='If true then will recursively search through input directory for images. Default {}'.format(default_recursive))
+    parser.add_argument('-s', dest='serial_number', default='auto', help="Serial number of camera in renamed images that log is for. Default 'auto' (camera that matches the most log lines).")
+    parser.add_argument('-mn', dest='max_image_number', default=9999, help='Largest image number before camera counter rolls over to 1. Default 9999.')
+    parser.add_argument('-no', dest='number_offset', default=0, help='Added to image numbers in log (wrapping around like camera counter) if they are off from the actual images. Default 0.')
     args = parser.parse_args()
     
     # Convert command line arguments
@@ -22,6 +116,13 @@ if __name__ == '__main__':
     image_log = args.image_log
     extensions = args.extensions.split(',')
     recursive = args.recursive.lower() == 'true'
+    serial_number = args.serial_number
+    max_image_number = int(args.max_image_number)
+    number_offset = int(args.number_offset)
+
+    if max_image_number < 1:
+        print "Max image number must be at least 1."
+        sys.exit(1)
     
     if not os.path.exists(image_directory):
         print "Directory does not exist: {}".format(image_directory)
@@ -33,21 +134,7 @@ if __name__ == '__main__':
         print "Creating output directory {}".format(output_directory)
         os.makedirs(output_directory)
         
-    filesystem_images = []
-    for (dirpath, dirnames, filenames) in os.walk(image_directory):
-        for filename in filenames:
-            # Make sure file has correct extension before adding it.
-            just_filename, extension = os.path.splitext(filename)
-            if extension[1:] in extensions:
-                filename_parts = just_filename.split('_')
-                serial_number = filename_parts[1]
-                datetime_original = '-'.join(filename_parts[2:4])
-                datetime_original = time.strptime(datetime_original, "%Y%m%d-%H%M%S")
-                epoch_seconds = time.mktime(datetime_original)
-                image_number = int(filename_parts[-1])
-                filesystem_images.append((epoch_seconds, filename, image_number))
-        if not recursive:
-            break # only walk top level directory
+    filesystem_images = read_filesystem_images(image_directory, extensions, recursive)
         
     if len(filesystem_images) == 0:
         print "No images with extensions {} from directory {} could be read in.".format(extensions, image_directory)
@@ -56,7 +143,25 @@ if __name__ == '__main__':
     print "Read in {} images from image directory.".format(len(filesystem_images))
 
     print "Sorting images from file system by time stamp."
-    filesystem_images = sorted(filesystem_images, key=lambda i: i[0])
+    filesystem_images = sorted(filesystem_images, key=lambda i: (i[0], i[1]))
+
+    # Numbers outside the counter range would throw off rollovers (and could never match after a shift).
+    bad_numbers = out_of_range_image_numbers([image[3] for image in filesystem_images], max_image_number)
+    if len(bad_numbers) > 0:
+        print "Images in image directory have numbers outside of 1 to {}: {}".format(max_image_number, bad_numbers[:10])
+        print "Specify the largest image number with -mn."
+        sys.exit(1)
+
+    # Camera counters roll over so index by rollover epoch (from time order) as well as by image number.
+    image_index, epochs_by_serial = index_filesystem_images(filesystem_images, max_image_number)
+    
+    if serial_number == 'auto':
+        serial_numbers = sorted(epochs_by_serial.keys())
+    elif serial_number in epochs_by_serial:
+        serial_numbers = [serial_number]
+    else:
+        print "No images with serial number {}. Found serial numbers {}".format(serial_number, sorted(epochs_by_serial.keys()))
+        sys.exit(1)
 
     # Read in input file.
     log_contents = []
@@ -76,36 +181,44 @@ if __name__ == '__main__':
     print 'Sorting log contents by time stamp.'
     log_contents = sorted(log_contents, key=lambda c: c[0])
             
-    last_matched_index = 0
+    log_image_numbers = [image_number_from_filename(log_line[1]) for log_line in log_contents]
+    bad_numbers = out_of_range_image_numbers(log_image_numbers, max_image_number)
+    if len(bad_numbers) > 0:
+        print "Image log has numbers outside of 1 to {}: {}".format(max_image_number, bad_numbers[:10])
+        print "Specify the largest image number with -mn."
+        sys.exit(1)
+    if number_offset != 0:
+        log_image_numbers = [shift_image_number(image_number, number_offset, max_image_number) for image_number in log_image_numbers]
+    log_epochs = rollover_epochs(log_image_numbers, max_image_number)
+    log_keys = zip(log_image_numbers, log_epochs)
+
+    alignments = align_log_to_index(log_keys, image_index, epochs_by_serial, serial_numbers)
+    num_matches, serial_number, epoch_shift = alignments[0]
+    if num_matches == 0:
+        print "Couldn't match any log file names to images."
+        sys.exit(1)
+    if len(alignments) > 1 and alignments[1][0] * 2 > num_matches:
+        # Cameras with counters in sync can't be told apart so don't guess.
+        print "Log matches more than one camera: {}".format(', '.join('{} ({} lines)'.format(serial, matches) for matches, serial, _ in alignments))
+        print "Specify serial number with -s."
+        sys.exit(1)
+    print "Log matches camera {} with {} rollovers before first log line.".format(serial_number, epoch_shift)
+
     matched_log_contents = []
-    for line_num, log_line in enumerate(log_contents):
+    for line_num, (log_line, (image_number, epoch)) in enumerate(zip(log_contents, log_keys)):
         
         utc_time = log_line[0]
         original_filename = log_line[1]
-        just_filename, extension = os.path.splitext(original_filename)
+        extension = os.path.splitext(original_filename)[1]
         
-        filename_parts = just_filename.split('_')
-        image_number = int(filename_parts[-1])
-
-        found_match = False
-        current_index = last_matched_index
-        for filesystem_image in itertools.islice(filesystem_images, last_matched_index, None):
-            filesystem_image_number = filesystem_image[2]
-            if image_number == filesystem_image_number:
-                last_matched_index = current_index
-                found_match = True
-                
-                filesystem_imagename = filesystem_image[1]
-                just_filesystem_imagename = os.path.splitext(filesystem_imagename)[0]
-                new_log_filename = just_filesystem_imagename + extension
-                matched_log_contents.append(("{0:.4f}".format(utc_time), new_log_filename))
-                
-                break
-            
-            current_index += 1
-                
-        if not found_match:
+        filesystem_imagename = image_index.get((serial_number, image_number, epoch + epoch_shift))
+        if filesystem_imagename is None:
             print "Couldn't find image on file system corresponding to log file line {} time {} filename {}".format(line_num, utc_time, original_filename)
+            continue
+                
+        just_filesystem_imagename = os.path.splitext(filesystem_imagename)[0]
+        new_log_filename = just_filesystem_imagename + extension
+        matched_log_contents.append(("{0:.4f}".format(utc_time), new_log_filename))
         
     print "Matched {} out of {} log file names to actual image names.".format(len(matched_log_contents), len(log_contents))
         
@@ -3,6 +3,11 @@
 import sys
 import os
 import math
+import time
+import threading
+import Queue
+import atexit
+from collections import defaultdict
 
 # OpenCV imports
 import cv2
@@ -10,6 +15,7 @@ import numpy as np
 
 # Project imports
 from data import *
+from timing import PhaseTimer
 
 class ImageWriter(object):
     '''Facilitate writing output images to an output directory.'''
@@ -18,6 +24,15 @@ class ImageWriter(object):
     
     level = DEBUG
     output_directory = './'
+    
+    # Asynchronous writing. Queue is None when images are written right away.
+    _write_queue = None
+    _writer_threads = []
+    _exit_flush_registered = False
+    
+    # Directories that are known to exist so they don't need to be checked for every image.
+    _created_directories = set()
+    _directory_lock = threading.Lock()
 
     @staticmethod
     def save_debug(filename, image):
@@ -34,12 +49,93 @@ class ImageWriter(object):
             return
 
         filepath = os.path.join(ImageWriter.output_directory, filename)
-        if not os.path.exists(os.path.dirname(filepath)):
-            os.makedirs(os.path.dirname(filepath))
-            
-        cv2.imwrite(filepath, image)
+        ImageWriter.write(filepath, image)
         
         return filepath
+    
+    @staticmethod
+    def write(filepath, image):
+        '''
+        Write image to file path (regardless of level). If writing asynchronously then image is queued to be written and
+        the time spent waiting to queue it is timed separately from the time a writer thread spends writing it.
+        '''
+        if ImageWriter._write_queue is None:
+            with PhaseTimer.phase('ImageWriter.write'):
+                ImageWriter._write_image(filepath, image)
+        else:
+            with PhaseTimer.phase('ImageWriter.enqueue'):
+                # Copy so caller is free to modify image and so a cropped image doesn't keep the entire frame in memory.
+                # Blocks if queue is full so analysis can't get too far ahead of the writer threads.
+                ImageWriter._write_queue.put((filepath, image.copy(), PhaseTimer.image_name))
+    
+    @staticmethod
+    def start_async(num_threads=1, max_queue_size=0):
+        '''
+        Write images from background threads.  Queued images are written before the program exits.  Queue holds copies of
+        (possibly full resolution) images so by default it only holds two per thread, which is enough to keep threads busy.
+        '''
+        if ImageWriter._write_queue is not None:
+            return # already started
+        if max_queue_size <= 0:
+            max_queue_size = 2 * num_threads
+        ImageWriter._write_queue = Queue.Queue(max_queue_size)
+        for _ in range(num_threads):
+            thread = threading.Thread(target=ImageWriter._write_queued_images, args=(ImageWriter._write_queue,))
+            thread.daemon = True
+            thread.start()
+            ImageWriter._writer_threads.append(thread)
+        if not ImageWriter._exit_flush_registered:
+            atexit.register(ImageWriter.stop_async)
+            ImageWriter._exit_flush_registered = True
+    
+    @staticmethod
+    def flush():
+        '''Block until all queued images are written.'''
+        if ImageWriter._write_queue is not None:
+            ImageWriter._write_queue.join()
+    
+    @staticmethod
+    def stop_async():
+        '''Write all queued images, stop background threads and go back to writing images right away.'''
+        write_queue = ImageWriter._write_queue
+        if write_queue is None:
+            return # not started
+        for _ in ImageWriter._writer_threads:
+            write_queue.put(None) # tell thread to stop once it's written everything before this
+        for thread in ImageWriter._writer_threads:
+            thread.join()
+        ImageWriter._write_queue = None
+        ImageWriter._writer_threads = []
+    
+    @staticmethod
+    def _write_queued_images(write_queue):
+        '''Write images from queue until a None entry is received.'''
+        while True:
+            entry = write_queue.get()
+            try:
+                if entry is None:
+                    return
+                filepath, image, image_name = entry
+                start_time = time.time()
+                try:
+                    ImageWriter._write_image(filepath, image)
+                except Exception as e:
+                    print 'Failed to write image {}. Exception {}'.format(filepath, e)
+                PhaseTimer.record(image_name, 'ImageWriter.write', time.time() - start_time)
+            finally:
+                write_queue.task_done()
+    
+    @staticmethod
+    def _write_image(filepath, image):
+        '''Write image making sure its directory exists.'''
+        directory = os.path.dirname(filepath)
+        if directory not in ImageWriter._created_directories:
+            with ImageWriter._directory_lock:
+                if not os.path.exists(directory):
+                    os.makedirs(directory)
+                ImageWriter._created_directories.add(directory)
+            
+        cv2.imwrite(filepath, image)
 
 def postfix_filename(filename, postfix):
     '''Return post-fixed file name with original extension.'''
@@ -236,46 +332,74 @@ def distance_between_rects(rect1, rect2, rotated=True):
     return math.sqrt(dx*dx + dy*dy)
 
 def merge_rectangles(rectangles):
-    '''Return rectangle that contains all rectangles.'''
+    '''Return smallest rotated rectangle that contains all rotated rectangles.'''
+    corners = np.vstack([rectangle_corners(rectangle) for rectangle in rectangles]).astype(np.float32)
+    return cv2.minAreaRect(corners)
+                
+class SpatialGrid(object):
+    '''Buckets values into square cells by XY position so values near a position can be found without checking all of them.'''
+    def __init__(self, cell_size):
+        '''Constructor.  Cell size is in same units as positions and should be at least the largest search distance.'''
+        self.cell_size = float(cell_size)
+        self.cells = defaultdict(list) # (column, row) -> values in cell in order they were added
+        
+    def cell(self, position):
+        '''Return (column, row) of cell containing position.'''
+        return (int(math.floor(position[0] / self.cell_size)), int(math.floor(position[1] / self.cell_size)))
     
-    raise NotImplementedError
+    def add(self, position, value):
+        '''Add value to cell containing position.'''
+        self.cells[self.cell(position)].append(value)
+        
+    def nearby(self, position):
+        '''Return values in the cell containing position and its 8 neighbor cells.  Includes every value within cell size.'''
+        column, row = self.cell(position)
+        values = []
+        for neighbor_column in (column - 1, column, column + 1):
+            for neighbor_row in (row - 1, row, row + 1):
+                values.extend(self.cells.get((neighbor_column, neighbor_row), []))
+        return values
 
-    corners = [rectangle_corners(rectangle) for rectangle in rectangles]
-    x1 = min([c[0] for c in corners])
-    y1 = min([c[1] for c in corners])
-    x2 = max([c[2] for c in corners])
-    y2 = max([c[3] for c in corners])
-    return (x1, y1, x2-x1, y2-y1)
-                
-def cluster_rectangles(rectangles, eps):
-    '''Combine rectangles within eps (pixels) of each other.'''
+class UnionFind(object):
+    '''Disjoint sets of the indexes 0 to size-1.  Each set is represented by its smallest index.'''
+    def __init__(self, size):
+        '''Constructor. Every index starts in its own set.'''
+        self.parents = range(size)
+        
+    def find(self, index):
+        '''Return index representing the set that index belongs to.'''
+        while self.parents[index] != index:
+            self.parents[index] = self.parents[self.parents[index]] # halve path for next time
+            index = self.parents[index]
+        return index
     
-    raise NotImplementedError
+    def union(self, index1, index2):
+        '''Combine sets containing both indexes.'''
+        root1 = self.find(index1)
+        root2 = self.find(index2)
+        if root1 < root2:
+            self.parents[root2] = root1
+        elif root2 < root1:
+            self.parents[root1] = root2
 
-    groupings = [-1] * len(rectangles)
-    for i, rectangle in enumerate(rectangles):
-        if groupings[i] == -1:
-            groupings[i] = i # haven't been claim yet.
-        for j, other_rectangle in enumerate(rectangles):
-            if i == j:
-                continue # same rectangle
-            if distance_between_rects(rectangle, other_rectangle) < eps:
-                if groupings[j] == -1:
-                    groupings[j] = groupings[i] # claim this rectangle
-                else:
-                    # claim all rectangle with group we're running into
-                    groupings = [groupings[i] if x==groupings[j] else x for x in groupings]
-     
-    used_groupings = list(set(groupings))
+def cluster_rectangles(rectangles, eps):
+    '''
+    Combine rotated rectangles whose centers are within eps (pixels) of each other, including through a chain of other
+    rectangles, into the smallest rotated rectangle containing them.  Clusters are in order of their first rectangle.
+    '''
+    centers = [rectangle_center(rectangle) for rectangle in rectangles]
     
-    clustered_rectangles = []
-    for group in used_groupings:
-        # Get all rectangles associated with this group
-        rectangles_in_group = []
-        for i, g in enumerate(groupings):
-            if g == group:
-                rectangles_in_group.append(rectangles[i])
-                
-        clustered_rectangles.append(merge_rectangles(rectangles_in_group))
-   
-    return clustered_rectangles
+    # Only need to compare rectangles in nearby grid cells.
+    grid = SpatialGrid(max(eps, 1e-9))
+    clusters = UnionFind(len(rectangles))
+    for i, center in enumerate(centers):
+        for j in grid.nearby(center):
+            if math.hypot(center[0] - centers[j][0], center[1] - centers[j][1]) < eps:
+                clusters.union(i, j)
+        grid.add(center, i)
+        
+    cluster_indexes = defaultdict(list) # index representing cluster -> indexes of rectangles in cluster
+    for i in range(len(rectangles)):
+        cluster_indexes[clusters.find(i)].append(i)
+    
+    return [merge_rectangles([rectangles[i] for i in cluster_indexes[root]]) for root in sorted(cluster_indexes.keys())]
@@ -3,6 +3,7 @@
 import os
 from operator import itemgetter, attrgetter, methodcaller
 import math
+from collections import defaultdict
 
 # OpenCV imports
 import cv2
@@ -10,7 +11,6 @@ import numpy as np
 
 # Zbar imports
 import zbar
-import Image # Python Imaging Library
 
 # Project imports
 from data import *
@@ -30,9 +30,13 @@ class ItemExtractor:
             pixels = int(2.54 / geo_image.resolution)
             cv2.rectangle(marked_image, (1,1), (pixels, pixels), (255,255,255), 2) 
     
+        # Share color conversions between locators so each one is only done once per image.
+        preprocessed = PreprocessedImage(image)
+    
         field_items = []
         for locator in self.locators:
-            located_items = locator.locate(geo_image, image, marked_image)
+            with PhaseTimer.phase(locator.__class__.__name__ + '.locate'):
+                located_items = locator.locate(geo_image, image, marked_image, preprocessed)
             field_items.extend(located_items)
 
         # Filter out any items that touch the image border since it likely doesn't represent entire item.
@@ -59,24 +63,170 @@ class ItemExtractor:
             
             item.parent_image_filename = geo_image.file_name
             
-            item.position = calculate_position(item, geo_image)
+            with PhaseTimer.phase('calculate_position'):
+                item.position = calculate_position(item, geo_image)
         
         return field_items
         
+class PreprocessedImage(object):
+    '''Conversions of an image that are computed the first time a locator needs them and then shared with the other locators.'''
+    # Kernel used to open (remove noise) and then dilate (connect contours) masks.
+    morphology_kernel = np.ones((5,5), np.uint8)
+    
+    def __init__(self, image):
+        '''Constructor.  Image is in the BGR color space.'''
+        self.image = image
+        self._gray = None
+        self._hsv = None
+        self._color_labels = {} # labeled image for each color profile
+        
+    @property
+    def gray(self):
+        '''Return grayscale image.'''
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        return self._gray
+    
+    @property
+    def hsv(self):
+        '''Return image converted to the HSV color space.'''
+        if self._hsv is None:
+            self._hsv = cv2.cvtColor(self.image, cv2.COLOR_BGR2HSV)
+        return self._hsv
+    
+    def color_labels(self, classifier):
+        '''Return image labeled with the color classes of the classifier.  Locators using the same profile share it.'''
+        if classifier.profile_name not in self._color_labels:
+            self._color_labels[classifier.profile_name] = classifier.classify(self.hsv)
+        return self._color_labels[classifier.profile_name]
+
+# Inclusive HSV (lower, upper) range for each color class.  Select profile by name instead of editing ranges in locators.
+COLOR_PROFILES = {
+    'day': [
+            ('green_plant', (30, 90, 50), (90, 255, 255)), # green colors that correspond to healthy plants.
+            ('dead_green_plant', (10, 35, 60), (90, 255, 255)), # greenish dead plants
+            #('dead_yellow_plant', (10, 50, 125), (40, 255, 255)), # yellowish dead plants
+            ('blue_stick', (90, 90, 50), (130, 255, 255)),
+            ],
+    'night': [
+            ('green_plant', (30, 90, 50), (90, 255, 255)),
+            ('dead_green_plant', (10, 35, 60), (90, 255, 255)),
+            ('blue_stick', (90, 10, 5), (142, 255, 255)), # less saturated and darker at night
+            ],
+    }
+
+class ColorClassifier(object):
+    '''
+    Labels each pixel of an HSV image with every color class it belongs to in a single pass.  Each class is one bit
+    in the label so overlapping ranges (like green and dead green plants) can be pulled out of the same labeled image.
+    '''
+    _profile_classifiers = {} # cache so every locator using a profile gets the same classifier.
+    
+    def __init__(self, profile_name):
+        '''Constructor. Raise ValueError if profile name isn't in COLOR_PROFILES or has more than 8 classes.'''
+        if profile_name not in COLOR_PROFILES:
+            raise ValueError('Unknown color profile {}. Possible choices are {}'.format(profile_name, sorted(COLOR_PROFILES.keys())))
+        color_classes = COLOR_PROFILES[profile_name]
+        if len(color_classes) > 8:
+            raise ValueError('Color profile {} has more than 8 classes.'.format(profile_name))
+        
+        self.profile_name = profile_name
+        self.class_bits = {} # bit for each color class name
+        # Lookup table for each channel (H, S, V) with the bits set for every class whose range includes that value.
+        # Since ranges are boxes then a pixel is in a class if the bit is set in all 3 channel lookups.
+        self.channel_luts = [np.zeros(256, np.uint8) for _ in range(3)]
+        for class_index, (class_name, lower, upper) in enumerate(color_classes):
+            bit = 1 << class_index
+            self.class_bits[class_name] = bit
+            for lut, low, high in zip(self.channel_luts, lower, upper):
+                lut[low:high+1] |= bit
+    
+    @staticmethod
+    def for_profile(profile_name):
+        '''Return shared classifier for profile name.'''
+        if profile_name not in ColorClassifier._profile_classifiers:
+            ColorClassifier._profile_classifiers[profile_name] = ColorClassifier(profile_name)
+        return ColorClassifier._profile_classifiers[profile_name]
+    
+    def classify(self, hsv_image):
+        '''Return single channel image where each pixel has the bits set for all the classes it belongs to.'''
+        h, s, v = cv2.split(hsv_image)
+        labels = cv2.LUT(h, self.channel_luts[0])
+        cv2.bitwise_and(labels, cv2.LUT(s, self.channel_luts[1]), dst=labels)
+        cv2.bitwise_and(labels, cv2.LUT(v, self.channel_luts[2]), dst=labels)
+        return labels
+    
+    def class_mask(self, labels, class_name):
+        '''Return mask (255 in class, 0 otherwise) for class name from labeled image.  Same as cv2.inRange() on class range.'''
+        class_labels = cv2.bitwise_and(labels, self.class_bits[class_name])
+        _, mask = cv2.threshold(class_labels, 0, 255, cv2.THRESH_BINARY)
+        return mask
+        
 class QRLocator:
     '''Locates and decodes QR codes.'''
-    def __init__(self, qr_size):
-        '''Constructor.  QR size is an estimate for searching.'''
+    num_scan_tries = 3 # number of different thresholds in threshold_for_scan_try()
+    
+    def __init__(self, qr_size, min_code_pixels=0, adaptive_order=False, max_scan_attempts=0):
+        '''
+        Constructor.  QR size is an estimate for searching.  If min code pixels is greater than zero then codes are
+        searched for in a downscaled image where a QR code is still at least that many pixels wide, and only the
+        final candidates are mapped back to the full resolution image for decoding.  If adaptive order is true then
+        the (trim, threshold) combinations that have succeeded the most so far are tried first.  If max scan attempts
+        is greater than zero then no more than that many combinations are tried for each candidate.
+        '''
         self.qr_size = qr_size
+        self.min_code_pixels = min_code_pixels
+        self.adaptive_order = adaptive_order
+        self.max_scan_attempts = max_scan_attempts
+        self.scan_attempt_orders = {} # ScanAttemptOrder for each list of trims. Stats last as long as this locator.
+        self._scanner = None # created on first scan so each process (i.e. worker) configures its own.
+    
+    def __getstate__(self):
+        '''Return state to pickle.  Zbar scanner can't be pickled so a new one is created after unpickling.'''
+        state = self.__dict__.copy()
+        state['_scanner'] = None
+        return state
+    
+    @property
+    def scanner(self):
+        '''Return configured Zbar scanner that is reused for every scan.'''
+        if self._scanner is None:
+            self._scanner = zbar.ImageScanner()
+            self._scanner.parse_config('enable')
+        return self._scanner
+    
+    def detection_scale(self, geo_image):
+        '''Return factor (0, 1] that the image can be downscaled by and still have QR codes span min code pixels.'''
+        if self.min_code_pixels <= 0 or geo_image.resolution <= 0:
+            return 1.0 # downscaling disabled
+        # Use the smallest size a code can be and still pass the size filter.
+        min_qr_pixels = (self.qr_size * 0.6) / geo_image.resolution
+        if min_qr_pixels <= self.min_code_pixels:
+            return 1.0 # codes already small so can't reduce image
+        return self.min_code_pixels / min_qr_pixels
     
-    def locate(self, geo_image, image, marked_image):
+    def locate(self, geo_image, image, marked_image, preprocessed=None):
         '''Find QR codes in image and decode them.  Return list of FieldItems representing valid QR codes.''' 
+        if preprocessed is None:
+            preprocessed = PreprocessedImage(image)
+        gray_image = preprocessed.gray
+        
+        # Find candidates in a reduced image if possible since thresholding and finding contours is proportional to image size.
+        scale = self.detection_scale(geo_image)
+        if scale < 1.0:
+            full_image_width = gray_image.shape[1]
+            gray_image = cv2.resize(gray_image, (0,0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            scale = float(gray_image.shape[1]) / full_image_width # actual scale after rounding to whole pixels
+        
         # Threshold grayscaled image to make white QR codes stands out.
-        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
         _, thresh_image = cv2.threshold(gray_image, 160, 255, 0)
         
-        # Open mask (to remove noise) and then dilate it to connect contours.
-        kernel = np.ones((5,5), np.uint8)
+        # Open mask (to remove noise) and then dilate it to connect contours.  Keep kernel the same size relative to the code.
+        if scale < 1.0:
+            kernel_size = max(1, int(round(5 * scale)))
+            kernel = np.ones((kernel_size, kernel_size), np.uint8)
+        else:
+            kernel = preprocessed.morphology_kernel
         mask_open = cv2.morphologyEx(thresh_image, cv2.MORPH_OPEN, kernel)
         thresh_image = cv2.dilate(mask_open, kernel, iterations = 1)
         
@@ -86,6 +236,10 @@ class QRLocator:
         
         # Create bounding box for each contour.
         bounding_rectangles = [cv2.minAreaRect(contour) for contour in contours]
+        
+        if scale < 1.0:
+            # Map rectangles back to full resolution so they can be filtered and decoded like normal.
+            bounding_rectangles = [scale_rotated_rect(rectangle, 1.0 / scale) for rectangle in bounding_rectangles]
 
         # Remove any rectangles that couldn't be a QR item based off specified side length.
         min_qr_size = self.qr_size * 0.6
@@ -124,105 +278,105 @@ class QRLocator:
         return qr_items
     
     def scan_image_different_trims_and_threshs(self, full_image, rotated_rect, trims):
-        '''Scan image using different trims if first try fails. Return list of data found in image.'''
+        '''Scan image using different trims and thresholds if first try fails. Return list of data found in image.'''
+        if self.adaptive_order:
+            if tuple(trims) not in self.scan_attempt_orders:
+                self.scan_attempt_orders[tuple(trims)] = ScanAttemptOrder(trims, QRLocator.num_scan_tries)
+            scan_attempt_order = self.scan_attempt_orders[tuple(trims)]
+            attempts = scan_attempt_order.ordered_attempts()
+        else:
+            scan_attempt_order = None
+            attempts = [(trim, scan_try) for trim in trims for scan_try in range(QRLocator.num_scan_tries)]
+            
+        if self.max_scan_attempts > 0:
+            attempts = attempts[:self.max_scan_attempts]
         
-        for i, trim in enumerate(trims):
-            extracted_image = extract_rotated_image(full_image, rotated_rect, 30, trim=trim)
-            qr_data = self.scan_image_different_threshs(extracted_image)
+        # Only extract each trimmed image once even if its thresholds aren't tried back to back.
+        gray_images = {}
+        for i, (trim, scan_try) in enumerate(attempts):
+            if trim not in gray_images:
+                with PhaseTimer.phase('extract_rotated_image'):
+                    extracted_image = extract_rotated_image(full_image, rotated_rect, 30, trim=trim)
+                gray_images[trim] = cv2.cvtColor(extracted_image, cv2.COLOR_BGR2GRAY)
+            
+            with PhaseTimer.phase('scan_image trim {} try {}'.format(trim, scan_try)):
+                qr_data = self.scan_image(threshold_for_scan_try(gray_images[trim], scan_try))
             if len(qr_data) != 0:
                 if i > 0:
-                    print "Success with trim value {} on try {}".format(trim, i+1)
+                    print "Success with trim value {} and scan try {} on attempt {}".format(trim, scan_try, i+1)
+                if scan_attempt_order is not None:
+                    scan_attempt_order.record_success((trim, scan_try))
                 return qr_data # scan successful
             
         return [] # scans unsuccessful.
     
-    def scan_image_different_threshs(self, cv_image):
-        '''Scan image using multiple thresholds if first try fails. Return list of data found in image.'''
-        scan_try = 0
-        qr_data = []
-        while True:
-            if scan_try == 0:
-                image_to_scan = cv_image # use original image
-            elif scan_try == 1:
-                cv_gray_image = cv2.cvtColor(cv_image, cv2.COLOR_BGR2GRAY)
-                cv_thresh_image = cv2.adaptiveThreshold(cv_gray_image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 101, 2)
-                image_to_scan = cv2.cvtColor(cv_thresh_image, cv2.COLOR_GRAY2BGR)
-            elif scan_try == 2:
-                cv_gray_image = cv2.cvtColor(cv_image, cv2.COLOR_BGR2GRAY)
-                _, cv_thresh_image = cv2.threshold(cv_gray_image, 150, 255, 0)
-                image_to_scan = cv2.cvtColor(cv_thresh_image, cv2.COLOR_GRAY2BGR)
-            else:
-                break # nothing else to try.
-            
-            qr_data = self.scan_image(image_to_scan)
-            
-            if len(qr_data) > 0:
-                break # found code data in image so don't need to keep trying
-            
-            scan_try += 1
-            
-        # Notify if had to use a backup thresholding and had success.
-        if scan_try > 0 and len(qr_data) > 0:
-            print 'success on scan try {0}'.format(scan_try)
-            
-        return qr_data
-    
     def scan_image(self, cv_image):
-        '''Scan image with Zbar and return data found in visual code(s)'''
-        # Create and configure reader.
-        scanner = zbar.ImageScanner()
-        scanner.parse_config('enable')
-         
-        # Convert colored OpenCV image to grayscale PIL image.
-        cv_image = cv2.cvtColor(cv_image, cv2.COLOR_BGR2RGB)
-        pil_image= Image.fromarray(cv_image)
-        pil_image = pil_image.convert('L') # convert to grayscale
+        '''Scan grayscale (or BGR) image with Zbar and return data found in visual code(s)'''
+        if cv_image.ndim == 3:
+            cv_image = cv2.cvtColor(cv_image, cv2.COLOR_BGR2GRAY)
 
-        # Wrap image data. Y800 is grayscale format.
-        width, height = pil_image.size
-        raw = pil_image.tostring()
+        # Wrap image data. Y800 is grayscale format so the pixel buffer can be passed as is.
+        # Zbar only accepts a string so this is the one copy that gets made.
+        height, width = cv_image.shape
+        raw = np.ascontiguousarray(cv_image).tostring()
         image = zbar.Image(width, height, 'Y800', raw)
         
         # Scan image and return results.
-        scanner.scan(image)
+        self.scanner.scan(image)
 
         return [symbol.data for symbol in image]
 
+class ScanAttemptOrder(object):
+    '''Orders (trim, scan try) decode attempts so the ones that have succeeded the most are tried first.'''
+    def __init__(self, trims, num_scan_tries):
+        '''Constructor.  Before any successes attempts are in the same order as trying every scan try for each trim.'''
+        self.attempts = [(trim, scan_try) for trim in trims for scan_try in range(num_scan_tries)]
+        self.successes = defaultdict(int) # number of successful scans for each attempt
+        
+    def ordered_attempts(self):
+        '''Return list of attempts sorted by most successes.  Sort is stable so ties keep their default order.'''
+        return sorted(self.attempts, key=lambda attempt: self.successes[attempt], reverse=True)
+    
+    def record_success(self, attempt):
+        '''Update stats to show specified (trim, scan try) successfully decoded a code.'''
+        self.successes[attempt] += 1
+
+def threshold_for_scan_try(gray_image, scan_try):
+    '''Return grayscale image to scan for the specified try.  First try is the original image and the others are thresholded.'''
+    if scan_try == 0:
+        return gray_image # use original image
+    elif scan_try == 1:
+        return cv2.adaptiveThreshold(gray_image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 101, 2)
+    elif scan_try == 2:
+        _, thresh_image = cv2.threshold(gray_image, 150, 255, 0)
+        return thresh_image
+    raise ValueError('Invalid scan try {}'.format(scan_try))
+
 class PlantLocator:
     '''Locates plants within an image.'''
-    def __init__(self, min_plant_size, max_plant_size):
-        '''Constructor.  Plant size is an estimate for searching.'''
+    def __init__(self, min_plant_size, max_plant_size, color_profile='day'):
+        '''Constructor.  Plant size is an estimate for searching.  Color profile is a key in COLOR_PROFILES.'''
         self.min_plant_size = min_plant_size
         self.max_plant_size = max_plant_size
+        self.color_classifier = ColorClassifier.for_profile(color_profile)
     
-    def locate(self, geo_image, image, marked_image):
+    def locate(self, geo_image, image, marked_image, preprocessed=None):
         '''Find plants in image and return list of Plant instances.''' 
+        if preprocessed is None:
+            preprocessed = PreprocessedImage(image)
+
         # Grayscale original image so we can find edges in it. Default for OpenCV is BGR not RGB.
         #blue_channel, green_channel, red_channel = cv2.split(image)
         
-        # Convert Blue-Green-Red color space to HSV
-        hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-            
-        # Threshold the HSV image to get only green colors that correspond to healthy plants.
-        green_hue = 60
-        lower_green = np.array([green_hue - 30, 90, 50], np.uint8)
-        upper_green = np.array([green_hue + 30, 255, 255], np.uint8)
-        plant_mask = cv2.inRange(hsv_image, lower_green, upper_green)
-        
-        # Now do the same thing for greenish dead plants.
-        lower_dead_green = np.array([10, 35, 60], np.uint8)
-        upper_dead_green = np.array([90, 255, 255], np.uint8)
-        dead_green_plant_mask = cv2.inRange(hsv_image, lower_dead_green, upper_dead_green)
-    
-        # Now do the same thing for yellowish dead plants.
-        #lower_yellow = np.array([10, 50, 125], np.uint8)
-        #upper_yellow = np.array([40, 255, 255], np.uint8)
-        #dead_yellow_plant_mask = cv2.inRange(hsv_image, lower_yellow, upper_yellow)
+        # Label HSV image with color classes then pull out healthy green plants and greenish dead plants.
+        labels = preprocessed.color_labels(self.color_classifier)
+        plant_mask = self.color_classifier.class_mask(labels, 'green_plant')
+        dead_green_plant_mask = self.color_classifier.class_mask(labels, 'dead_green_plant')
         
         filtered_rectangles = []
         for i, mask in enumerate([plant_mask, dead_green_plant_mask]):
             # Open mask (to remove noise) and then dilate it to connect contours.
-            kernel = np.ones((5,5), np.uint8)
+            kernel = preprocessed.morphology_kernel
             mask_open = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
             mask = cv2.dilate(mask_open, kernel, iterations = 1)
             
@@ -272,33 +426,29 @@ class PlantLocator:
 
 class BlueStickLocator:
     '''Locates blue sticks that are inserted into center of plants.'''
-    def __init__(self, stick_length, stick_diameter):
-        '''Constructor.  Sizes should be in centimeters.'''
+    def __init__(self, stick_length, stick_diameter, color_profile='night'):
+        '''Constructor.  Sizes should be in centimeters.  Color profile is a key in COLOR_PROFILES.  Night ranges are the widest.'''
         self.stick_length = stick_length
         self.stick_diameter = stick_diameter
+        self.color_classifier = ColorClassifier.for_profile(color_profile)
     
-    def locate(self, geo_image, image, marked_image):
+    def locate(self, geo_image, image, marked_image, preprocessed=None):
         '''Find sticks in image and return list of FieldItem instances.''' 
+        if preprocessed is None:
+            preprocessed = PreprocessedImage(image)
+
         # Extract out just blue channel from BGR image.
         #blue_channel, _, _ = cv2.split(image)
         #_, mask = cv2.threshold(blue_channel, 160, 255, 0)
         
-        # Convert Blue-Green-Red color space to HSV
-        hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-        
-        lower_blue = np.array([90, 90, 50], np.uint8)
-        upper_blue = np.array([130, 255, 255], np.uint8)
-        mask = cv2.inRange(hsv_image, lower_blue, upper_blue)
-        
-        # Night time testing
-        lower_blue = np.array([90, 10, 5], np.uint8)
-        upper_blue = np.array([142, 255, 255], np.uint8)
-        mask = cv2.inRange(hsv_image, lower_blue, upper_blue)
+        # Label HSV image with color classes then pull out blue colors.
+        labels = preprocessed.color_labels(self.color_classifier)
+        mask = self.color_classifier.class_mask(labels, 'blue_stick')
 
         filtered_rectangles = []
         
         # Open mask (to remove noise) and then dilate it to connect contours.
-        kernel = np.ones((5,5), np.uint8)
+        kernel = preprocessed.morphology_kernel
         mask_open = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
         mask = cv2.dilate(mask_open, kernel, iterations = 1)
         
@@ -361,9 +511,23 @@ def filter_by_size(bounding_rects, resolution, min_size, max_size, enforce_min_o
             
     return filtered_rects
 
+def scale_rotated_rect(rotated_rect, scale):
+    '''Return rotated rectangle found in an image resized by 1/scale in the coordinates of the original image.
+       Contour points lie on pixel centers so each side is one pixel wider than the rectangle found.'''
+    center, dim, theta = rotated_rect
+    width, height = dim
+    scaled_center = ((center[0] + 0.5) * scale - 0.5, (center[1] + 0.5) * scale - 0.5)
+    scaled_dim = ((width + 1) * scale, (height + 1) * scale)
+    return (scaled_center, scaled_dim, theta)
+
 def extract_square_image(image, rectangle, pad, rotated=True):
     '''Return image that corresponds to bounding rectangle with pad added in.
        If rectangle is rotated then it is converted to a normal non-rotated rectangle.'''
+    top, bottom, left, right = padded_image_bounds(image, rectangle, pad, rotated)
+    return image[top:bottom, left:right]
+
+def padded_image_bounds(image, rectangle, pad, rotated=True):
+    '''Return (top, bottom, left, right) pixel bounds of rectangle with pad added in that respect image boundaries.'''
     # reference properties of bounding rectangle
     if rotated:
         rectangle = rotatedToRegularRect(rectangle)
@@ -371,34 +535,45 @@ def extract_square_image(image, rectangle, pad, rotated=True):
     x, y, w, h = rectangle
     
     # image width, height and depth
-    image_h, image_w, image_d = image.shape
+    image_h, image_w = image.shape[:2]
     
     # add in pad to rectangle and respect image boundaries
     top = int(max(1, y - pad))
     bottom = int(min(image_h - 1, y + h + pad))
     left = int(max(1, x - pad))
     right = int(min(image_w - 1, x + w + pad))
-
-    return image[top:bottom, left:right]
+    
+    return top, bottom, left, right
     
 def extract_rotated_image(image, rotated_rect, pad, trim=0):
     '''Return image that corresponds to bounding rectangle with a white pad background added in.'''
     center, dim, theta = rotated_rect
     width, height = dim
     trimmed_rect = (center, (width-trim, height-trim), theta)
-    center, dim, theta = trimmed_rect
-    width, height = dim
 
+    # Only work on the padded region around the rectangle so cost depends on the rectangle size and not the image size.
+    top, bottom, left, right = padded_image_bounds(image, trimmed_rect, pad, rotated=True)
+    extracted_image = image[top:bottom, left:right].copy()
+
+    # Draw rectangle mask in a region that covers both the extracted image and the whole rectangle.  Clipping the
+    # rectangle at the image border (and not at the extracted image border) keeps the mask the same as if it was
+    # drawn on the full image.
     rect_corners = rectangle_corners(trimmed_rect, rotated=True)
     poly = np.array([rect_corners], dtype=np.int32)
-    mask = np.zeros((image.shape[0],image.shape[1],1), np.uint8)
+    image_h, image_w = image.shape[:2]
+    mask_top = max(0, min(top, poly[0,:,1].min()))
+    mask_bottom = min(image_h, max(bottom, poly[0,:,1].max() + 1))
+    mask_left = max(0, min(left, poly[0,:,0].min()))
+    mask_right = min(image_w, max(right, poly[0,:,0].max() + 1))
+    mask = np.zeros((mask_bottom - mask_top, mask_right - mask_left), np.uint8)
+    poly -= np.array([mask_left, mask_top], dtype=np.int32)
     cv2.fillPoly(mask, poly, 255)
-    masked_image = cv2.bitwise_and(image, image, mask=mask)
+    mask = mask[top-mask_top:bottom-mask_top, left-mask_left:right-mask_left]
     
-    inverted_mask = cv2.bitwise_not(mask, mask)
-    masked_image = cv2.bitwise_not(masked_image, masked_image, mask=inverted_mask)
+    # Make everything outside of rectangle white.
+    extracted_image[mask == 0] = 255
     
-    return extract_square_image(masked_image, trimmed_rect, pad, rotated=True)
+    return extracted_image
     
 def calculate_position(item, geo_image):
     '''Return (x,y,z) position of item within geo image.'''
@@ -1,21 +1,97 @@
 #! /usr/bin/env python
 
+import sys
 import time
+import csv
+import itertools
+import pickle
+import multiprocessing
+import multiprocessing.util
+import math
 from math import sqrt
+from collections import defaultdict
 
 # Project imports
 from data import *
 from image_utils import *
 
+def process_geo_images(geo_images, item_extractor, camera_rotation, image_directory, out_directory, use_marked_image, workers=1, writer_threads=0):
+    '''
+    Generate (geo_image, items) for each geo image in the same order as the geo images are passed in.
+    If workers is greater than 1 then images are analyzed by a pool of that many processes.
+    If writer threads is greater than 0 then output images are written by that many background threads in each process.
+    '''
+    if workers <= 1:
+        if writer_threads > 0:
+            ImageWriter.start_async(writer_threads)
+        try:
+            for geo_image in geo_images:
+                yield geo_image, process_geo_image(geo_image, item_extractor, camera_rotation, image_directory, out_directory, use_marked_image)
+        finally:
+            ImageWriter.stop_async()
+        return
+
+    # Each worker process gets its own copy of the extractor and of the ImageWriter class settings.
+    worker_args = (item_extractor, camera_rotation, image_directory, out_directory, use_marked_image, ImageWriter.level, writer_threads,
+                   PhaseTimer.enabled)
+    pool = multiprocessing.Pool(workers, _init_geo_image_worker, worker_args)
+    try:
+        # imap returns results in the order the images were submitted regardless of which worker finishes first.
+        results = pool.imap(_process_geo_image_in_worker, geo_images)
+        for geo_image, (image_size, image_items, timing_records) in itertools.izip(geo_images, results):
+            # Worker analyzed a copy of the geo image so bring back the properties it filled in.
+            geo_image.size = image_size
+            PhaseTimer.add_records(timing_records)
+            yield geo_image, image_items
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+# Settings for process_geo_image() that are set once when each worker process starts up.
+_worker_settings = {}
+
+def _init_geo_image_worker(item_extractor, camera_rotation, image_directory, out_directory, use_marked_image, image_writer_level, writer_threads,
+                           timing_enabled=False):
+    '''Store settings that stay the same for every image analyzed in this worker process.'''
+    _worker_settings['item_extractor'] = item_extractor
+    _worker_settings['camera_rotation'] = camera_rotation
+    _worker_settings['image_directory'] = image_directory
+    _worker_settings['out_directory'] = out_directory
+    _worker_settings['use_marked_image'] = use_marked_image
+    # ImageWriter settings are class attributes so they need to be setup in every process. The output directory
+    # is updated by process_geo_image() for each image so it doesn't get shared between workers.
+    ImageWriter.level = image_writer_level
+    ImageWriter.output_directory = out_directory
+    PhaseTimer.enabled = timing_enabled
+    if writer_threads > 0:
+        ImageWriter.start_async(writer_threads)
+        # Pool workers don't run atexit functions so register a finalizer to write queued images when worker exits.
+        multiprocessing.util.Finalize(None, ImageWriter.stop_async, exitpriority=10)
+
+def _process_geo_image_in_worker(geo_image):
+    '''Return (image size, items, timing records) from analyzing geo image inside of worker process.'''
+    s = _worker_settings
+    image_items = process_geo_image(geo_image, s['item_extractor'], s['camera_rotation'], s['image_directory'], s['out_directory'], s['use_marked_image'])
+    if PhaseTimer.enabled:
+        # Writer threads record how long each write takes so wait for them before sending records back with this image.
+        ImageWriter.flush()
+    return geo_image.size, image_items, PhaseTimer.take_records()
+
 def process_geo_image(geo_image, item_extractor, camera_rotation, image_directory, out_directory, use_marked_image):
-    '''Return list of extracted items sorted in direction of movement.'''
+    '''Return list of extracted items sorted in direction of movement, or None if image couldn't be analyzed.'''
     full_filename = os.path.join(image_directory, geo_image.file_name)
     
-    image = cv2.imread(full_filename, cv2.CV_LOAD_IMAGE_COLOR)
+    PhaseTimer.start_image(geo_image.file_name)
+    
+    with PhaseTimer.phase('cv2.imread'):
+        image = cv2.imread(full_filename, cv2.CV_LOAD_IMAGE_COLOR)
     
     if image is None:
         print 'Cannot open image: {0}'.format(full_filename)
-        return []
+        return None
     
     # Update remaining geo image properties before doing image analysis.  This makes it so we only open image once.
     image_height, image_width, _ = image.shape
@@ -23,7 +99,7 @@ def process_geo_image(geo_image, item_extractor, camera_rotation, image_director
     
     if geo_image.resolution <= 0:
         print "Cannot calculate image resolution. Skipping image."
-        return []
+        return None
     
     # Specify 'image directory' so that if any images associated with current image are saved a directory is created.
     image_out_directory = os.path.join(out_directory, os.path.splitext(geo_image.file_name)[0])
@@ -41,10 +117,111 @@ def process_geo_image(geo_image, item_extractor, camera_rotation, image_director
     if marked_image is not None:
         marked_image_filename = postfix_filename(geo_image.file_name, '_marked')
         marked_image_path = os.path.join(out_directory, marked_image_filename)
-        cv2.imwrite(marked_image_path, marked_image)
+        ImageWriter.write(marked_image_path, marked_image)
         
     return image_items
 
+class ResultManifest(object):
+    '''
+    Append-only file with the items found in each image.  Results are saved as soon as each image is analyzed
+    so that an interrupted run doesn't lose them, and a later run can skip any image whose key hasn't changed.
+    Key is made up of the image file name, size and modification time, its geo data and the analysis settings.
+    '''
+    def __init__(self, filepath, settings, resume=True):
+        '''
+        Constructor. Settings should be anything (comparable and picklable) that changes the results if changed.  If resume
+        is false then earlier results aren't loaded and the file is started over when the first result is recorded.
+        '''
+        self.filepath = filepath
+        self.settings = settings
+        self.results = {} # image filename -> (key, image size, items)
+        self.manifest_file = None # opened on first record
+        self.start_over = not resume
+        if resume:
+            self.load()
+        
+    def load(self):
+        '''
+        Read in all results saved by earlier runs.  If the last result was only partially written then it's removed.  If any
+        image has more than one result (since it was analyzed again) then file is rewritten with just the latest ones.
+        '''
+        if not os.path.exists(self.filepath):
+            return
+        num_records = 0
+        with open(self.filepath, 'r+b') as manifest_file:
+            last_good_offset = 0
+            while True:
+                try:
+                    key, image_size, items = pickle.load(manifest_file)
+                except EOFError:
+                    # Either read every result or last one was cut off before any of its data could be unpickled.
+                    if manifest_file.tell() > last_good_offset:
+                        print "Removing incomplete result from end of manifest {}.".format(self.filepath)
+                        manifest_file.truncate(last_good_offset)
+                    break
+                except Exception as e:
+                    print "Removing incomplete result from end of manifest {}. Exception {}".format(self.filepath, e)
+                    manifest_file.truncate(last_good_offset)
+                    break
+                self.results[key[0]] = (key, image_size, items)
+                last_good_offset = manifest_file.tell()
+                num_records += 1
+                
+        if num_records > len(self.results):
+            print "Compacting manifest {} from {} to {} results.".format(self.filepath, num_records, len(self.results))
+            self.rewrite()
+            
+    def rewrite(self):
+        '''Replace manifest file with one that only has the current results.'''
+        temp_filepath = self.filepath + '.tmp'
+        with open(temp_filepath, 'wb') as temp_file:
+            for result in self.results.itervalues():
+                pickle.dump(result, temp_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_filepath, self.filepath)
+                
+    def image_key(self, geo_image, image_directory):
+        '''Return key identifying everything that affects the items found in geo image.'''
+        stat = os.stat(os.path.join(image_directory, geo_image.file_name))
+        return (geo_image.file_name, stat.st_size, stat.st_mtime, geo_image.image_time, geo_image.position,
+                geo_image.heading_degrees, self.settings)
+        
+    def restore(self, geo_image, image_directory):
+        '''Return true if results for geo image are unchanged since they were recorded and fill in geo image with them.'''
+        if geo_image.file_name not in self.results:
+            return False
+        key, image_size, items = self.results[geo_image.file_name]
+        try:
+            if key != self.image_key(geo_image, image_directory):
+                return False
+        except OSError:
+            return False # image doesn't exist anymore
+        geo_image.size = image_size
+        geo_image.items = items
+        return True
+    
+    def record(self, geo_image, image_directory, items):
+        '''Save items found in geo image to end of manifest.'''
+        try:
+            key = self.image_key(geo_image, image_directory)
+        except OSError:
+            return # image couldn't be opened so there's nothing to save.
+        if self.manifest_file is None:
+            manifest_directory = os.path.dirname(self.filepath)
+            if manifest_directory and not os.path.exists(manifest_directory):
+                os.makedirs(manifest_directory)
+            # Results from earlier runs are thrown out if not resuming so the file doesn't keep growing.
+            self.manifest_file = open(self.filepath, 'wb' if self.start_over else 'ab')
+            self.start_over = False
+        pickle.dump((key, geo_image.size, items), self.manifest_file, pickle.HIGHEST_PROTOCOL)
+        self.manifest_file.flush()
+        self.results[key[0]] = (key, geo_image.size, items)
+        
+    def close(self):
+        '''Close manifest file.'''
+        if self.manifest_file is not None:
+            self.manifest_file.close()
+            self.manifest_file = None
+
 def all_items(geo_images):
     '''Return single list of all items found within geo images.'''
     items = []
@@ -67,15 +244,26 @@ def order_items(items, camera_rotation):
     
 def merge_items(items, max_distance):
     '''Return new list of items with all duplicates removed and instead can be referenced through surviving items.'''
+    # Only need to compare items in nearby grid cells.  Codes with the same name are allowed to be further
+    # apart (see is_same_item) so in that case cells need to be large enough to include them.
+    cell_size = max_distance
+    if any('code' in item.type.lower() for item in items):
+        cell_size = max(max_distance, 30)
+    cell_size = max(cell_size / 100.0, 1e-6) # centimeters to meters
+    grid = SpatialGrid(cell_size)
+    
     unique_items = []
     for item in items:
         matching_item = None
-        for comparision_item in unique_items:
+        # Check in the order unique items were found so the first one stored is the one that's matched.
+        for comparision_index in sorted(grid.nearby(item.position)):
+            comparision_item = unique_items[comparision_index]
             if is_same_item(item, comparision_item, max_distance):
                 matching_item = comparision_item
                 break
         if matching_item is None:
             #print 'No matching item for {} adding to list'.format(item.name)
+            grid.add(item.position, len(unique_items))
             unique_items.append(item)
         else:
             # We've already stored this same item so just have the one we stored reference this one.
@@ -83,25 +271,72 @@ def merge_items(items, max_distance):
             
     return unique_items
 
-def cluster_merged_items(items, cluster_size):
+def merge_codes(codes, max_distance):
+    '''
+    Return same list as merge_items() but first split codes into buckets by type and name since codes can only be
+    the same item if both of those match.  Position matching is then only done within each (usually small) bucket.
+    '''
+    buckets = defaultdict(list)
+    for code in codes:
+        # Non-code items match on position alone so only split those up by type.
+        name_key = code.name if 'code' in code.type.lower() else None
+        buckets[(code.type, name_key)].append(code)
+        
+    unique_codes = []
+    for bucket_codes in buckets.itervalues():
+        unique_codes.extend(merge_items(bucket_codes, max_distance))
+        
+    # Put surviving codes back in the order merge_items() would have found them.
+    original_order = dict((id(code), index) for index, code in enumerate(codes))
+    return sorted(unique_codes, key=lambda code: original_order[id(code)])
+
+class ClusterStats(object):
+    '''Sizes and spread of the position clusters found for a merged item.'''
+    def __init__(self, cluster_sizes, average_position, separations):
+        '''Constructor.  Separations are XY distances from average position for each item reference that was kept.'''
+        self.cluster_sizes = cluster_sizes # size of each cluster, largest first
+        self.average_position = average_position # average position of the item references that were kept
+        self.num_references = len(separations)
+        self.largest_separation = max(separations) if len(separations) > 0 else 0
+        self.sum_separation = sum(separations)
+
+def cluster_item_references(item_refs, cluster_size):
+    '''
+    Return list of single-linkage clusters where item references in the same cluster are connected by references that
+    are within cluster size (meters) of each other.  Each cluster is a list in the same order as item references and
+    clusters are sorted from largest to smallest.  Clusters that are the same size are ordered by their first reference.
+    '''
+    grid = SpatialGrid(max(cluster_size, 1e-9))
+    clusters = UnionFind(len(item_refs))
+    for index, item_ref in enumerate(item_refs):
+        for other_index in grid.nearby(item_ref.position):
+            if position_difference(item_ref.position, item_refs[other_index].position) < cluster_size:
+                clusters.union(index, other_index)
+        grid.add(item_ref.position, index)
     
+    clustered_refs = defaultdict(list)
+    for index, item_ref in enumerate(item_refs):
+        clustered_refs[clusters.find(index)].append(item_ref)
+        
+    # Sort by first reference index (which is the root) and then by size so ties keep that order.
+    sorted_roots = sorted(clustered_refs.keys())
+    return sorted([clustered_refs[root] for root in sorted_roots], key=lambda c: len(c), reverse=True)
+
+def cluster_merged_items(items, cluster_size):
+    '''Return merged items with any item references outside the largest position cluster (in meters) removed.'''
+    clustered_merged_items, _ = cluster_merged_items_with_stats(items, cluster_size)
+    return clustered_merged_items
+
+def cluster_merged_items_with_stats(items, cluster_size):
+    '''
+    Return (merged items, cluster stats) where only item references in the largest position cluster are kept, or if
+    the largest clusters are tied then all references are kept.  Stats list has a ClusterStats for each merged item.
+    '''
     clustered_merged_items = []
+    cluster_stats = []
     for item in items:
-        clusters = []
         item_refs = [item] + item.other_items
-        for item_ref in item_refs:
-            added_to_an_existing_cluster = False
-            for cluster in clusters:
-                for clustered_item in cluster:
-                    if position_difference(item_ref.position, clustered_item.position) < cluster_size:
-                        cluster.append(item_ref)
-                        added_to_an_existing_cluster = True
-                        break
-            if not added_to_an_existing_cluster:
-                # make a new cluster
-                clusters.append([item_ref])
-        
-        clusters = sorted(clusters, key=lambda c: len(c), reverse=True)
+        clusters = cluster_item_references(item_refs, cluster_size)
         
         if len(clusters) == 0:
             continue 
@@ -127,8 +362,15 @@ def cluster_merged_items(items, cluster_size):
             main_item.other_items.append(item)
 
         clustered_merged_items.append(main_item)
+        
+        # Calculate spread of kept references now since they're already together.
+        positions = np.array([item_ref.position for item_ref in kept_cluster], dtype=float)
+        average = tuple(np.mean(positions, axis=0))
+        deltas = positions[:, :2] - average[:2]
+        separations = list(np.sqrt(np.sum(deltas * deltas, axis=1)))
+        cluster_stats.append(ClusterStats([len(c) for c in clusters], average, separations))
 
-    return clustered_merged_items
+    return clustered_merged_items, cluster_stats
 
 def average_position(item):
     
@@ -342,69 +584,109 @@ def lateral_and_projection_distance_2d(p, a, b):
     
     return lateral_error, a_to_b_traveled_mag
  
+def lateral_and_projection_distances_2d(points, starts, ends):
+    '''
+    Vectorized version of lateral_and_projection_distance_2d() for N points against M vectors going from start to end.
+    Return (lateral errors, projection distances) as NxM arrays.  Zero length vectors give NaN for both distances.
+    '''
+    points = np.asarray(points, dtype=float).reshape(-1, 2)[:, np.newaxis, :]
+    starts = np.asarray(starts, dtype=float).reshape(-1, 2)[np.newaxis, :, :]
+    ends = np.asarray(ends, dtype=float).reshape(-1, 2)[np.newaxis, :, :]
+    
+    a_to_b = ends - starts
+    a_to_b_mag = np.sqrt(a_to_b[..., 0]*a_to_b[..., 0] + a_to_b[..., 1]*a_to_b[..., 1])
+    a_to_p = points - starts
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a_to_b_traveled_mag = (a_to_p[..., 0]*a_to_b[..., 0] + a_to_p[..., 1]*a_to_b[..., 1]) / a_to_b_mag
+        a_to_b_traveled_x = a_to_b[..., 0] * a_to_b_traveled_mag / a_to_b_mag
+        a_to_b_traveled_y = a_to_b[..., 1] * a_to_b_traveled_mag / a_to_b_mag
+    
+    dx = a_to_p[..., 0] - a_to_b_traveled_x
+    dy = a_to_p[..., 1] - a_to_b_traveled_y
+    lateral_error_magnitude = np.sqrt(dx * dx + dy * dy)
+    
+    # Use cross product between path and position vector to find correct sign of lateral error.
+    path_cross_position_z = a_to_b[..., 0]*a_to_p[..., 1] - a_to_b[..., 1]*a_to_p[..., 0]
+    lateral_error = np.where(path_cross_position_z < 0.0, -1.0, 1.0) * lateral_error_magnitude
+    
+    zero_length = np.broadcast_to(a_to_b_mag == 0.0, lateral_error.shape)
+    lateral_error[zero_length] = np.nan
+    a_to_b_traveled_mag = np.where(zero_length, np.nan, a_to_b_traveled_mag)
+    
+    return lateral_error, a_to_b_traveled_mag
+
+def nearest_lines_2d(points, starts, ends):
+    '''
+    Return (line indexes, lateral distances, projection distances) with an entry for each point describing the closest
+    vector going from start to end.  Lateral distances are absolute. If no vector is valid for a point then its index is -1
+    and its lateral distance is the max float.  Ties go to the first vector.
+    '''
+    num_points = len(points)
+    if num_points == 0 or len(starts) == 0:
+        return np.full(num_points, -1, dtype=int), np.full(num_points, sys.float_info.max), np.zeros(num_points)
+    
+    lateral_errors, projection_distances = lateral_and_projection_distances_2d(points, starts, ends)
+    lateral_distances = np.abs(lateral_errors)
+    lateral_distances[np.isnan(lateral_distances)] = np.inf
+    
+    point_indexes = np.arange(num_points)
+    line_indexes = np.argmin(lateral_distances, axis=1)
+    min_distances = lateral_distances[point_indexes, line_indexes]
+    min_projections = projection_distances[point_indexes, line_indexes]
+    
+    no_line = np.isinf(min_distances)
+    line_indexes[no_line] = -1
+    min_distances[no_line] = sys.float_info.max
+    min_projections[no_line] = 0
+    
+    return line_indexes, min_distances, min_projections
+
+results_header = ['Type', 'Name', 'Entry', 'Rep', '# In Field', '# In Row', 'Direction', 'Row', 'Range', 'E', 'N', 'U',
+                  'Easting', 'Northing', 'Altitude', 'UTM-Zone', 'Image Name', 'Parent Image Name']
+
 def export_results(items, rows, out_filepath):
     '''Write all items to results file.'''
+    row_directions = dict((row.number, row.direction) for row in rows)
     with open(out_filepath, 'wb') as out_file:
         writer = csv.writer(out_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(results_header)
+        for item in items:
+            writer.writerow(result_fields(item, row_directions))
 
-        # Write out header
-        writer.writerow([
-               'Type',
-               'Name',
-               'Entry',
-               'Rep',
-               '# In Field',
-               '# In Row',
-               'Direction',
-               'Row',
-               'Range',
-               'E',
-               'N',
-               'U',
-               'Easting',
-               'Northing',
-               'Altitude',
-               'UTM-Zone',
-               'Image Name',
-               'Parent Image Name'])
+    return out_filepath
 
-        for item in items:
-            
-            has_group = hasattr(item, 'group') and item.group is not None
-            
-            #entry = item.group.entry if has_group else ''
-            #rep = item.group.rep if has_group else ''
-            entry = item.entry if hasattr(item, 'entry') else ''
-            rep = item.rep if hasattr(item, 'rep') else ''
-
-            # TODO cleanup 
-            if hasattr(item, 'row_number'):
-                item.row = item.row_number
-
-            # Row properties
-            row_direction = 'N/A'
-            row = [row for row in rows if row.number == item.row]
-            if len(row) > 0:
-                row_direction = row[0].direction
-
-            writer.writerow([
-                           item.type,
-                           item.name,
-                           entry,
-                           rep,
-                           item.number_within_field,
-                           item.number_within_row,
-                           row_direction,
-                           item.row,
-                           item.range,
-                           item.field_position[0],
-                           item.field_position[1],
-                           item.field_position[2],
-                           item.position[0],
-                           item.position[1],
-                           item.position[2],
-                           'TODO', # UTM-Zone
-                           os.path.split(item.image_path)[1],
-                           os.path.split(item.parent_image_filename)[1]])
-
-    return out_filepath
\ No newline at end of file
+def result_fields(item, row_directions):
+    '''Return list of fields to write to results file for item. Row directions is a dictionary of row number -> direction.'''
+    has_group = hasattr(item, 'group') and item.group is not None
+    
+    #entry = item.group.entry if has_group else ''
+    #rep = item.group.rep if has_group else ''
+    entry = item.entry if hasattr(item, 'entry') else ''
+    rep = item.rep if hasattr(item, 'rep') else ''
+
+    # TODO cleanup 
+    if hasattr(item, 'row_number'):
+        item.row = item.row_number
+
+    # Row properties
+    row_direction = row_directions.get(item.row, 'N/A')
+
+    return [item.type,
+            item.name,
+            entry,
+            rep,
+            item.number_within_field,
+            item.number_within_row,
+            row_direction,
+            item.row,
+            item.range,
+            item.field_position[0],
+            item.field_position[1],
+            item.field_position[2],
+            item.position[0],
+            item.position[1],
+            item.position[2],
+            'TODO', # UTM-Zone
+            os.path.split(item.image_path)[1],
+            os.path.split(item.parent_image_filename)[1]]
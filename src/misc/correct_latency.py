@@ -4,7 +4,7 @@ import sys
 import os
 import argparse
 import pickle
-import itertools
+import multiprocessing
 import copy
 from collections import Counter
 from collections import defaultdict
@@ -14,7 +14,8 @@ from data import *
 from item_extraction import *
 from image_utils import *
 from item_processing import *
-from geotag import geotag, closests_pose_by_time
+from geotag import closest_poses_by_time, geotag_positions
+from columnar_items import load_stage1_geo_images
 
 class EvalSet(object):
     
@@ -26,6 +27,16 @@ class EvalSet(object):
         self.sse = 0
         self.avg_matching_sep = 0
         self.cost = 0
+        self._averaged_items_by_name = None
+
+    @property
+    def averaged_items_by_name(self):
+        '''Dictionary of name -> averaged items with that name in the same order as averaged items.  Built the first time it's used.'''
+        if self._averaged_items_by_name is None:
+            self._averaged_items_by_name = {}
+            for item in self.averaged_items:
+                self._averaged_items_by_name.setdefault(item.name, []).append(item)
+        return self._averaged_items_by_name
 
 class ImageSet(object):
     
@@ -44,10 +55,10 @@ class PositionItem(object):
         self.name = name
         self.position = position
 
-def find_matching_item_in_eval_list(item, item_list):
-    
+def find_matching_item_in_eval_set(item, eval_set):
+    '''Return first averaged item in eval set with the same name as item and close enough to it. None if there isn't one.'''
     matching_item = None
-    for item_ref in item_list:
+    for item_ref in eval_set.averaged_items_by_name.get(item.name, []):
         if is_same_position_item(item_ref, item, max_position_difference=5000):
             matching_item = item_ref
             break
@@ -103,74 +114,344 @@ def is_same_position_item(item1, item2, max_position_difference):
     
     return position_difference(item1.position, item2.position) < max_position_difference
         
-#def analyze_image_sets(image_sets):
-        
-def analyze_set(image_set, time_offset):
-    
-    eval_set = EvalSet(image_set)
-    eval_set.time_offset = time_offset
-    
-    sum_squared_errors = 0
-    max_sep = 0.0
-    
-    # create copy of geo-images
-    images = copy.deepcopy(image_set.geo_images)
-    
-    set_items = []
-    
-    # change time of all images
-    for image in images:
-        image.image_time += time_offset
-    
-        # TODO: remove hardcoded
-        if "c01" in image.file_name.lower():
-            offsets = (1, 0.4, 0)
-        elif "c04" in image.file_name.lower():
-            offsets = (1, -0.4, 0)
-        else:
-            print "bad"
+def parse_cameras(cameras):
+    '''
+    Return list of (camera ID, (x, y, z) body offsets) from either string or path to file containing string like
+    'c01 1 0.4 0, c04 1 -0.4 0'.  Camera IDs are part of image file names.  Body offsets are in meters from the position
+    reading with positive x forward, y left and z up.  Exits if any camera info is bad.
+    '''
+    if os.path.exists(cameras):
+        # Replace cameras with file contents to mimic passing in on command line.
+        with open(cameras) as cameras_file:
+            cameras = cameras_file.read()
+
+    parsed_cameras = []
+    for camera in cameras.replace('\n', ',').split(','):
+        camera = camera.split()
+        if len(camera) == 0:
+            continue
+        if len(camera) != 4:
+            print 'Bad camera info. Need exactly 4 elements: {}'.format(camera)
             sys.exit(1)
-    
-        reading_position, reading_orientation = closests_pose_by_time(image.image_time, "none", position_times, positions, orientation_times, orientations)
-        geotagged_reading = geotag(image.image_time, "none", reading_position, reading_orientation, offsets)
-        new_position = geotagged_reading.position
-        new_heading = math.degrees(geotagged_reading.orientation[2])
-        image.position = new_position
-        image.heading_degrees = new_heading
-        
+        try:
+            offsets = tuple(float(offset) for offset in camera[1:])
+        except ValueError:
+            print 'Bad camera offsets: {}'.format(camera)
+            sys.exit(1)
+        parsed_cameras.append((camera[0].lower(), offsets))
+
+    return parsed_cameras
+
+def find_camera_offsets(file_name, cameras):
+    '''Return body offsets of first camera whose ID is in image file name. Exits if there isn't one.'''
+    for camera_id, offsets in cameras:
+        if camera_id in file_name.lower():
+            return offsets
+    print "No camera offsets for image {}".format(file_name)
+    sys.exit(1)
+
+def item_pixel_offset(item, geo_image):
+    '''Return (x,y) offset in pixels of item from center of image with positive y being top of image.  Same as calculate_position().'''
+    x, y = rectangle_center(item.bounding_rect)
+    return x - geo_image.size[0]/2, -y + geo_image.size[1]/2
+
+class LatencyEvaluator(object):
+    '''
+    Evaluates how well items in an image set line up when all image times are shifted by a time offset.  Everything that
+    doesn't depend on the offset (item pixel offsets, which items could be merged, etc) is found once so any number of
+    offsets can be evaluated at once using arrays of image poses.
+    '''
+    def __init__(self, image_set, poses, cameras, max_distance=5000):
+        '''
+        Constructor. Poses is (position times, positions, orientation times, orientations), cameras is a list of
+        (camera ID, body offsets) and max distance is in cm.
+        '''
+        self.image_set = image_set
+        self.poses = poses
+        self.max_position_difference = max_distance / 100.0 # cm to meters
+
+        geo_images = image_set.geo_images
+        self.image_times = np.array([image.image_time for image in geo_images], dtype=np.float64)
+        self.image_offsets = np.array([find_camera_offsets(image.file_name, cameras) for image in geo_images], dtype=np.float64).reshape(-1, 3)
+        self.camera_rotations = np.array([image.camera_rotation_degrees for image in geo_images], dtype=np.float64)
+
+        # Flatten out items in image order which is the order they are merged in.
+        self.items = []
+        image_indexes = []
+        for image_index, image in enumerate(geo_images):
+            for item in image.items:
+                self.items.append(item)
+                image_indexes.append(image_index)
+        self.image_indexes = np.array(image_indexes, dtype=np.int64)
+
+        pixel_offsets = np.array([item_pixel_offset(item, geo_images[i]) for item, i in zip(self.items, image_indexes)], dtype=np.float64).reshape(-1, 2)
+        self.pixel_x = pixel_offsets[:, 0]
+        self.pixel_y = pixel_offsets[:, 1]
+        self.meters_per_pixel = np.array([geo_images[i].resolution / 100 for i in image_indexes], dtype=np.float64)
+        self.z_offsets = np.array([-geo_images[i].camera_height / 100 for i in image_indexes], dtype=np.float64)
+
+        # Same as merge_codes() only items with the same type (and name if a code) can be merged.  Within each bucket
+        # store which pairs of items aren't ruled out by coming from the same image (see is_same_item).
+        buckets = defaultdict(list)
+        for index, item in enumerate(self.items):
+            name_key = item.name if 'code' in item.type.lower() else None
+            buckets[(item.type, name_key)].append(index)
+        self.merge_buckets = []
+        for (item_type, _), indexes in buckets.iteritems():
+            if len(indexes) < 2:
+                continue
+            parent_images = np.array([image_indexes[i] for i in indexes])
+            can_merge = parent_images[:, np.newaxis] != parent_images[np.newaxis, :]
+            if item_type.lower() == 'rowcode':
+                can_merge[:] = True
+            self.merge_buckets.append((np.array(indexes), can_merge))
+
+    @property
+    def num_items(self):
+        return len(self.items)
+
+    def image_poses(self, time_offsets):
+        '''Return (positions, headings in degrees) of each image for each time offset with shapes (offsets, images, 3) and (offsets, images).'''
+        num_offsets = len(time_offsets)
+        num_images = len(self.image_times)
+        image_times = self.image_times[np.newaxis, :] + time_offsets[:, np.newaxis]
+        positions, orientations = closest_poses_by_time(image_times.ravel(), *self.poses)
+        positions = geotag_positions(positions, orientations, np.tile(self.image_offsets, (num_offsets, 1)))
+        headings = np.degrees(orientations[:, 2])
+        return positions.reshape(num_offsets, num_images, 3), headings.reshape(num_offsets, num_images)
+
+    def item_positions(self, time_offsets):
+        '''Return (offsets, items, 3) array of item positions.  Vectorized version of calculate_position().'''
+        image_positions, image_headings = self.image_poses(time_offsets)
+        image_positions = image_positions[:, self.image_indexes, :]
+        headings = np.radians(image_headings[:, self.image_indexes] + self.camera_rotations[self.image_indexes] - 90)
+        cos_headings = np.cos(headings)
+        sin_headings = np.sin(headings)
+        positions = np.empty(image_positions.shape)
+        positions[:, :, 0] = image_positions[:, :, 0] + (cos_headings * self.pixel_x - sin_headings * self.pixel_y) * self.meters_per_pixel
+        positions[:, :, 1] = image_positions[:, :, 1] + (sin_headings * self.pixel_x + cos_headings * self.pixel_y) * self.meters_per_pixel
+        positions[:, :, 2] = image_positions[:, :, 2] + self.z_offsets
+        return positions
+
+    def merge_labels(self, positions):
+        '''
+        Return (offsets, items) array where each item is labeled with the index of the item it would be merged into by merge_items()
+        (the first earlier unmerged item within the max distance).  Unmerged items are labeled with their own index.
+        '''
+        num_offsets = positions.shape[0]
+        labels = np.tile(np.arange(self.num_items), (num_offsets, 1))
+        for indexes, can_merge in self.merge_buckets:
+            bucket_positions = positions[:, indexes, :2]
+            is_unmerged = np.ones((num_offsets, len(indexes)), dtype=bool)
+            for j in range(1, len(indexes)):
+                deltas = bucket_positions[:, :j, :] - bucket_positions[:, j:j+1, :]
+                distances = np.sqrt(deltas[:, :, 0] * deltas[:, :, 0] + deltas[:, :, 1] * deltas[:, :, 1])
+                matches = is_unmerged[:, :j] & can_merge[j, :j] & (distances <= self.max_position_difference)
+                has_match = matches.any(axis=1)
+                labels[:, indexes[j]] = np.where(has_match, indexes[matches.argmax(axis=1)], indexes[j])
+                is_unmerged[:, j] = ~has_match
+        return labels
+
+    def evaluate(self, time_offsets):
+        '''Return list of eval sets (one for each time offset) with the sum of squared errors and averaged items filled in.'''
+        time_offsets = np.asarray(time_offsets, dtype=np.float64)
+        num_offsets = len(time_offsets)
+        num_items = self.num_items
+
+        positions = self.item_positions(time_offsets)
+        labels = self.merge_labels(positions)
+
+        # Average each merged item by summing its references with a separate bin for each offset/item pair.
+        bins = (labels + np.arange(num_offsets)[:, np.newaxis] * num_items).ravel()
+        num_bins = num_offsets * num_items
+        counts = np.bincount(bins, minlength=num_bins).astype(np.float64)
+        counts[counts == 0] = 1 # bins of merged items aren't used.
+        averages = np.empty((num_bins, 3))
+        for axis in range(3):
+            averages[:, axis] = np.bincount(bins, weights=positions[:, :, axis].ravel(), minlength=num_bins) / counts
+
+        # Distances are only in XY.  Unmerged items are their own average so don't add anything.
+        errors = positions[:, :, :2].reshape(-1, 2) - averages[bins, :2]
+        squared_errors = (errors[:, 0] * errors[:, 0] + errors[:, 1] * errors[:, 1]).reshape(num_offsets, num_items)
+        sums_squared_errors = squared_errors.sum(axis=1)
+
+        averages = averages.reshape(num_offsets, num_items, 3)
+        is_unmerged = labels == np.arange(num_items)
+        eval_sets = []
+        for k, time_offset in enumerate(time_offsets):
+            eval_set = EvalSet(self.image_set)
+            eval_set.time_offset = time_offset
+            eval_set.sse = sums_squared_errors[k]
+            unmerged_indexes = np.flatnonzero(is_unmerged[k])
+            eval_set.averaged_items = [PositionItem(self.items[i].name, tuple(average)) for i, average in
+                                       zip(unmerged_indexes, averages[k, unmerged_indexes].tolist())]
+            eval_sets.append(eval_set)
+
+        return eval_sets
+
+def offset_geo_images(image_set, time_offset, poses, cameras):
+    '''Return copy of geo images in set with time shifted by offset and positions/headings of images and items updated to match.'''
+    geo_images = copy.deepcopy(image_set.geo_images)
+    image_times = [image.image_time + time_offset for image in geo_images]
+    positions, orientations = closest_poses_by_time(image_times, *poses)
+    positions = geotag_positions(positions, orientations, [find_camera_offsets(image.file_name, cameras) for image in geo_images])
+    for image, image_time, position, orientation in zip(geo_images, image_times, positions.tolist(), orientations.tolist()):
+        image.image_time = image_time
+        image.position = tuple(position)
+        image.heading_degrees = math.degrees(orientation[2])
         for item in image.items:
-            item.other_items = [] # make sure no old references so we don't duplicate them when merging items below.
+            item.other_items = []
             item.position = calculate_position(item, image)
-            set_items.append(item)
-    
-    # Make a copy of all codes before merging so we don't end up with duplicates (merged references and original ones).
-    merged_codes = merge_items(copy.deepcopy(set_items), max_distance=5000)
-    
-    # calculate least squares error sum 
-    for item in merged_codes:
-        item_references = [item] + item.other_items
-        avg_x = np.mean([it.position[0] for it in item_references])
-        avg_y = np.mean([it.position[1] for it in item_references])
-        avg_z = np.mean([it.position[2] for it in item_references])
-    
-        if len(item.other_items) > 0:
-    
-            distances = [position_difference(item_ref.position, (avg_x, avg_y)) for item_ref in item_references]
-            
-            item_combos = itertools.combinations(item_references, 2)
-            for (item1, item2) in item_combos:
-                separation = position_difference(item1.position, item2.position)
-                if separation > max_sep:
-                    max_sep = separation
-            
-            for dist in distances:
-                sum_squared_errors += dist * dist
-                
-        eval_set.averaged_items.append(PositionItem(item.name, (avg_x, avg_y, avg_z)))
-        
-    eval_set.sse = sum_squared_errors
-        
-    return eval_set, images
+
+    return geo_images
+
+def scan_time_offsets(max_offset, time_step):
+    '''
+    Return 0 followed by evenly spaced time offsets from -max offset to +max offset.  0 must be first so that sets without
+    any repeated items only need to be evaluated once.
+    '''
+    time_offsets = np.arange(-max_offset, max_offset + time_step, time_step)
+    # Don't evaluate 0 twice (arange can come close without being exactly 0)
+    return [0.0] + [time_offset for time_offset in time_offsets if abs(time_offset) > time_step * 1e-6]
+
+class TiedSet(object):
+    '''Items in an image set that were also found in another image set.'''
+    def __init__(self, other_set, these_items, other_items):
+        '''Constructor. These items and other items are matching pairs of averaged items from the first eval set of each image set.'''
+        self.other_set_number = other_set.number # don't keep other set so tied set is small enough to send to worker processes.
+        self.these_items = these_items
+        self.other_items = other_items
+        # XY positions of other items in each eval set the other set has now (eval sets, items, 2).
+        # Eval sets added to the other set later (e.g. when refining) aren't included.
+        self.other_positions = np.array([[find_matching_item_in_eval_set(item, other_eval_set).position[:2] for item in other_items]
+                                         for other_eval_set in other_set.eval_sets])
+
+    def matching_separations(self, eval_set):
+        '''Return array with average separation between these items in eval set and the other items in each of the other eval sets.'''
+        these_positions = np.array([find_matching_item_in_eval_set(item, eval_set).position[:2] for item in self.these_items])
+        deltas = self.other_positions - these_positions[np.newaxis, :, :]
+        return np.sqrt(deltas[:, :, 0] * deltas[:, :, 0] + deltas[:, :, 1] * deltas[:, :, 1]).mean(axis=1)
+
+def find_tied_sets(image_set, other_sets):
+    '''Return list of tied sets for each of the other image sets that have items matching the ones in image set.'''
+    original_items = image_set.eval_sets[0].averaged_items
+    tied_sets = []
+    for other_set in other_sets:
+        # Only items with the same name can match.
+        other_items_by_name = other_set.eval_sets[0].averaged_items_by_name
+        # TODO use different function
+        matching_items = [(item, other_item) for item in original_items for other_item in other_items_by_name.get(item.name, [])
+                          if is_same_position_item(item, other_item, max_position_difference=5000)]
+        if len(matching_items) > 0:
+            these_items, other_items = zip(*matching_items)
+            tied_sets.append(TiedSet(other_set, these_items, other_items))
+    return tied_sets
+
+def calculate_cost(eval_set, tied_sets):
+    '''Set and return cost of eval set from separation of items within the set and from matching items in any tied sets.'''
+    avg_sep_within_set = math.sqrt(eval_set.sse)
+    if len(tied_sets) > 0:
+        # Average over every eval set of every tied set.
+        matching_seps = np.concatenate([tied_set.matching_separations(eval_set) for tied_set in tied_sets])
+        eval_set.avg_matching_sep = np.mean(matching_seps)
+        eval_set.cost = avg_sep_within_set * .5 + eval_set.avg_matching_sep * .5
+    else:
+        # Can only rely on separation within a set
+        eval_set.avg_matching_sep = 0
+        eval_set.cost = avg_sep_within_set
+    return eval_set.cost
+
+def golden_section_search(cost_at, low, high, tolerance):
+    '''
+    Return time offset between low and high where cost_at(time offset) is smallest, assuming there's only one minimum
+    between them.  The range is shrunk by the golden ratio each iteration (one new cost) until it's less than tolerance.
+    '''
+    inverse_ratio = (math.sqrt(5) - 1) / 2
+    offset1 = high - inverse_ratio * (high - low)
+    offset2 = low + inverse_ratio * (high - low)
+    cost1 = cost_at(offset1)
+    cost2 = cost_at(offset2)
+    while high - low > tolerance:
+        if cost1 < cost2:
+            high, offset2, cost2 = offset2, offset1, cost1
+            offset1 = high - inverse_ratio * (high - low)
+            cost1 = cost_at(offset1)
+        else:
+            low, offset1, cost1 = offset1, offset2, cost2
+            offset2 = low + inverse_ratio * (high - low)
+            cost2 = cost_at(offset2)
+    return offset1 if cost1 < cost2 else offset2
+
+def refine_minima(evaluator, eval_sets, tied_sets, tolerance, max_minima=3):
+    '''
+    Return new eval sets from searching around the lowest cost local minima of the already costed eval sets (which should
+    come from an even scan of time offsets) until each minimum is found to within tolerance.
+    '''
+    scanned_sets = sorted(eval_sets, key=lambda eval_set: eval_set.time_offset)
+    costs = [eval_set.cost for eval_set in scanned_sets]
+    last = len(scanned_sets) - 1
+    minima = [i for i in range(len(scanned_sets)) if (i == 0 or costs[i] <= costs[i-1]) and (i == last or costs[i] <= costs[i+1])]
+    minima = sorted(minima, key=lambda i: costs[i])[:max_minima]
+
+    new_eval_sets = []
+    def cost_at(time_offset):
+        eval_set = evaluator.evaluate([time_offset])[0]
+        new_eval_sets.append(eval_set)
+        return calculate_cost(eval_set, tied_sets)
+
+    for i in minima:
+        # Actual minimum has to be somewhere between neighboring offsets.
+        golden_section_search(cost_at, scanned_sets[max(i-1, 0)].time_offset, scanned_sets[min(i+1, last)].time_offset, tolerance)
+
+    return new_eval_sets
+
+# Settings that are the same for every image set.  Set once in each worker process (or this process if not using workers).
+_worker_settings = {}
+
+def _init_latency_worker(poses, cameras, scan_offsets, search_mode, tolerance):
+    '''Store settings that stay the same for every image set analyzed in this process.'''
+    _worker_settings['poses'] = poses
+    _worker_settings['cameras'] = cameras
+    _worker_settings['scan_offsets'] = scan_offsets
+    _worker_settings['search_mode'] = search_mode
+    _worker_settings['tolerance'] = tolerance
+
+def _scan_image_set(image_set):
+    '''Return eval sets of image set for each scanned time offset.  Only the 0 offset if no items are in multiple images.'''
+    s = _worker_settings
+    evaluator = LatencyEvaluator(image_set, s['poses'], s['cameras'])
+    eval_sets = evaluator.evaluate(s['scan_offsets'][:1])
+    if eval_sets[0].sse == 0.0:
+        # No duplicate elements so don't keep analyzing.
+        print "No items occuring in multiple images in set {}.".format(image_set.number)
+    else:
+        eval_sets += evaluator.evaluate(s['scan_offsets'][1:])
+    return strip_parent_sets(eval_sets)
+
+def _cost_image_set(set_and_ties):
+    '''Return scanned eval sets (already in image set) with costs filled in followed by any new eval sets from refining.'''
+    image_set, tied_sets = set_and_ties
+    s = _worker_settings
+    for eval_set in image_set.eval_sets:
+        calculate_cost(eval_set, tied_sets)
+
+    eval_sets = list(image_set.eval_sets)
+    if s['search_mode'] == 'refine' and len(eval_sets) > 1:
+        evaluator = LatencyEvaluator(image_set, s['poses'], s['cameras'])
+        eval_sets += refine_minima(evaluator, eval_sets, tied_sets, s['tolerance'])
+    return strip_parent_sets(eval_sets)
+
+def strip_parent_sets(eval_sets):
+    '''Remove parent image set from eval sets so only the results are sent back from worker processes.'''
+    for eval_set in eval_sets:
+        eval_set.parent_image_set = None
+    return eval_sets
+
+def map_image_sets(function, items, pool):
+    '''Return function applied to each item using pool if it's not None.  Results are always in the same order as items.'''
+    if pool is None:
+        return map(function, items)
+    return pool.map(function, items, chunksize=1)
 
 if __name__ == '__main__':
     '''Group codes into rows/groups/segments.'''
@@ -179,6 +460,13 @@ if __name__ == '__main__':
     parser.add_argument('input_directory', help='path containing pickled files from stage 1.')
     parser.add_argument('position_filename', help='.')
     parser.add_argument('orientation_filename', help='.')
+    parser.add_argument('-sm', dest='search_mode', default='grid', help="How to search time offsets. 'grid' evaluates every time step and 'refine' does a coarse scan and then searches around the lowest minima. Default grid.")
+    parser.add_argument('-mo', dest='max_offset', default=7, help='Largest time offset (in either direction) in seconds. Default 7.')
+    parser.add_argument('-ts', dest='time_step', default=0.05, help='Seconds between time offsets in grid mode. Default 0.05.')
+    parser.add_argument('-cs', dest='coarse_step', default=0.5, help='Seconds between time offsets in coarse scan of refine mode. Default 0.5.')
+    parser.add_argument('-tl', dest='tolerance', default=0.005, help='Seconds that minima are refined to in refine mode. Default 0.005.')
+    parser.add_argument('-c', dest='cameras', default='c01 1 0.4 0, c04 1 -0.4 0', help="Camera ID (part of image file names) followed by body offsets from position file.  Positive body offsets are x forward, y left, z up.  Multiple cameras are separated by commas. Can also be path to file.  Default 'c01 1 0.4 0, c04 1 -0.4 0'")
+    parser.add_argument('-j', '--workers', dest='workers', default=1, help='Number of processes to analyze image sets with. Default 1.')
     
     args = parser.parse_args()
     
@@ -186,45 +474,58 @@ if __name__ == '__main__':
     input_directory = args.input_directory
     position_filepath = args.position_filename
     orientation_filepath = args.orientation_filename
+    search_mode = args.search_mode.lower()
+    max_offset = float(args.max_offset)
+    time_step = float(args.time_step)
+    coarse_step = float(args.coarse_step)
+    tolerance = float(args.tolerance)
+    cameras = parse_cameras(args.cameras)
+    workers = int(args.workers)
+
+    search_modes = ['grid', 'refine']
+    if search_mode not in search_modes:
+        print "Error: Search mode {} invalid.  Possible choices are {}".format(search_mode, search_modes)
+        sys.exit(1)
+
+    if max_offset <= 0 or time_step <= 0 or coarse_step <= 0 or tolerance <= 0:
+        print "Error: Max offset, time step, coarse step and tolerance must all be greater than zero."
+        sys.exit(1)
+
+    if len(cameras) == 0:
+        print "Error: Need at least one camera."
+        sys.exit(1)
+
+    if workers < 1:
+        print "Error: Number of workers must be at least 1."
+        sys.exit(1)
 
-    # Unpickle geo images.
-    stage1_filenames = [f for f in os.listdir(input_directory) if os.path.isfile(os.path.join(input_directory, f))]
-    geo_images = []
-    for stage1_filename in stage1_filenames:
-        stage1_filepath = os.path.join(input_directory, stage1_filename)
-        with open(stage1_filepath) as stage1_file:
-            file_geo_images = pickle.load(stage1_file)
-            print 'Loaded {} geo images from {}'.format(len(file_geo_images), stage1_filename)
-            geo_images += file_geo_images
+    # Load geo images with all their items so plants are merged and written out the same as with pickled input.
+    geo_images = load_stage1_geo_images(input_directory)
             
     if len(geo_images) == 0:
-        print "Couldn't load any geo images from {}".format(stage1_filepath)
+        print "Couldn't load any geo images from {}".format(input_directory)
         sys.exit(1)
         
     print "Sorting geo images by time"
     geo_images = sorted(geo_images, key=lambda image: image.image_time)
             
-    cam1_geo_images = [image for image in geo_images if 'c01' in image.file_name.lower()]
-    cam2_geo_images = [image for image in geo_images if 'c04' in image.file_name.lower()]
-            
-    cam1_sets = split_into_sets(cam1_geo_images)
-    cam2_sets = split_into_sets(cam2_geo_images)
-            
-    cam1_sets = [s for s in cam1_sets if len(s) > 15]
-    cam2_sets = [s for s in cam2_sets if len(s) > 15]
+    # Split each camera's images into sets.  Every camera should have a set for each pass.
+    all_camera_sets = []
+    for camera_id, _ in cameras:
+        camera_geo_images = [image for image in geo_images if camera_id in image.file_name.lower()]
+        camera_sets = [s for s in split_into_sets(camera_geo_images) if len(s) > 15]
+        all_camera_sets.append(camera_sets)
     
-    if len(cam1_sets) != len(cam2_sets):
+    if len(set(len(camera_sets) for camera_sets in all_camera_sets)) > 1:
         print "number of camera sets don't match."    
-        print "cam1 len {} cam2 len {}".format(len(cam1_sets), len(cam2_sets))
+        print ", ".join("{} len {}".format(camera_id, len(camera_sets)) for (camera_id, _), camera_sets in zip(cameras, all_camera_sets))
         sys.exit(1)
           
     image_sets = []  
-    for set1, set2 in zip(cam1_sets, cam2_sets):
+    for camera_sets in zip(*all_camera_sets):
         image_set = ImageSet()
         # Remove first and last 3 images from each set since there times might be really off.
-        set1 = set1[3:-3]
-        set2 = set2[3:-3]
-        image_set.geo_images = set1 + set2    
+        image_set.geo_images = [image for camera_set in camera_sets for image in camera_set[3:-3]]
         image_sets.append(image_set)
 
     # Read in positions.
@@ -257,115 +558,73 @@ if __name__ == '__main__':
     orientation_times = [o[0] for o in orientations]
     orientations = [o[1:] for o in orientations]
         
-    start_time = -7
-    end_time = 7
-    time_step = .05
+    # Refine mode only scans coarsely before searching.
+    scan_step = time_step if search_mode == 'grid' else coarse_step
+    scan_offsets = scan_time_offsets(max_offset, scan_step)
         
+    # Convert once so every image set can use them for pose lookups.
+    poses = (np.array(position_times), np.array(positions), np.array(orientation_times), np.array(orientations))
+
     analyzed_sets = []
-    for k, image_set in enumerate(image_sets):
+    for image_set in image_sets:
         
         if len(image_set.geo_images) <= 1:
             print "Really small image set.  Skipping."
             continue
 
         print "{} images in set from {} to {}".format(len(image_set.geo_images), image_set.geo_images[0].file_name, image_set.geo_images[-1].file_name)
+        analyzed_sets.append(image_set)
 
-        # must have 0.0 be first time offset so that sse check below works
-        image_set.time_offsets = [0.0] + list(np.arange(start_time, end_time+time_step, time_step))
+    # Image sets are independent (other than ties which are found in this process) so can be analyzed by a pool of workers.
+    # Results are always in the same order as the sets so the output doesn't depend on the number of workers.
+    worker_args = (poses, cameras, scan_offsets, search_mode, tolerance)
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, _init_latency_worker, worker_args)
+    else:
+        _init_latency_worker(*worker_args)
 
-        for time_offset in image_set.time_offsets:
-            eval_set, _ = analyze_set(image_set, time_offset)
-            image_set.eval_sets.append(eval_set)
-            
-            if eval_set.sse == 0.0:
-                # No duplicate elements so don't keep analyzing.
-                print "No items occuring in multiple images so moving to next set."
-                image_set.time_offsets = [eval_set.time_offset]
-                if eval_set.time_offset != 0.0:
-                    print "Bad first time offset."
-                    sys.exit(1)
-                break
-            
-        analyzed_sets.append(image_set)
+    try:
+        for image_set, eval_sets in zip(analyzed_sets, map_image_sets(_scan_image_set, analyzed_sets, pool)):
+            image_set.eval_sets = eval_sets
         
-    
-    print str(len(analyzed_sets))
+        print str(len(analyzed_sets))
 
-    for image_set in analyzed_sets:
-        print "Image set {} has {} eval sets".format(image_set.number, len(image_set.eval_sets))
-        if len(image_set.eval_sets) == 0:
-            print "Empty eval sets after analyzing. Shouldn't happen."
-            sys.exit(1)     
+        for image_set in analyzed_sets:
+            print "Image set {} has {} eval sets".format(image_set.number, len(image_set.eval_sets))
+            if len(image_set.eval_sets) == 0:
+                print "Empty eval sets after analyzing. Shouldn't happen."
+                sys.exit(1)     
+
+        # Find all ties before refining so every set is compared to the same (scanned) eval sets of the other sets.
+        all_tied_sets = []
+        for i, image_set in enumerate(analyzed_sets):
+            tied_sets = find_tied_sets(image_set, analyzed_sets[:i] + analyzed_sets[i+1:])
+            print "For set {} found {} other sets with matching items.".format(image_set.number, len(tied_sets))
+            for tied_set in tied_sets:
+                print "..comparing to set {} with {} matching items.".format(tied_set.other_set_number, len(tied_set.these_items))
+            all_tied_sets.append(tied_sets)
+
+        for image_set, eval_sets in zip(analyzed_sets, map_image_sets(_cost_image_set, zip(analyzed_sets, all_tied_sets), pool)):
+            image_set.eval_sets = eval_sets
+
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
         
     chosen_sets = []
-    for i, image_set in enumerate(analyzed_sets):
-
-        original_items = image_set.eval_sets[0].averaged_items
-                
-        tied_sets = defaultdict(list)
-
-        for other_set in analyzed_sets[:i] + analyzed_sets[i+1:]:
-            other_items = other_set.eval_sets[0].averaged_items
-            for item in original_items:
-                for other_item in other_items:
-                    # TODO use different function
-                    if is_same_position_item(item, other_item, max_position_difference=5000):
-                        tied_sets[other_set].append((item, other_item, position_difference(item.position, other_item.position)))
-                
-        print "For set {} found {} other sets with matching items.".format(image_set.number, len(tied_sets.keys()))
-                
-        all_seps = []
-        for other_set, all_matching_items in tied_sets.iteritems():
-            these_items, other_items, seps = zip(*all_matching_items)
-            
-            #for i, sep in enumerate(seps):
-            #    print "{} and {} has sep of {}".format(these_items[i].name, other_items[i].name, sep)
-            
-            print "..comparing to set {} with {} matching items.".format(other_set.number, len(all_matching_items))
-            
-            eval_seps = []
-            for eval_set in image_set.eval_sets:
-                # Find item in current eval set corresponding to matched item
-                these_items = [find_matching_item_in_eval_list(item, eval_set.averaged_items) for item in these_items]
-                
-                for other_eval_set in other_set.eval_sets:
-                    group_seps = 0
-                    other_items = [find_matching_item_in_eval_list(item, other_eval_set.averaged_items) for item in other_items]
-                    
-                    for this_item, other_item in zip(these_items, other_items):
-                        diff = position_difference(this_item.position, other_item.position)
-                        #print "{} at {} sec and {} at {} sec has sep of {}".format(this_item.name, eval_set.time_offset, other_item.name, other_eval_set.time_offset, diff)
-                        group_seps += diff
-                        
-                    average_sep_per_code = 0
-                    if len(these_items) > 0:
-                        average_sep_per_code = group_seps / len(these_items)
-
-                    eval_seps.append((eval_set, other_eval_set, average_sep_per_code))
-                    
-            sorted_seps = sorted(eval_seps, key=lambda s: s[2])
-            smallest_sep = sorted_seps[0]
-            all_seps += eval_seps
-            #print "Smallest avg sep is {} at time offsets {} and {}".format(smallest_sep[2], smallest_sep[0].time_offset, smallest_sep[1].time_offset)
-            
+    for image_set in analyzed_sets:
         for eval_set in image_set.eval_sets:
-            
-            avg_sep_within_set = math.sqrt(eval_set.sse)
-            
-            # one matching sep for each tie group.  The value is the smallest for that tie group.
-            matching_seps = [sep for sep in all_seps if (sep[0].time_offset == eval_set.time_offset)]
-            
-            if len(matching_seps) > 0:
-                avg_matching_sep = np.mean([sep[2] for sep in matching_seps])
-                
-                eval_set.avg_matching_sep = avg_matching_sep
-                
-                eval_set.cost = avg_sep_within_set * .5 + avg_matching_sep * .5
-            else:
-                # Can only rely on separation within a set
-                eval_set.avg_matching_sep = 0
-                
-                eval_set.cost = avg_sep_within_set
+            eval_set.parent_image_set = image_set
+
+        image_set.time_offsets = [eval_set.time_offset for eval_set in image_set.eval_sets]
+        print "Evaluated {} time offsets for set {}".format(len(image_set.time_offsets), image_set.number)
             
         sorted_eval_sets = sorted(image_set.eval_sets, key=lambda eval_set: eval_set.cost)
             
@@ -375,16 +634,18 @@ if __name__ == '__main__':
     output_images = []
     for i, chosen_set in enumerate(chosen_sets):
         print "Set {} smallest cost {} at time offset {}. sqrt(sse) {} avg_match_sep {}".format(i, chosen_set.cost, chosen_set.time_offset, math.sqrt(chosen_set.sse), chosen_set.avg_matching_sep)
-        _, geo_images = analyze_set(chosen_set.parent_image_set, chosen_set.time_offset)
+        geo_images = offset_geo_images(chosen_set.parent_image_set, chosen_set.time_offset, poses, cameras)
         output_images += geo_images
     
     for image_set in image_sets:
+        # Cost curve of every time offset that was sampled.
         with open(os.path.join(input_directory, "set_{}.csv".format(image_set.number)), 'w') as image_set_file:
-            for eval_set in image_set.eval_sets:
+            for eval_set in sorted(image_set.eval_sets, key=lambda eval_set: eval_set.time_offset):
                 image_set_file.write("{},{},{},{}\n".format(eval_set.time_offset, eval_set.cost, math.sqrt(eval_set.sse), eval_set.avg_matching_sep))
         
     print "Resorting images by timestamp."
-    output_images = sorted(output_images, key=lambda i: i.image_time)
+    # Images from different cameras can have the same time so also sort by name to always get the same order.
+    output_images = sorted(output_images, key=lambda i: (i.image_time, i.file_name))
         
     #dump_filename = "latencyfixed".format(just_in_filename, in_fileext)
     dump_filepath = os.path.join(input_directory, 'latency_fixed.txt')
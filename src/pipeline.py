@@ -0,0 +1,160 @@
+#! /usr/bin/env python
+
+import sys
+import os
+import argparse
+
+# Project imports
+from data import *
+from item_extraction import *
+from image_utils import *
+from item_processing import *
+import stage1_code_extraction as stage1
+import stage2_grouping as stage2
+import stage3_plant_extraction as stage3
+import stage4_output as stage4
+from field_database import FieldDatabase
+
+def run_pipeline(image_directory, image_geo_file, group_info_file, field_direction, output_directory, qr_size=2.54,
+                 provided_resolution=0, camera_height=0, sensor_width=0, focal_length=0, camera_rotation=0,
+                 updated_items_filepath='none', workers=1, save_intermediate=False, columns_format='none', database_filepath='none',
+                 min_code_pixels=0, adaptive_order=False, max_scan_attempts=0, writer_threads=0):
+    '''
+    Run stages 1 through 4 in this process keeping geo images and rows in memory.  If save intermediate is true then
+    each stage also writes the same output it would if run by itself.  If database filepath is specified then the rows
+    (with the plants placed by stage 3) are saved to it.  Return paths of (all results, averaged results).
+    '''
+    image_filenames = read_images(image_directory, ['tiff', 'tif', 'jpg', 'jpeg', 'png'])
+    if len(image_filenames) == 0:
+        print "No images found in directory: {0}".format(image_directory)
+        sys.exit(1)
+
+    geo_images = parse_geo_file(image_geo_file, provided_resolution, focal_length, camera_rotation, camera_height, sensor_width)
+    geo_images = sorted(geo_images, key=lambda image: image.image_time)
+    geo_images, missing_image_count = verify_geo_images(geo_images, image_filenames)
+    if missing_image_count > 0:
+        print "Warning {0} geo images do not exist and will be skipped.".format(missing_image_count)
+
+    if len(geo_images) == 0:
+        print "No geo images. Exiting."
+        sys.exit(1)
+
+    # Stage 1 - find codes in each image.
+    item_extractor = ItemExtractor([QRLocator(qr_size, min_code_pixels, adaptive_order, max_scan_attempts)])
+    ImageWriter.level = ImageWriter.NORMAL
+    analyzed_images = process_geo_images(geo_images, item_extractor, camera_rotation, image_directory, output_directory,
+                                         use_marked_image=False, workers=workers, writer_threads=writer_threads)
+    for i, (geo_image, image_items) in enumerate(analyzed_images):
+        print "Analyzed image {0} [{1}/{2}]".format(geo_image.file_name, i+1, len(geo_images))
+        if image_items is None:
+            image_items = []
+        geo_image.items = image_items
+
+    if save_intermediate:
+        stage1.output_results(geo_images, output_directory, columns_format)
+
+    # Stage 2 - group codes into rows, segments and groups.
+    grouping_info = stage2.load_grouping_info(group_info_file)
+    rows = stage2.group_codes_into_rows(geo_images, grouping_info, field_direction, updated_items_filepath)
+
+    if save_intermediate:
+        stage2.output_results(rows, geo_images, output_directory)
+
+    # Stage 3 - place expected plants in each segment.
+    rows = stage3.place_plants_in_rows(rows)
+
+    if save_intermediate:
+        stage3.output_results(rows, output_directory)
+
+    if database_filepath != 'none':
+        print "Saving {} rows to field database {}.".format(len(rows), database_filepath)
+        field_database = FieldDatabase(database_filepath)
+        field_database.save_rows(rows)
+        field_database.close()
+
+    # Stage 4 - write out results.
+    row_directions = dict((row.number, row.direction) for row in rows)
+    return stage4.export_field_results(lambda: rows, row_directions, output_directory)
+
+if __name__ == '__main__':
+    '''Run all stages in one process.'''
+
+    parser = argparse.ArgumentParser(description='''Run all stages in one process.''')
+    parser.add_argument('image_directory', help='where to search for images to process')
+    parser.add_argument('image_geo_file', help='file with position/heading data for each image.')
+    parser.add_argument('group_info_file', help='file with group numbers and corresponding number of plants.')
+    parser.add_argument('field_direction', help='Planting angle of entire field.  0 degrees East and increases CCW.')
+    parser.add_argument('output_directory', help='where to write output files')
+    parser.add_argument('-qr', dest='qr_size', default=2.54, help='side length of QR item in centimeters. Must be > 0')
+    parser.add_argument('-rs', dest='resolution', default=0, help='Calculated image resolution in centimeter/pixel.')
+    parser.add_argument('-ch', dest='camera_height', default=0, help='camera height in centimeters. Must be > 0')
+    parser.add_argument('-sw', dest='sensor_width', default=0, help='Sensor width in same units as focal length. Must be > 0')
+    parser.add_argument('-fl', dest='focal_length', default=0, help='effective focal length in same units as sensor width. Must be > 0')
+    parser.add_argument('-cr', dest='camera_rotation', default=0, help='Camera rotation (0, 90, 180, 270).  0 is camera top forward and increases counter-clockwise.' )
+    parser.add_argument('-u', dest='updated_items_filepath', default='none', help='')
+    parser.add_argument('-si', dest='save_intermediate', default='false', help='If true then output of stages 1-3 is saved like when run separately. Default false.')
+    parser.add_argument('-co', dest='columns_format', default='none', help="Format to save stage 1 output in if saving intermediate results ('none', 'npy' or 'npz'). Default none (pickled).")
+    parser.add_argument('-db', dest='database_filepath', default='none', help='If specified (ending in .db) then rows with the plants placed by stage 3 are saved to this field database.')
+    parser.add_argument('-mp', dest='min_code_pixels', default=0, help='If > 0 then codes are searched for in a reduced image where a code is at least this many pixels wide. Default 0 (full resolution).')
+    parser.add_argument('-ao', dest='adaptive_order', default='false', help='If true then the trim/threshold combinations that decode the most codes are tried first. Default false.')
+    parser.add_argument('-ma', dest='max_scan_attempts', default=0, help='If > 0 then the max number of trim/threshold combinations to try for each possible code. Default 0 (try all).')
+    parser.add_argument('-wt', dest='writer_threads', default=0, help='Number of background threads (per worker) that write output images. Default 0 (write during analysis).')
+    parser.add_argument('-j', '--workers', dest='workers', default=1, help='Number of processes to analyze images with. Default 1.')
+
+    args = parser.parse_args()
+
+    # convert command line arguments
+    qr_size = float(args.qr_size)
+    provided_resolution = float(args.resolution)
+    camera_height = float(args.camera_height)
+    sensor_width = float(args.sensor_width)
+    focal_length = float(args.focal_length)
+    camera_rotation = int(args.camera_rotation)
+    field_direction = float(args.field_direction)
+    save_intermediate = args.save_intermediate.lower() == 'true'
+    columns_format = args.columns_format.lower()
+    workers = int(args.workers)
+    min_code_pixels = float(args.min_code_pixels)
+    adaptive_order = args.adaptive_order.lower() == 'true'
+    max_scan_attempts = int(args.max_scan_attempts)
+    writer_threads = int(args.writer_threads)
+
+    if qr_size <= 0:
+        print "\nError: QR code must be greater than zero.\n"
+        parser.print_help()
+        sys.exit(1)
+
+    if provided_resolution <= 0 and (camera_height <= 0 or sensor_width <= 0 or focal_length <= 0):
+        print "\nError: Resolution not provided so camera height, sensor width and focal length must be non-zero."
+        parser.print_help()
+        sys.exit(1)
+
+    possible_camera_rotations = [0, 90, 180, 270]
+    if camera_rotation not in possible_camera_rotations:
+        print "Error: Camera rotation {0} invalid.  Possible choices are {1}".format(camera_rotation, possible_camera_rotations)
+        sys.exit(1)
+
+    possible_columns_formats = ['none', 'npy', 'npz']
+    if columns_format not in possible_columns_formats:
+        print "Error: Columns format {0} invalid.  Possible choices are {1}".format(columns_format, possible_columns_formats)
+        sys.exit(1)
+
+    if workers < 1:
+        print "Error: Number of workers must be at least 1."
+        sys.exit(1)
+
+    if args.database_filepath != 'none' and not stage2.is_field_database_path(args.database_filepath):
+        print "Error: Field database {} must end in .db".format(args.database_filepath)
+        sys.exit(1)
+
+    if not os.path.exists(args.output_directory):
+        os.makedirs(args.output_directory)
+
+    try:
+        run_pipeline(args.image_directory, args.image_geo_file, args.group_info_file, field_direction, args.output_directory,
+                     qr_size, provided_resolution, camera_height, sensor_width, focal_length, camera_rotation,
+                     args.updated_items_filepath, workers, save_intermediate, columns_format, args.database_filepath,
+                     min_code_pixels, adaptive_order, max_scan_attempts, writer_threads)
+    except ValueError as e:
+        print "{}. Exiting".format(e)
+        sys.exit(1)
@@ -16,6 +16,22 @@ from data import *
 from item_extraction import *
 from image_utils import *
 from item_processing import *
+from columnar_items import save_item_columns
+
+def output_results(geo_images, out_directory, columns_format='none'):
+    '''Save geo images (with items) either pickled or as item columns if format is 'npy' or 'npz'. Return path that was written.'''
+    if columns_format == 'none':
+        dump_filename = "stage1_geoimages_{}.txt".format(int(geo_images[0].image_time))
+        dump_filepath = os.path.join(out_directory, dump_filename)
+        print "Serializing {} geo images to {}.".format(len(geo_images), dump_filepath)
+        with open(dump_filepath, 'wb') as dump_file:
+            pickle.dump(geo_images, dump_file)
+        return dump_filepath
+    else:
+        columns_path = os.path.join(out_directory, "stage1_columns_{}".format(int(geo_images[0].image_time)))
+        columns_path = save_item_columns(geo_images, columns_path, compressed=(columns_format == 'npz'))
+        print "Saved {} geo images as item columns to {}.".format(len(geo_images), columns_path)
+        return columns_path
 
 if __name__ == '__main__':
     '''Extract codes from images.'''
@@ -33,6 +49,15 @@ if __name__ == '__main__':
     parser.add_argument('-cr', dest='camera_rotation', default=0, help='Camera rotation (0, 90, 180, 270).  0 is camera top forward and increases counter-clockwise.' )
     parser.add_argument('-debug_start', dest='debug_start', default='__none__', help='Substring in image name to start processing at.')
     parser.add_argument('-debug_stop', dest='debug_stop', default='__none__', help='Substring in image name to stop processing at.')
+    parser.add_argument('-mp', dest='min_code_pixels', default=0, help='If > 0 then codes are searched for in a reduced image where a code is at least this many pixels wide. Default 0 (full resolution).')
+    parser.add_argument('-ao', dest='adaptive_order', default='false', help='If true then the trim/threshold combinations that decode the most codes are tried first. Default false.')
+    parser.add_argument('-ma', dest='max_scan_attempts', default=0, help='If > 0 then the max number of trim/threshold combinations to try for each possible code. Default 0 (try all).')
+    parser.add_argument('-wt', dest='writer_threads', default=0, help='Number of background threads (per worker) that write output images. Default 0 (write during analysis).')
+    parser.add_argument('-resume', dest='resume', default='false', help='If true then images that were analyzed by a previous run with the same settings are skipped. Default false.')
+    parser.add_argument('-co', dest='columns_format', default='none', help="If 'npy' then results are saved as a directory of memory mappable item columns instead of pickled geo images. If 'npz' then columns are compressed into one file. Default none.")
+    parser.add_argument('-tm', dest='timing', default='false', help='If true then time spent reading, locating, decoding and writing is summarized at end of run. Default false.')
+    parser.add_argument('-tc', dest='timing_csv', default='none', help='If specified (and timing is enabled) then time spent in each phase for every image is written to this CSV file.')
+    parser.add_argument('-j', '--workers', dest='workers', default=1, help='Number of processes to analyze images with. Default 1.')
     
     args = parser.parse_args()
     
@@ -49,6 +74,15 @@ if __name__ == '__main__':
     camera_rotation = int(args.camera_rotation)
     debug_start = args.debug_start
     debug_stop = args.debug_stop
+    workers = int(args.workers)
+    writer_threads = int(args.writer_threads)
+    resume = args.resume.lower() == 'true'
+    min_code_pixels = float(args.min_code_pixels)
+    adaptive_order = args.adaptive_order.lower() == 'true'
+    max_scan_attempts = int(args.max_scan_attempts)
+    columns_format = args.columns_format.lower()
+    timing = args.timing.lower() == 'true'
+    timing_csv = args.timing_csv
     
     if qr_size <= 0:
         print "\nError: QR code must be greater than zero.\n"
@@ -65,6 +99,15 @@ if __name__ == '__main__':
         print "Error: Camera rotation {0} invalid.  Possible choices are {1}".format(camera_rotation, possible_camera_rotations)
         sys.exit(1)
         
+    if workers < 1:
+        print "Error: Number of workers must be at least 1."
+        sys.exit(1)
+        
+    possible_columns_formats = ['none', 'npy', 'npz']
+    if columns_format not in possible_columns_formats:
+        print "Error: Columns format {0} invalid.  Possible choices are {1}".format(columns_format, possible_columns_formats)
+        sys.exit(1)
+        
     image_filenames = read_images(image_directory, ['tiff', 'tif', 'jpg', 'jpeg', 'png'])
                         
     if len(image_filenames) == 0:
@@ -100,27 +143,54 @@ if __name__ == '__main__':
     if missing_image_count > 0:
         print "Warning {0} geo images do not exist and will be skipped.".format(missing_image_count)
 
-    qr_locator = QRLocator(qr_size)
+    qr_locator = QRLocator(qr_size, min_code_pixels, adaptive_order, max_scan_attempts)
     item_extractor = ItemExtractor([qr_locator])
     
     ImageWriter.level = ImageWriter.NORMAL
+    PhaseTimer.enabled = timing
+
+    # Save results for each image as it's analyzed so they can be reused if run is interrupted or rerun.
+    settings = (qr_size, provided_resolution, camera_height, sensor_width, focal_length, camera_rotation,
+                use_marked_image, min_code_pixels, adaptive_order, max_scan_attempts)
+    manifest_filepath = os.path.join(out_directory, 'stage1_checkpoint', 'stage1_manifest.pkl')
+    manifest = ResultManifest(manifest_filepath, settings, resume)
+    
+    images_to_analyze = geo_images
+    if resume:
+        images_to_analyze = [geo_image for geo_image in geo_images if not manifest.restore(geo_image, image_directory)]
+        num_restored_images = len(geo_images) - len(images_to_analyze)
+        print "Restored {} images that have results saved in {}".format(num_restored_images, manifest_filepath)
+
+    if workers > 1:
+        print "Analyzing images with {} worker processes.".format(workers)
 
     # Extract all QR items from images.
-    for i, geo_image in enumerate(geo_images):
-        print "Analyzing image {0} [{1}/{2}]".format(geo_image.file_name, i+1, len(geo_images))
-        geo_image.items = process_geo_image(geo_image, item_extractor, camera_rotation, image_directory, out_directory, use_marked_image)
+    analyzed_images = process_geo_images(images_to_analyze, item_extractor, camera_rotation, image_directory, out_directory, use_marked_image, workers, writer_threads)
+    for i, (geo_image, image_items) in enumerate(analyzed_images):
+        print "Analyzed image {0} [{1}/{2}]".format(geo_image.file_name, i+1, len(images_to_analyze))
+        if image_items is None:
+            geo_image.items = [] # don't record so image is analyzed again on next run.
+            continue
+        geo_image.items = image_items
+        manifest.record(geo_image, image_directory, image_items)
         for code in geo_image.items:
             print "Found code: {}".format(code.name)
+            
+    manifest.close()
+    
+    if timing:
+        print "\nTime spent analyzing {} images:".format(len(images_to_analyze))
+        for line in PhaseTimer.summary():
+            print line
+        if timing_csv != 'none':
+            PhaseTimer.write_csv(timing_csv)
+            print "Wrote time spent on each image to {}".format(timing_csv)
   
-    dump_filename = "stage1_geoimages_{}.txt".format(int(geo_images[0].image_time))
-    dump_filepath = os.path.join(out_directory, dump_filename)
-    print "Serializing {} geo images to {}.".format(len(geo_images), dump_filepath)
-    with open(dump_filepath, 'wb') as dump_file:
-        pickle.dump(geo_images, dump_file)
+    output_results(geo_images, out_directory, columns_format)
 
     # Display QR code stats for user.
     all_codes = all_items(geo_images)
-    merged_codes = merge_items(all_codes, max_distance=500)
+    merged_codes = merge_codes(all_codes, max_distance=500)
     if len(merged_codes) == 0:
         print "No codes found."
     else:
@@ -14,6 +14,8 @@ from data import *
 from item_extraction import *
 from image_utils import *
 from item_processing import *
+from columnar_items import load_stage1_geo_images
+from field_database import FieldDatabase, is_field_database_path
 
 def make_grouping_info_unique(grouping_info):
     # Warn if there are duplicate groups in info file.
@@ -33,18 +35,11 @@ def make_grouping_info_unique(grouping_info):
             unique_grouping_info_list.append(infos[0])
         else: # just one unique info listing
             unique_grouping_info_list.append(infos[0])
-    return unique_grouping_info_list
+    return GroupingInfo(unique_grouping_info_list)
     
 def unpickle_geo_images(input_directory):
-    stage1_filenames = [f for f in os.listdir(input_directory) if os.path.isfile(os.path.join(input_directory, f))]
-    geo_images = []
-    for stage1_filename in stage1_filenames:
-        stage1_filepath = os.path.join(input_directory, stage1_filename)
-        with open(stage1_filepath) as stage1_file:
-            file_geo_images = pickle.load(stage1_file)
-            print 'Loaded {} geo images from {}'.format(len(file_geo_images), stage1_filename)
-            geo_images += file_geo_images
-    return geo_images
+    # Only codes are grouped so don't load other items if stage 1 saved columns.
+    return load_stage1_geo_images(input_directory, codes_only=True)
 
 def all_codes_from_geo_images(geo_images):
     all_codes = []
@@ -114,7 +109,7 @@ def add_in_none_codes(updated_none_items, grouping_info):
 
     # codes that were missing from expected grouping file
     for none_item in updated_none_items:
-        # TODO make grouping info a class. This needs to stay in sync with actual parsing of grouping file.
+        # This needs to stay in sync with actual parsing of grouping file.
         order_entered = -1 # don't know it wasn't in file
         qr_id = none_item[0] # same as name
         flag = none_item[3]
@@ -126,7 +121,7 @@ def add_in_none_codes(updated_none_items, grouping_info):
             estimated_num_plants = actual_num_plants
         except ValueError:
             estimated_num_plants = -1
-        grouping_info.append((qr_id, entry, rep, estimated_num_plants, order_entered))
+        grouping_info.add((qr_id, entry, rep, estimated_num_plants, order_entered))
 
 def add_in_missing_codes(updated_missing_items, all_codes):
 
@@ -147,11 +142,18 @@ def add_in_missing_codes(updated_missing_items, all_codes):
             group_code.rep = missing_flag[-1].upper()
             #all_codes.append(group_code)
             
-def check_code_precision(merged_codes):
+def check_code_precision(merged_codes, cluster_stats=None):
     # Sanity check that multiple references of the same code are all close to each other.
     largest_separation = 0
     sum_separation = 0
     sum_separation_count = 0
+    if cluster_stats is not None:
+        # Separations were already found when clustering.
+        for stats in cluster_stats:
+            largest_separation = max(largest_separation, stats.largest_separation)
+            sum_separation += stats.sum_separation
+            sum_separation_count += stats.num_references
+        merged_codes = [] # don't need to recalculate
     for code in merged_codes:
         avg_position = average_position(code)
         code_refs = [code] + code.other_items
@@ -185,11 +187,11 @@ def warn_about_missing_and_extra_codes(missing_code_ids, extra_code_ids):
         for id in extra_code_ids:
             print "Extra ID: {}".format(id)
 
-def associate_ids_to_entry_rep(group_codes):
+def associate_ids_to_entry_rep(group_codes, grouping_info):
     # Update group codes with entry x rep
     num_matched_ids_to_info = 0
     for group_code in group_codes:
-        matching_info = [info for info in grouping_info if info[0] == group_code.name]
+        matching_info = grouping_info.matching_id(group_code.name)
         if len(matching_info) == 0:
             continue
         matching_info = matching_info[0]
@@ -218,7 +220,7 @@ def display_row_info(grouped_row_codes):
     else:
         print "No skipped row numbers."
 
-def create_rows(grouped_row_codes):
+def create_rows(grouped_row_codes, field_direction):
     rows = []
     for row_number, codes in grouped_row_codes.iteritems():
         if len(codes) == 1:
@@ -284,34 +286,30 @@ def assign_rows_a_direction(rows, up_row_nums, back_row_nums):
             print "Row number {} doesn't have a defined up/back direction".format(row.number)
             sys.exit(1)
 
-def calculate_projection_to_nearest_row(group_codes, rows):
+def calculate_projection_to_nearest_row(group_codes, rows, max_row_distance=3):
+    '''Assign each code to the nearest row (within max distance in meters) and return list of (code, projection distance).'''
+    code_positions = [code.position[:2] for code in group_codes]
+    row_starts = [row.start_code.position[:2] for row in rows]
+    row_ends = [row.end_code.position[:2] for row in rows]
+    
+    # Projection is along closest row (in meters) from bottom of field to top.
+    row_indexes, min_distances, projection_distances = nearest_lines_2d(code_positions, row_starts, row_ends)
+    
     codes_with_projections = []
-    for code in group_codes:
-        
-        min_distance = sys.float_info.max
-        projection_distance = 0 # projection along closest row (in meters) from bottom of field to top.
-        closest_row = None
-        for row in rows:
-            start_pos = row.start_code.position
-            end_pos = row.end_code.position
-            distance_to_code, row_projection_distance = lateral_and_projection_distance_2d(code.position, start_pos, end_pos)
-            distance_to_code = abs(distance_to_code)
-            if distance_to_code < min_distance:
-                min_distance = distance_to_code
-                projection_distance = row_projection_distance
-                closest_row = row
-        if closest_row is not None and min_distance < 3: # TODO remove hard-coded value
+    for code, row_index, min_distance, projection_distance in zip(group_codes, row_indexes, min_distances, projection_distances):
+        if row_index >= 0 and min_distance < max_row_distance:
+            closest_row = rows[row_index]
             code.row = closest_row.number
             if closest_row.number == 0:
                 print "closest row has 0 number"
-            codes_with_projections.append((code, projection_distance))
+            codes_with_projections.append((code, float(projection_distance)))
         else:
             code.row = -1
             print "Couldn't find a row for code {}. Closest row is {} meters away.".format(code.name, min_distance)
             
     return codes_with_projections
 
-def create_group_segments(codes_with_projections):
+def create_group_segments(codes_with_projections, rows):
     
     group_segments = []
     for row in rows:
@@ -354,7 +352,7 @@ def organize_group_segments(group_segments):
     
     return start_segments, middle_segments, end_segments, single_segments
 
-def complete_groups(end_segments, single_segments):
+def complete_groups(end_segments, single_segments, field_passes):
     
     groups = []
     for end_segment in end_segments[:]: 
@@ -455,14 +453,14 @@ def order_and_number_items_by_row(rows):
             
     return ordered_items
 
-def warn_about_bad_group_lengths(groups):
+def warn_about_bad_group_lengths(groups, grouping_info):
 
     num_good_lengths = 0 # how many groups have a close expected length
     num_bad_lengths = 0 # how many groups don't have a close expected length
     num_no_info = 0 # how many groups don'have any expected lengths
     num_too_much_info = 0 # how many groups have more than 1 expected lengths
     for group in groups:
-        info = [i for i in grouping_info if i[0] == group.id]
+        info = grouping_info.matching_id(group.id)
         if len(info) == 0:
             #print "no expected info for group found in field {}".format(group.id)
             num_no_info += 1
@@ -506,10 +504,14 @@ def warn_about_bad_group_lengths(groups):
     print "Found {} groups with close expected lengths and {} groups that aren't close.".format(num_good_lengths, num_bad_lengths)
     print "{} groups with no expected number of plants and {} with too many expected number number of plants.".format(num_no_info, num_too_much_info)
 
-def display_missing_codes_neighbors(missing_code_ids):
+def display_missing_codes_neighbors(missing_code_ids, grouping_info, group_codes):
+
+    group_codes_by_name = {}
+    for code in group_codes:
+        group_codes_by_name.setdefault(code.name, code) # first code with name is the one that's reported
 
     for missing_id in missing_code_ids:
-        missing_id_info = [info for info in grouping_info if info[0] == missing_id][0]
+        missing_id_info = grouping_info.matching_id(missing_id)[0]
         
         order_entered = missing_id_info[4]
         
@@ -518,7 +520,7 @@ def display_missing_codes_neighbors(missing_code_ids):
         neighbor_info = [] 
         neighbors_order_entered = range(order_entered - 3, order_entered + 4, 1)
         for neighbor_order_entered in neighbors_order_entered:
-            close_neighbor_info = [info for info in grouping_info if info[4] == neighbor_order_entered]
+            close_neighbor_info = grouping_info.matching_order_entered(neighbor_order_entered)
             neighbor_info.append(close_neighbor_info)
             '''
             if missing_id == '1525':
@@ -534,11 +536,10 @@ def display_missing_codes_neighbors(missing_code_ids):
                 print "\tNo neighbor in document."
             else:
                 neighbor = neighbor[0]
-                neighbor_code = [code for code in group_codes if code.name == neighbor[0]]
-                if len(neighbor_code) == 0:
+                neighbor_code = group_codes_by_name.get(neighbor[0])
+                if neighbor_code is None:
                     print "\tNeighbor code with id {} not found in field.".format(neighbor[0])
                 else:
-                    neighbor_code = neighbor_code[0]
                     print "\tHas neighbor code {} ({}{}) that is {} code from {} side of row {}".format(neighbor_code.name,
                                                                                                                       neighbor_code.entry,
                                                                                                                       neighbor_code.rep,
@@ -604,7 +605,14 @@ def update_number_of_plants_in_end_groups(updated_all_items, groups):
                     measured_row_seg_count += 1
     print "Updated {} row segs wtih measured values".format(measured_row_seg_count)
 
-def output_results(geo_images, output_directory):
+def output_results(rows, geo_images, output_directory, database_filepath='none'):
+    
+    if database_filepath != 'none':
+        print "Saving {} rows to field database {}.".format(len(rows), database_filepath)
+        field_database = FieldDatabase(database_filepath)
+        field_database.save_rows(rows)
+        field_database.close()
+        return
     
     dump_filename = "stage2_rows_{}_{}.txt".format(geo_images[0].image_time, geo_images[-1].image_time)
     dump_filepath = os.path.join(output_directory, dump_filename)
@@ -617,39 +625,15 @@ def output_results(geo_images, output_directory):
             print "Runtime error when pickling. Exception {}".format(e)
 
 
-if __name__ == '__main__':
-    '''Group codes into rows/groups/segments.'''
-
-    parser = argparse.ArgumentParser(description='''Group codes into rows/groups/segments.''')
-    parser.add_argument('group_info_file', help='file with group numbers and corresponding number of plants.')
-    #parser.add_argument('path_file', help='file with path position information used for segmenting rows.')
-    parser.add_argument('input_directory', help='directory containing pickled files from previous stage.')
-    parser.add_argument('field_direction', help='Planting angle of entire field.  0 degrees East and increases CCW.')
-    parser.add_argument('output_directory', help='where to write output files')
-    parser.add_argument('-u', dest='updated_items_filepath', default='none', help='')
-    
-    args = parser.parse_args()
-    
-    # convert command line arguments
-    group_info_file = args.group_info_file
-    #path_file = args.path_file
-    input_directory = args.input_directory
-    field_direction = float(args.field_direction)
-    output_directory = args.output_directory
-    updated_items_filepath = args.updated_items_filepath
-    
-    # Parse in group info
+def load_grouping_info(group_info_file):
+    '''Return GroupingInfo parsed from grouping file with duplicate ids removed.'''
     grouping_info = parse_grouping_file(group_info_file)
     print "Parsed {} groups. ".format(len(grouping_info))
     
-    grouping_info = make_grouping_info_unique(grouping_info)
-
-    geo_images = unpickle_geo_images(input_directory)
+    return make_grouping_info_unique(grouping_info)
 
-    if len(geo_images) == 0:
-        print "Couldn't load any geo images from input directory {}".format(input_directory)
-        sys.exit(1)
-    
+def group_codes_into_rows(geo_images, grouping_info, field_direction, updated_items_filepath='none'):
+    '''Return list of rows built from codes found in geo images, with codes split into group segments and groups.'''
     all_codes = all_codes_from_geo_images(geo_images)
     
     print 'Found {} codes in {} geo images.'.format(len(all_codes), len(geo_images))
@@ -674,26 +658,25 @@ if __name__ == '__main__':
     #    print "\n\n\n"
     
     # Merge items down so they're unique.  One code with reference other instances of that same code.
-    merged_codes = merge_items(all_codes, max_distance=2000)
+    merged_codes = merge_codes(all_codes, max_distance=2000)
     
-    merged_codes = cluster_merged_items(merged_codes, geo_images, cluster_size=0.3)
+    merged_codes, cluster_stats = cluster_merged_items_with_stats(merged_codes, cluster_size=0.3)
     
     print '{} unique codes.'.format(len(merged_codes))
     
-    check_code_precision(merged_codes)
+    check_code_precision(merged_codes, cluster_stats)
                 
     row_codes = [code for code in merged_codes if code.type.lower() == 'rowcode']
     group_codes = [code for code in merged_codes if code.type.lower() == 'groupcode']
     
     # Tell user how many codes are missing or if there are any extra codes.
     found_code_ids = [code.name for code in group_codes] 
-    all_code_ids = [g[0] for g in grouping_info] 
-    missing_code_ids = [id for id in all_code_ids if id not in found_code_ids]
-    extra_code_ids = [id for id in found_code_ids if id not in all_code_ids]
+    missing_code_ids = grouping_info.missing_ids(found_code_ids)
+    extra_code_ids = grouping_info.extra_ids(found_code_ids)
     
     warn_about_missing_and_extra_codes(missing_code_ids, extra_code_ids)
 
-    associate_ids_to_entry_rep(group_codes)
+    associate_ids_to_entry_rep(group_codes, grouping_info)
 
     grouped_row_codes = group_row_codes(row_codes)
     
@@ -703,7 +686,7 @@ if __name__ == '__main__':
 
     display_row_info(grouped_row_codes)
         
-    rows = create_rows(grouped_row_codes)
+    rows = create_rows(grouped_row_codes, field_direction)
                 
     if len(rows) == 0:
         print "No complete rows found.  Exiting."
@@ -728,7 +711,7 @@ if __name__ == '__main__':
 
     codes_with_projections = calculate_projection_to_nearest_row(group_codes, rows)
             
-    group_segments = create_group_segments(codes_with_projections)
+    group_segments = create_group_segments(codes_with_projections, rows)
         
     # Go through and organize segments.
     start_segments, middle_segments, end_segments, single_segments = organize_group_segments(group_segments)
@@ -737,7 +720,7 @@ if __name__ == '__main__':
         print "Middle segments that span entire row aren't supported right now. Exiting"
         sys.exit(1)
     
-    groups = complete_groups(end_segments, single_segments)
+    groups = complete_groups(end_segments, single_segments, field_passes)
         
     handle_single_segments(single_segments, groups)
         
@@ -746,13 +729,52 @@ if __name__ == '__main__':
     # JUST HERE FOR FINDING MISSING CODES
     order_and_number_items_by_row(rows)
     
-    warn_about_bad_group_lengths(groups)
+    warn_about_bad_group_lengths(groups, grouping_info)
 
-    display_missing_codes_neighbors(missing_code_ids)
+    display_missing_codes_neighbors(missing_code_ids, grouping_info, group_codes)
     
     # update # of plants in each measured groups and ones at end of rows
     update_number_of_plants_in_groups(updated_all_items, group_segments)
 
     update_number_of_plants_in_end_groups(updated_all_items, groups)
+
+    return rows
+
+if __name__ == '__main__':
+    '''Group codes into rows/groups/segments.'''
+
+    parser = argparse.ArgumentParser(description='''Group codes into rows/groups/segments.''')
+    parser.add_argument('group_info_file', help='file with group numbers and corresponding number of plants.')
+    #parser.add_argument('path_file', help='file with path position information used for segmenting rows.')
+    parser.add_argument('input_directory', help='directory containing pickled files from previous stage.')
+    parser.add_argument('field_direction', help='Planting angle of entire field.  0 degrees East and increases CCW.')
+    parser.add_argument('output_directory', help='where to write output files')
+    parser.add_argument('-u', dest='updated_items_filepath', default='none', help='')
+    parser.add_argument('-db', dest='database_filepath', default='none', help='If specified (ending in .db) then rows are saved to this field database instead of being pickled.')
+    
+    args = parser.parse_args()
+    
+    # convert command line arguments
+    group_info_file = args.group_info_file
+    #path_file = args.path_file
+    input_directory = args.input_directory
+    field_direction = float(args.field_direction)
+    output_directory = args.output_directory
+    updated_items_filepath = args.updated_items_filepath
+    database_filepath = args.database_filepath
+    
+    if database_filepath != 'none' and not is_field_database_path(database_filepath):
+        print "Error: Field database {} must end in .db".format(database_filepath)
+        sys.exit(1)
+
+    grouping_info = load_grouping_info(group_info_file)
+
+    geo_images = unpickle_geo_images(input_directory)
+
+    if len(geo_images) == 0:
+        print "Couldn't load any geo images from input directory {}".format(input_directory)
+        sys.exit(1)
+        
+    rows = group_codes_into_rows(geo_images, grouping_info, field_direction, updated_items_filepath)
                     
-    output_results(geo_images, output_directory)
\ No newline at end of file
+    output_results(rows, geo_images, output_directory, database_filepath)
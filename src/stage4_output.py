@@ -12,30 +12,12 @@ import numpy as np
 
 # Project imports
 from data import *
-from item_processing import export_results, position_difference
+from item_processing import results_header, result_fields, position_difference
+from field_database import FieldDatabase, is_field_database_path
 
-if __name__ == '__main__':
-    '''Output results.'''
-
-    parser = argparse.ArgumentParser(description='''Output results.''')
-    parser.add_argument('input_filepath', help='pickled file from either stage 2 or stage 3.')
-    parser.add_argument('output_directory', help='where to write output files')
-    
-    args = parser.parse_args()
-    
-    # convert command line arguments
-    input_filepath = args.input_filepath
-    out_directory = args.output_directory
-
-    # Unpickle rows.
-    with open(input_filepath) as input_file:
-        rows = pickle.load(input_file)
-        print 'Loaded {} rows from {}'.format(len(rows), input_filepath)
-    
-    rows = sorted(rows, key=lambda r: r.number)
-    
+def ordered_field_items(rows):
+    '''Yield items in each row (sorted by row number) in serpentine order and number them within field and row.'''
     current_field_item_num = 1
-    ordered_items = []
     for row in rows:
         row_items = []
         for i, segment in enumerate(row.group_segments):
@@ -55,66 +37,110 @@ if __name__ == '__main__':
         for item_num_in_row, item in enumerate(row_items):
             item.number_within_field = current_field_item_num
             item.number_within_row = item_num_in_row + 1 # index off 1 instead of 0
-            ordered_items.append(item)
             current_field_item_num += 1
-                
-    items = ordered_items
-    
+            yield item
+
+def average_item_references(item):
+    '''Update item position, area and size to be the average of all its references.'''
+    avg_item = item # copy.copy(item)
+    item_references = [avg_item] + avg_item.other_items
+    avg_x = np.mean([it.position[0] for it in item_references])
+    avg_y = np.mean([it.position[1] for it in item_references])
+    avg_z = np.mean([it.position[2] for it in item_references])
+    avg_item.position = (avg_x, avg_y, avg_z)
+    avg_item.area = np.mean([it.area for it in item_references])
+    avg_width = np.mean([it.size[0] for it in item_references])
+    avg_height = np.mean([it.size[1] for it in item_references])
+    avg_item.size = (avg_width, avg_height)
+    return avg_item
+
+def export_field_results(load_rows, row_directions, out_directory, expected_first_group_code=None):
+    '''
+    Write all item references and averaged items to CSV files in output directory and return both file paths. Load rows is
+    called to get an iterable of rows sorted by row number each time items need to be gone through.  Positions are relative
+    to the first group code.  If expected first group code (name) is specified then raise ValueError if it isn't the first.
+    Also raise ValueError if there aren't any group codes.
+    '''
     first_group_code = None
-    for item in items:
+    for item in ordered_field_items(load_rows()):
         if item.type.lower() == 'groupcode':
             first_group_code = item
             break
         
     if first_group_code is None:
-        print "No group codes. Exiting"
-        sys.exit(1)
+        raise ValueError("No group codes")
         
-    expected_first_group_code = '930'
-    if first_group_code.name != expected_first_group_code:
-        expected_first_group_code_actual_index = [item.name for item in items].index(expected_first_group_code)
-        print "First group code is {0} and should be {1}. {1} actually has an index of {2}. Exiting".format(first_group_code.name, expected_first_group_code, expected_first_group_code_actual_index)
-        sys.exit(1)
+    if expected_first_group_code is not None and first_group_code.name != expected_first_group_code:
+        item_names = [item.name for item in ordered_field_items(load_rows())]
+        if expected_first_group_code in item_names:
+            expected_index_message = "{} actually has an index of {}".format(expected_first_group_code, item_names.index(expected_first_group_code))
+        else:
+            expected_index_message = "{} wasn't found".format(expected_first_group_code)
+        raise ValueError("First group code is {0} and should be {1}. {2}".format(first_group_code.name, expected_first_group_code, expected_index_message))
                 
     first_position = first_group_code.position
     
-    for item in items:
-        rel_x = item.position[0] - first_position[0]
-        rel_y = item.position[1] - first_position[1]
-        rel_z = item.position[2] - first_position[2]
-        item.field_position = (rel_x, rel_y, rel_z)
-                
-    print 'Found {} items in rows.'.format(len(items))
-    
-    # Shouldn't be necessary, but do it anyway.
-    print 'Sorting items by number within field.'
-    items = sorted(items, key=lambda item: item.number_within_field)
-    
-    # Write everything out to CSV file to be imported into database.
+    # Write everything out to CSV files to be imported into database.  Items are already ordered by number within field.
     all_results_filename = time.strftime("_results_all-%Y%m%d-%H%M%S.csv")
     all_results_filepath = os.path.join(out_directory, all_results_filename)
-    all_output_items = []
-    for item in items:
-        all_output_items.extend([item] + item.other_items)
-    export_results(all_output_items, rows, all_results_filepath)
-    print "Exported all results to " + all_results_filepath
-    
-    # Write averaged results out to file.
     avg_results_filename = time.strftime("_results_averaged-%Y%m%d-%H%M%S.csv")
     avg_results_filepath = os.path.join(out_directory, avg_results_filename)
-    avg_output_items = []
-    for item in items:
-        avg_item = item # copy.copy(item)
-        item_references = [avg_item] + avg_item.other_items
-        avg_x = np.mean([it.position[0] for it in item_references])
-        avg_y = np.mean([it.position[1] for it in item_references])
-        avg_z = np.mean([it.position[2] for it in item_references])
-        avg_item.position = (avg_x, avg_y, avg_z)
-        avg_item.area = np.mean([it.area for it in item_references])
-        avg_width = np.mean([it.size[0] for it in item_references])
-        avg_height = np.mean([it.size[1] for it in item_references])
-        avg_item.size = (avg_width, avg_height)
-        avg_output_items.append(avg_item)
-    print 'Output averaged {} items'.format(len(avg_output_items))
-    export_results(avg_output_items, rows, avg_results_filepath)
+    num_items = 0
+    with open(all_results_filepath, 'wb') as all_results_file, open(avg_results_filepath, 'wb') as avg_results_file:
+        all_writer = csv.writer(all_results_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        avg_writer = csv.writer(avg_results_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        all_writer.writerow(results_header)
+        avg_writer.writerow(results_header)
+        
+        for item in ordered_field_items(load_rows()):
+            rel_x = item.position[0] - first_position[0]
+            rel_y = item.position[1] - first_position[1]
+            rel_z = item.position[2] - first_position[2]
+            item.field_position = (rel_x, rel_y, rel_z)
+            
+            for item_ref in [item] + item.other_items:
+                all_writer.writerow(result_fields(item_ref, row_directions))
+                
+            avg_writer.writerow(result_fields(average_item_references(item), row_directions))
+            num_items += 1
+                
+    print 'Found {} items in rows.'.format(num_items)
+    print "Exported all results to " + all_results_filepath
+    print 'Output averaged {} items'.format(num_items)
     print "Exported averaged results to " + avg_results_filepath
+    
+    return all_results_filepath, avg_results_filepath
+
+if __name__ == '__main__':
+    '''Output results.'''
+
+    parser = argparse.ArgumentParser(description='''Output results.''')
+    parser.add_argument('input_filepath', help='pickled file from either stage 2 or stage 3, or field database (.db).')
+    parser.add_argument('output_directory', help='where to write output files')
+    
+    args = parser.parse_args()
+    
+    # convert command line arguments
+    input_filepath = args.input_filepath
+    out_directory = args.output_directory
+
+    if is_field_database_path(input_filepath):
+        # Stream rows out of database one at a time.
+        field_database = FieldDatabase(input_filepath)
+        load_rows = field_database.rows
+        row_directions = field_database.row_directions()
+        print 'Reading {} rows from {}'.format(len(row_directions), input_filepath)
+    else:
+        # Unpickle rows.
+        with open(input_filepath) as input_file:
+            rows = pickle.load(input_file)
+            print 'Loaded {} rows from {}'.format(len(rows), input_filepath)
+        rows = sorted(rows, key=lambda r: r.number)
+        load_rows = lambda: rows
+        row_directions = dict((row.number, row.direction) for row in rows)
+    
+    try:
+        export_field_results(load_rows, row_directions, out_directory, expected_first_group_code='930')
+    except ValueError as e:
+        print "{}. Exiting".format(e)
+        sys.exit(1)
@@ -0,0 +1,233 @@
+#! /usr/bin/env python
+
+import sys
+import os
+import argparse
+import math
+import random
+import csv
+
+# non-default import
+import cv2
+import numpy as np
+
+try:
+    import qrcode
+except ImportError:
+    qrcode = None
+
+# Project imports
+from image_utils import rectangle_corners
+
+# Colors (BGR) that the locators are set up to look for.
+soil_color = (45, 70, 95)
+plant_color = (40, 150, 50)
+stick_color = (200, 90, 30)
+
+class SyntheticField(object):
+    '''
+    Layout of a simulated field where each row runs north starting with a 'R.<n>' code, followed by numbered group codes
+    with plants between them, and ending with another row code.  All positions are in meters.
+    '''
+    def __init__(self, num_rows=4, row_length=25.0, row_spacing=0.9144, group_length=4.572, plant_spacing=0.9144, first_group_code=930,
+                 origin=(1000.0, 5000.0), seed=0):
+        '''Constructor.'''
+        self.num_rows = num_rows
+        self.row_length = row_length # distance between row codes at each end of the row
+        self.row_spacing = row_spacing # distance between neighboring rows
+        self.group_length = group_length # distance between group codes within a row
+        self.plant_spacing = plant_spacing # distance between plants in a group
+        self.origin = origin # position of start code in first row
+        self.random = random.Random(seed)
+
+        self.codes = [] # (name, position) of every code in field
+        self.groups = [] # (group code name, number of plants) in the order they were planted
+        self.plants = [] # position of every plant
+        self.sticks = [] # (position, angle in degrees) of blue sticks laying in field
+        next_group_code = first_group_code
+        for row_number in range(1, num_rows + 1):
+            x = origin[0] + (row_number - 1) * row_spacing
+            start_y = origin[1]
+            end_y = origin[1] + row_length
+            self.codes.append(('R.{}'.format(row_number), (x, start_y)))
+
+            group_ys = list(np.arange(start_y + group_length / 2.0, end_y - group_length / 4.0, group_length))
+            for i, group_y in enumerate(group_ys):
+                group_name = str(next_group_code)
+                next_group_code += 1
+                self.codes.append((group_name, (x, group_y)))
+                # Plants are centered between codes.
+                next_y = group_ys[i+1] if i + 1 < len(group_ys) else end_y
+                plant_ys = list(np.arange(group_y + plant_spacing / 2.0, next_y - plant_spacing / 4.0, plant_spacing))
+                self.groups.append((group_name, len(plant_ys)))
+                for plant_y in plant_ys:
+                    jitter = self.random.uniform(-0.02, 0.02)
+                    self.plants.append((x + jitter, plant_y))
+                # One blue stick per group, next to the row so it doesn't cover anything.
+                self.sticks.append(((x + row_spacing / 3.0, group_y + group_length / 2.0), self.random.uniform(0, 180)))
+
+            self.codes.append(('R.{}'.format(row_number), (x, end_y)))
+
+    def row_x(self, row_number):
+        return self.origin[0] + (row_number - 1) * self.row_spacing
+
+def make_qr_image(data, size_pixels):
+    '''Return grayscale image (size_pixels square) of QR code with a white border around it.'''
+    qr = qrcode.QRCode(border=2, error_correction=qrcode.constants.ERROR_CORRECT_M)
+    qr.add_data(data)
+    qr.make(fit=True)
+    matrix = np.array(qr.get_matrix(), dtype=np.uint8)
+    modules = (1 - matrix) * 255 # black modules on white background
+    return cv2.resize(modules, (size_pixels, size_pixels), interpolation=cv2.INTER_NEAREST)
+
+class FrameRenderer(object):
+    '''Draws what a camera looking straight down (top of image north) sees of a synthetic field.'''
+    def __init__(self, field, resolution, image_size, qr_size):
+        '''Constructor. Resolution in centimeters/pixel, image size is (width, height) in pixels and QR size is in centimeters.'''
+        self.field = field
+        self.resolution = resolution
+        self.image_size = image_size
+        self.qr_pixels = int(round(qr_size / resolution))
+        self.plant_radius = max(2, int(round(4.0 / resolution))) # 8 cm wide
+        self.stick_length = int(round(30.0 / resolution)) # 30 cm long
+        self.stick_width = max(2, int(round(1.5 / resolution))) # 1.5 cm diameter
+        # Codes are the same in every frame they show up in so only render each one once.
+        self.code_images = dict((name, cv2.cvtColor(make_qr_image(name, self.qr_pixels), cv2.COLOR_GRAY2BGR)) for name, _ in field.codes)
+
+    def to_pixel(self, position, camera_position):
+        '''Return (column, row) of position in image taken at camera position.'''
+        width, height = self.image_size
+        column = (position[0] - camera_position[0]) * 100 / self.resolution + width / 2.0
+        row = -(position[1] - camera_position[1]) * 100 / self.resolution + height / 2.0
+        return int(round(column)), int(round(row))
+
+    def render(self, camera_position, noise_seed):
+        width, height = self.image_size
+        image = np.empty((height, width, 3), np.uint8)
+        image[:] = soil_color
+        noise = np.random.RandomState(noise_seed).randint(-12, 13, size=(height, width, 1))
+        image = np.clip(image.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+        for plant_position in self.field.plants:
+            column, row = self.to_pixel(plant_position, camera_position)
+            if -self.plant_radius <= column < width + self.plant_radius and -self.plant_radius <= row < height + self.plant_radius:
+                cv2.circle(image, (column, row), self.plant_radius, plant_color, -1)
+
+        for stick_position, angle in self.field.sticks:
+            column, row = self.to_pixel(stick_position, camera_position)
+            rect = ((column, row), (self.stick_length, self.stick_width), angle)
+            corners = np.int32(rectangle_corners(rect))
+            cv2.fillConvexPoly(image, corners, stick_color)
+
+        half_code = self.qr_pixels // 2
+        for name, code_position in self.field.codes:
+            column, row = self.to_pixel(code_position, camera_position)
+            left = column - half_code
+            top = row - half_code
+            # Only draw codes that are completely in view.  Partial codes would be thrown out anyway.
+            if left < 0 or top < 0 or left + self.qr_pixels > width or top + self.qr_pixels > height:
+                continue
+            image[top:top+self.qr_pixels, left:left+self.qr_pixels] = self.code_images[name]
+
+        return image
+
+def generate_field(output_directory, field, resolution=0.1, image_size=(1600, 1200), qr_size=6.0, overlap=0.5, frame_period=0.5):
+    '''
+    Render images flying north over each row so consecutive images overlap by the specified fraction.  Writes images,
+    geo file, grouping file and files of actual code, plant and stick positions to output directory.  Return number of images written.
+    '''
+    image_directory = os.path.join(output_directory, 'images')
+    if not os.path.exists(image_directory):
+        os.makedirs(image_directory)
+
+    renderer = FrameRenderer(field, resolution, image_size, qr_size)
+
+    frame_height_meters = image_size[1] * resolution / 100
+    frame_step = frame_height_meters * (1.0 - overlap)
+    heading = math.pi / 2 # north
+
+    image_time = 1000000000.0
+    image_number = 0
+    with open(os.path.join(output_directory, 'geo.csv'), 'w') as geo_file:
+        for row_number in range(1, field.num_rows + 1):
+            x = field.row_x(row_number)
+            y = field.origin[1] - frame_height_meters / 2
+            while y <= field.origin[1] + field.row_length + frame_height_meters / 2:
+                image_number += 1
+                image_name = 'synthetic_{:05d}'.format(image_number)
+                image = renderer.render((x, y), image_number)
+                cv2.imwrite(os.path.join(image_directory, image_name + '.jpg'), image, [cv2.IMWRITE_JPEG_QUALITY, 95])
+                geo_file.write('{:.3f},{},{:.4f},{:.4f},{:.3f},0,0,{:.6f}\n'.format(image_time, image_name, x, y, 0, heading))
+                image_time += frame_period
+                y += frame_step
+            image_time += 10 # turning around at end of row
+
+    with open(os.path.join(output_directory, 'grouping.csv'), 'w') as grouping_file:
+        for order_entered, (group_name, num_plants) in enumerate(field.groups):
+            entry = str(order_entered + 1)
+            rep = 'A'
+            grouping_file.write('{},{},{}{},{},{},{}\n'.format(order_entered + 1, group_name, entry, rep, entry, rep, num_plants))
+
+    with open(os.path.join(output_directory, 'codes.csv'), 'wb') as codes_file:
+        writer = csv.writer(codes_file)
+        for name, position in field.codes:
+            writer.writerow([name, position[0], position[1]])
+
+    with open(os.path.join(output_directory, 'plants.csv'), 'wb') as plants_file:
+        writer = csv.writer(plants_file)
+        for position in field.plants:
+            writer.writerow([position[0], position[1]])
+
+    with open(os.path.join(output_directory, 'sticks.csv'), 'wb') as sticks_file:
+        writer = csv.writer(sticks_file)
+        for position, angle in field.sticks:
+            writer.writerow([position[0], position[1], angle])
+
+    return image_number
+
+def read_actual_code_names(codes_filepath):
+    '''Return set of code names written by generate_field().'''
+    with open(codes_filepath, 'r') as codes_file:
+        return set(row[0] for row in csv.reader(codes_file) if len(row) > 0)
+
+def read_actual_positions(positions_filepath):
+    '''Return Nx2 array of (x, y) positions written to plants or sticks file by generate_field().'''
+    with open(positions_filepath, 'r') as positions_file:
+        positions = [(float(row[0]), float(row[1])) for row in csv.reader(positions_file) if len(row) > 0]
+    return np.array(positions, dtype=np.float64).reshape(-1, 2)
+
+if __name__ == '__main__':
+    '''Generate synthetic overhead images of a field for benchmarking.'''
+
+    parser = argparse.ArgumentParser(description='''Generate synthetic overhead images of a field for benchmarking.''')
+    parser.add_argument('output_directory', help='where to write images, geo file, grouping file and actual code positions.')
+    parser.add_argument('-nr', dest='num_rows', default=4, help='Number of rows in field. Default 4.')
+    parser.add_argument('-rl', dest='row_length', default=25.0, help='Distance between row codes in meters. Must be over 20 so stage 2 keeps row codes separate. Default 25.')
+    parser.add_argument('-gl', dest='group_length', default=4.572, help='Distance between group codes in meters. Default 4.572 (5 plants).')
+    parser.add_argument('-ps', dest='plant_spacing', default=0.9144, help='Distance between plants in meters. Default 0.9144 (same as stage 2 expects).')
+    parser.add_argument('-rs', dest='resolution', default=0.1, help='Image resolution in centimeter/pixel. Default 0.1.')
+    parser.add_argument('-qr', dest='qr_size', default=6.0, help='Side length of QR codes in centimeters. Default 6.')
+    parser.add_argument('-iw', dest='image_width', default=1600, help='Image width in pixels. Default 1600.')
+    parser.add_argument('-ih', dest='image_height', default=1200, help='Image height in pixels. Default 1200.')
+    parser.add_argument('-ol', dest='overlap', default=0.5, help='Fraction [0, 1) that consecutive images overlap. Default 0.5.')
+    parser.add_argument('-seed', dest='seed', default=0, help='Random seed. Default 0.')
+
+    args = parser.parse_args()
+
+    if qrcode is None:
+        print "Error: the 'qrcode' package is needed to draw codes.  Install it with 'pip install qrcode'."
+        sys.exit(1)
+
+    overlap = float(args.overlap)
+    if overlap < 0 or overlap >= 1:
+        print "Error: Overlap must be at least 0 and less than 1."
+        sys.exit(1)
+
+    field = SyntheticField(int(args.num_rows), float(args.row_length), group_length=float(args.group_length),
+                           plant_spacing=float(args.plant_spacing), seed=int(args.seed))
+
+    num_images = generate_field(args.output_directory, field, float(args.resolution), (int(args.image_width), int(args.image_height)),
+                                float(args.qr_size), overlap)
+
+    print "Wrote {} images of {} rows with {} codes and {} plants to {}".format(num_images, field.num_rows, len(field.codes),
+                                                                                 len(field.plants), args.output_directory)
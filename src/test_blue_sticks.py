@@ -26,6 +26,7 @@ if __name__ == '__main__':
     parser.add_argument('output_directory', help='where to write output files')
     parser.add_argument('-rs', dest='resolution', default=0, help='Calculated image resolution in centimeter/pixel.')
     parser.add_argument('-cr', dest='camera_rotation', default=0, help='Camera rotation (0, 90, 180, 270).  0 is camera top forward and increases counter-clockwise.' )
+    parser.add_argument('-cp', dest='color_profile', default='night', help='Name of color profile for stick colors. Options are {}. Default night.'.format(sorted(COLOR_PROFILES.keys())))
     parser.add_argument('-debug_start', dest='debug_start', default='__none__', help='Substring in image name to start processing at.')
     parser.add_argument('-debug_stop', dest='debug_stop', default='__none__', help='Substring in image name to stop processing at.')
     
@@ -43,6 +44,7 @@ if __name__ == '__main__':
     focal_length = 0
     use_marked_image = True
     camera_rotation = int(args.camera_rotation)
+    color_profile = args.color_profile
     debug_start = args.debug_start
     debug_stop = args.debug_stop
 
@@ -56,6 +58,10 @@ if __name__ == '__main__':
         print "Error: Camera rotation {0} invalid.  Possible choices are {1}".format(camera_rotation, possible_camera_rotations)
         sys.exit(1)
         
+    if color_profile not in COLOR_PROFILES:
+        print "Error: Color profile {0} invalid.  Possible choices are {1}".format(color_profile, sorted(COLOR_PROFILES.keys()))
+        sys.exit(1)
+        
     image_filenames = read_images(image_directory, ['tiff', 'tif', 'jpg', 'jpeg', 'png'])
                         
     if len(image_filenames) == 0:
@@ -91,7 +97,7 @@ if __name__ == '__main__':
     if missing_image_count > 0:
         print "Warning {} geo images do not exist and will be skipped.".format(missing_image_count)
 
-    blue_stick_locator = BlueStickLocator(stick_length, stick_diameter)
+    blue_stick_locator = BlueStickLocator(stick_length, stick_diameter, color_profile)
     item_extractor = ItemExtractor([blue_stick_locator])
     
     ImageWriter.level = ImageWriter.DEBUG
@@ -99,7 +105,7 @@ if __name__ == '__main__':
     # Extract all QR items from images.
     for i, geo_image in enumerate(geo_images):
         print "Analyzing image {0} [{1}/{2}]".format(geo_image.file_name, i+1, len(geo_images))
-        geo_image.items = process_geo_image(geo_image, item_extractor, camera_rotation, image_directory, out_directory, use_marked_image)
+        geo_image.items = process_geo_image(geo_image, item_extractor, camera_rotation, image_directory, out_directory, use_marked_image) or []
         for code in geo_image.items:
             print "Found code: {}".format(code.name)
   
@@ -0,0 +1,79 @@
+#! /usr/bin/env python
+
+import math
+import random
+import unittest
+
+# OpenCV imports
+import cv2
+import numpy as np
+
+# Project imports
+from image_utils import merge_rectangles, cluster_rectangles, rectangle_corners
+
+def contains_points(rectangle, points, tolerance=1e-3):
+    '''Return true if every point is inside (or on the edge of) rotated rectangle.'''
+    contour = np.array(rectangle_corners(rectangle), dtype=np.float32).reshape(-1, 1, 2)
+    return all(cv2.pointPolygonTest(contour, (float(x), float(y)), True) >= -tolerance for x, y in points)
+
+def connected_groups(centers, eps):
+    '''Return sets of indexes whose centers are connected through a chain of centers less than eps apart.'''
+    groups = []
+    unclaimed = set(range(len(centers)))
+    while unclaimed:
+        group = set([unclaimed.pop()])
+        to_check = list(group)
+        while to_check:
+            i = to_check.pop()
+            for j in list(unclaimed):
+                if math.hypot(centers[i][0] - centers[j][0], centers[i][1] - centers[j][1]) < eps:
+                    unclaimed.remove(j)
+                    group.add(j)
+                    to_check.append(j)
+        groups.append(group)
+    return groups
+
+class TestRectangleClustering(unittest.TestCase):
+
+    def test_merge_contains_every_rectangle(self):
+        rectangles = [((10, 10), (4, 2), 0), ((14, 11), (4, 4), 30), ((12, 16), (2, 6), -45)]
+        merged = merge_rectangles(rectangles)
+        for rectangle in rectangles:
+            self.assertTrue(contains_points(merged, rectangle_corners(rectangle)))
+
+    def test_merge_single_rectangle_unchanged(self):
+        merged = merge_rectangles([((10, 20), (8, 4), 0)])
+        center, size, _ = merged
+        self.assertAlmostEqual(center[0], 10, places=3)
+        self.assertAlmostEqual(center[1], 20, places=3)
+        self.assertAlmostEqual(size[0] * size[1], 32, places=2)
+
+    def test_overlapping_and_chained_rectangles_collapse(self):
+        # First three overlap or are chained together through the middle one.  Last one is far away.
+        rectangles = [((0, 0), (6, 6), 0), ((8, 0), (6, 6), 0), ((16, 0), (6, 6), 0), ((100, 100), (6, 6), 0)]
+        clusters = cluster_rectangles(rectangles, eps=10)
+        self.assertEqual(len(clusters), 2)
+        self.assertTrue(contains_points(clusters[0], [corner for rectangle in rectangles[:3] for corner in rectangle_corners(rectangle)]))
+        self.assertFalse(contains_points(clusters[0], [(100, 100)]))
+        self.assertTrue(contains_points(clusters[1], rectangle_corners(rectangles[3])))
+
+    def test_clusters_match_connected_centers(self):
+        rand = random.Random(0)
+        for _ in range(20):
+            rectangles = [((rand.uniform(0, 200), rand.uniform(0, 200)), (rand.uniform(2, 10), rand.uniform(2, 10)), rand.uniform(-90, 0))
+                          for _ in range(rand.randint(1, 60))]
+            eps = rand.uniform(5, 40)
+            clusters = cluster_rectangles(rectangles, eps)
+            # Clusters should be in order of their first rectangle.
+            groups = sorted(connected_groups([rectangle[0] for rectangle in rectangles], eps), key=min)
+            self.assertEqual(len(clusters), len(groups))
+            for cluster, group in zip(clusters, groups):
+                expected = merge_rectangles([rectangles[i] for i in sorted(group)])
+                np.testing.assert_allclose(cluster[0], expected[0], atol=1e-3)
+                self.assertAlmostEqual(cluster[1][0] * cluster[1][1], expected[1][0] * expected[1][1], places=2)
+
+    def test_no_rectangles(self):
+        self.assertEqual(cluster_rectangles([], eps=10), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+# OpenCV imports
+import cv2
+import numpy as np
+
+# Project imports
+from image_utils import ImageWriter
+from item_processing import process_geo_images
+from timing import PhaseTimer
+
+class FakeGeoImage(object):
+    '''Just the geo image properties that process_geo_image() uses.'''
+    def __init__(self, file_name):
+        '''Constructor.'''
+        self.file_name = file_name
+        self.resolution = 0.1
+        self.size = (0, 0)
+
+class WritingExtractor(object):
+    '''Stands in for ItemExtractor.  Writes a few crops of every image and doesn't find any items.'''
+    num_crops = 3
+
+    def extract_items(self, geo_image, image, marked_image, out_directory):
+        for i in range(WritingExtractor.num_crops):
+            ImageWriter.save_normal('crop_{}.png'.format(i), image)
+        return []
+
+class TestImageWriterTiming(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.image_directory = os.path.join(self.directory, 'images')
+        self.out_directory = os.path.join(self.directory, 'out')
+        os.makedirs(self.image_directory)
+        self.geo_images = []
+        image = np.random.RandomState(0).randint(0, 256, size=(600, 800, 3)).astype(np.uint8)
+        for i in range(12):
+            file_name = 'image_{:02d}.png'.format(i)
+            cv2.imwrite(os.path.join(self.image_directory, file_name), image)
+            self.geo_images.append(FakeGeoImage(file_name))
+        self.original_level = ImageWriter.level
+        ImageWriter.level = ImageWriter.NORMAL
+        PhaseTimer.enabled = True
+        PhaseTimer.take_records()
+
+    def tearDown(self):
+        ImageWriter.level = self.original_level
+        PhaseTimer.enabled = False
+        PhaseTimer.take_records()
+        shutil.rmtree(self.directory)
+
+    def test_every_background_write_timed_with_its_image(self):
+        # Marked images are written too so there are crops plus one marked image for each image.
+        results = list(process_geo_images(self.geo_images, WritingExtractor(), 0, self.image_directory, self.out_directory,
+                                          use_marked_image=True, workers=2, writer_threads=2))
+        self.assertEqual(len(results), len(self.geo_images))
+
+        num_written_images = sum(len(filenames) for _, _, filenames in os.walk(self.out_directory))
+        self.assertEqual(num_written_images, len(self.geo_images) * (WritingExtractor.num_crops + 1))
+
+        write_records = [record for record in PhaseTimer.records if record[1] == 'ImageWriter.write']
+        self.assertEqual(len(write_records), num_written_images)
+        for geo_image in self.geo_images:
+            image_write_records = [record for record in write_records if record[0] == geo_image.file_name]
+            self.assertEqual(len(image_write_records), WritingExtractor.num_crops + 1)
+
+if __name__ == '__main__':
+    unittest.main()
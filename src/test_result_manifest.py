@@ -0,0 +1,100 @@
+#! /usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+# Project imports
+from item_processing import ResultManifest
+
+class FakeGeoImage(object):
+    '''Just the geo image properties that make up a manifest key.'''
+    def __init__(self, file_name):
+        '''Constructor.'''
+        self.file_name = file_name
+        self.image_time = 0
+        self.position = (0, 0, 0)
+        self.heading_degrees = 0
+        self.size = (10, 10)
+        self.items = []
+
+class TestResultManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, 'manifest.pkl')
+        self.geo_images = []
+        for file_name in ['a.jpg', 'b.jpg']:
+            open(os.path.join(self.directory, file_name), 'w').close()
+            self.geo_images.append(FakeGeoImage(file_name))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_results_with_partial_tail(self, partial_length):
+        '''Record first image then append only part of the record for second image.  Return size of complete part.'''
+        manifest = ResultManifest(self.filepath, 'settings')
+        manifest.record(self.geo_images[0], self.directory, ['item'])
+        manifest.close()
+        good_size = os.path.getsize(self.filepath)
+        manifest.record(self.geo_images[1], self.directory, ['item'])
+        manifest.close()
+        with open(self.filepath, 'r+b') as manifest_file:
+            manifest_file.truncate(good_size + partial_length)
+        return good_size
+
+    def check_partial_result_removed(self, partial_length):
+        good_size = self.write_results_with_partial_tail(partial_length)
+        manifest = ResultManifest(self.filepath, 'settings')
+        self.assertEqual(os.path.getsize(self.filepath), good_size)
+        self.assertTrue(manifest.restore(self.geo_images[0], self.directory))
+        self.assertFalse(manifest.restore(self.geo_images[1], self.directory))
+
+        # Next result should be appended right after last good one so it can be read back in.
+        manifest.record(self.geo_images[1], self.directory, ['item'])
+        manifest.close()
+        manifest = ResultManifest(self.filepath, 'settings')
+        self.assertTrue(manifest.restore(self.geo_images[0], self.directory))
+        self.assertTrue(manifest.restore(self.geo_images[1], self.directory))
+
+    def test_partial_result_removed(self):
+        for partial_length in [1, 5, 20]:
+            self.check_partial_result_removed(partial_length)
+            os.remove(self.filepath)
+
+    def test_complete_results_kept(self):
+        self.write_results_with_partial_tail(0)
+        size = os.path.getsize(self.filepath)
+        manifest = ResultManifest(self.filepath, 'settings')
+        self.assertEqual(os.path.getsize(self.filepath), size)
+        self.assertTrue(manifest.restore(self.geo_images[0], self.directory))
+
+    def test_not_resuming_starts_over(self):
+        self.write_results_with_partial_tail(0)
+        manifest = ResultManifest(self.filepath, 'settings', resume=False)
+        self.assertEqual(manifest.results, {})
+        manifest.record(self.geo_images[0], self.directory, ['new item'])
+        manifest.close()
+        manifest = ResultManifest(self.filepath, 'settings')
+        self.assertEqual(manifest.results.keys(), ['a.jpg'])
+        self.assertTrue(manifest.restore(self.geo_images[0], self.directory))
+        self.assertEqual(self.geo_images[0].items, ['new item'])
+
+    def test_duplicate_results_compacted(self):
+        manifest = ResultManifest(self.filepath, 'settings')
+        for items in [['old item'], ['new item']]:
+            manifest.record(self.geo_images[0], self.directory, items)
+        manifest.record(self.geo_images[1], self.directory, ['item'])
+        manifest.close()
+        size = os.path.getsize(self.filepath)
+
+        manifest = ResultManifest(self.filepath, 'settings')
+        self.assertLess(os.path.getsize(self.filepath), size)
+        manifest = ResultManifest(self.filepath, 'settings')
+        self.assertTrue(manifest.restore(self.geo_images[0], self.directory))
+        self.assertEqual(self.geo_images[0].items, ['new item'])
+        self.assertTrue(manifest.restore(self.geo_images[1], self.directory))
+
+if __name__ == '__main__':
+    unittest.main()
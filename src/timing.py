@@ -0,0 +1,87 @@
+#! /usr/bin/env python
+
+import time
+import csv
+from contextlib import contextmanager
+from collections import OrderedDict
+
+import numpy as np
+
+class PhaseTimer(object):
+    '''
+    Records how long each phase of analyzing an image takes (reading, locating, decoding, writing, etc).
+    Nothing is recorded unless enabled. Like ImageWriter the settings are per process.
+    '''
+    enabled = False
+    image_name = '' # image currently being analyzed so recorded durations can be grouped by image.
+    records = [] # (image name, phase, seconds) for each timed call.
+
+    @staticmethod
+    def start_image(image_name):
+        '''Attribute all phases timed from now on to the specified image.'''
+        PhaseTimer.image_name = image_name
+
+    @staticmethod
+    @contextmanager
+    def phase(name):
+        '''Context manager that records how long the code inside of it takes.'''
+        if not PhaseTimer.enabled:
+            yield
+            return
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            PhaseTimer.records.append((PhaseTimer.image_name, name, time.time() - start_time))
+
+    @staticmethod
+    def record(image_name, name, seconds):
+        '''Record phase that was timed somewhere phase() can't be used, like a writer thread working on an earlier image.'''
+        if PhaseTimer.enabled:
+            PhaseTimer.records.append((image_name, name, seconds))
+
+    @staticmethod
+    def take_records():
+        '''Return records and start over with an empty list.  Used to send records from worker process back to main process.'''
+        records = PhaseTimer.records
+        PhaseTimer.records = []
+        return records
+
+    @staticmethod
+    def add_records(records):
+        PhaseTimer.records.extend(records)
+
+    @staticmethod
+    def image_durations():
+        '''Return ordered dictionary of phase -> ordered dictionary of image name -> total seconds spent in that phase for image.'''
+        durations = OrderedDict()
+        for image_name, phase, seconds in PhaseTimer.records:
+            image_durations = durations.setdefault(phase, OrderedDict())
+            image_durations[image_name] = image_durations.get(image_name, 0) + seconds
+        return durations
+
+    @staticmethod
+    def summary():
+        '''Return list of lines with total time and percentiles of per-image time for each phase, slowest total first.'''
+        durations = PhaseTimer.image_durations()
+        phase_totals = [(sum(image_durations.values()), phase) for phase, image_durations in durations.iteritems()]
+        lines = ['{:<40} {:>6} {:>10} {:>9} {:>9} {:>9} {:>9}'.format('Phase', 'Images', 'Total (s)', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'Max (ms)')]
+        for total, phase in sorted(phase_totals, reverse=True):
+            image_seconds = durations[phase].values()
+            p50, p90, p99 = np.percentile(image_seconds, [50, 90, 99]) * 1000
+            lines.append('{:<40} {:>6} {:>10.2f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(phase, len(image_seconds), total, p50, p90, p99,
+                                                                                      max(image_seconds) * 1000))
+        return lines
+
+    @staticmethod
+    def write_csv(filepath):
+        '''Write total seconds spent in each phase for each image.'''
+        image_phase_durations = OrderedDict()
+        for image_name, phase, seconds in PhaseTimer.records:
+            key = (image_name, phase)
+            image_phase_durations[key] = image_phase_durations.get(key, 0) + seconds
+        with open(filepath, 'wb') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(['Image', 'Phase', 'Seconds'])
+            for (image_name, phase), seconds in image_phase_durations.iteritems():
+                writer.writerow([image_name, phase, seconds])